@@ -1,3 +1,4 @@
+from bot.database.base import Repository
 from bot.database.models import Database
 
-__all__ = ['Database']
+__all__ = ['Repository', 'Database']
@@ -0,0 +1,269 @@
+"""
+Интерфейс хранилища бота.
+
+Обработчики, middleware, планировщик и очередь рассылок работают с базой
+только через методы Repository. Реализации: Database (SQLite, один
+писатель, кэши в памяти процесса) и PostgresDatabase (asyncpg, пул
+соединений, агрегаты и рейтинг считаются на сервере).
+"""
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from bot.database.juma import current_juma_week
+
+# Профиль пользователя - строка таблицы users (aiosqlite.Row у SQLite, dict у PostgreSQL)
+UserProfile = Mapping[str, Any]
+
+
+class Repository(ABC):
+    """Хранилище пользователей, марафонов, дуа, рассылок и служебных данных"""
+
+    # True - базу одновременно используют несколько экземпляров бота,
+    # поэтому состояния FSM нельзя держать в памяти процесса
+    multi_instance = False
+
+    @abstractmethod
+    async def init_db(self):
+        """Подключиться к базе и применить миграции"""
+
+    @abstractmethod
+    async def close(self):
+        """Записать отложенные изменения и закрыть соединения"""
+
+    async def sync_external_changes(self) -> bool:
+        """Сбросить кэши процесса, если базу изменили другие процессы"""
+        return False
+
+    # Пользователи
+    @abstractmethod
+    async def get_user(self, user_id: int) -> Optional[UserProfile]:
+        """Профиль пользователя или None"""
+
+    @abstractmethod
+    async def create_user(self, user_id: int, username: str, first_name: str):
+        pass
+
+    @abstractmethod
+    async def update_user_language(self, user_id: int, language: str):
+        pass
+
+    @abstractmethod
+    async def update_user_state(self, user_id: int, state: str):
+        pass
+
+    @abstractmethod
+    async def update_user_timezone(self, user_id: int, timezone: str):
+        """Сменить часовой пояс пользователя и пересчитать время его напоминаний"""
+
+    @abstractmethod
+    async def update_reminder_window(self, user_id: int, kind: str, start: str, length: int):
+        """Задать окно напоминания kind: начало HH:MM по местному времени и длительность в минутах"""
+
+    @abstractmethod
+    async def refresh_reminder_slots(self) -> int:
+        """Пересчитать время напоминаний по текущим смещениям часовых поясов"""
+
+    @abstractmethod
+    async def get_due_reminder_kinds(self, utc_minute: int) -> List[str]:
+        """Виды напоминаний, у которых есть получатели в минуту utc_minute"""
+
+    @abstractmethod
+    async def get_last_reminder_minute(self) -> Optional[datetime]:
+        """Последняя минута (UTC), обработанная диспетчером напоминаний, или None"""
+
+    @abstractmethod
+    async def set_last_reminder_minute(self, minute: datetime):
+        """Запомнить минуту (UTC), до которой напоминания поставлены в очередь"""
+
+    @abstractmethod
+    async def mark_user_reachable(self, user_id: int):
+        """Снять отметки о недоступности: пользователь снова написал боту"""
+
+    @abstractmethod
+    async def update_user_daily_plan(self, user_id: int, daily_plan: int):
+        pass
+
+    @abstractmethod
+    async def update_user_display_name(self, user_id: int, display_name: str, is_anonymous: bool):
+        pass
+
+    # Дуа
+    def get_current_juma_week(self) -> int:
+        """Ключ текущей недели Джума: порядковый номер ее пятницы"""
+        return current_juma_week()
+
+    @abstractmethod
+    async def count_user_duas_this_juma(self, user_id: int) -> int:
+        pass
+
+    @abstractmethod
+    async def count_total_duas_this_juma(self) -> int:
+        pass
+
+    @abstractmethod
+    async def add_dua(self, user_id: int, text: str, sender_name: str, is_anonymous: bool) -> Optional[str]:
+        """Сохранить дуа в пределах лимитов недели; иначе вернуть причину отказа (LIMIT_USER / LIMIT_TOTAL)"""
+
+    @abstractmethod
+    async def get_total_duas_count(self) -> int:
+        pass
+
+    @abstractmethod
+    async def get_undelivered_duas(self, limit: int = 200) -> List[dict]:
+        """Дуа, еще не пересланные администратору, в порядке отправки"""
+
+    @abstractmethod
+    async def mark_duas_delivered(self, dua_ids: List[int]):
+        pass
+
+    # Марафоны
+    @abstractmethod
+    async def create_marathon(self, goal_amount: int, start_date: str, end_date: str):
+        """Создать новый марафон, деактивировав остальные"""
+
+    @abstractmethod
+    async def get_active_marathon(self) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def join_marathon(self, user_id: int, marathon_id: int):
+        pass
+
+    @abstractmethod
+    async def get_user_marathon_stats(self, user_id: int, marathon_id: int) -> dict:
+        """total_contribution, completed_days, total_days пользователя"""
+
+    @abstractmethod
+    async def mark_day_completed(self, user_id: int, marathon_id: int, date: str, amount: int):
+        pass
+
+    @abstractmethod
+    async def mark_day_not_completed(self, user_id: int, marathon_id: int, date: str):
+        pass
+
+    @abstractmethod
+    async def reconcile_marathon_totals(self) -> List[dict]:
+        """Пересчитать суммы с нуля, исправить и вернуть расхождения"""
+
+    @abstractmethod
+    async def get_user_daily_completions(self, user_id: int, marathon_id: int, year: int, month: int) -> Dict[int, str]:
+        """Отметки пользователя за месяц: {день: completed / not_completed}"""
+
+    @abstractmethod
+    async def get_marathon_stats(self, marathon_id: int) -> dict:
+        """total_collected, participants_count, percent"""
+
+    @abstractmethod
+    async def get_daily_global_stats(self, marathon_id: int, date: str) -> dict:
+        """total_amount, participants_count за день"""
+
+    # Общая статистика
+    @abstractmethod
+    async def get_total_users_count(self) -> int:
+        pass
+
+    @abstractmethod
+    async def get_unreachable_users_count(self) -> Dict[str, int]:
+        """blocked, deactivated, backoff"""
+
+    @abstractmethod
+    async def get_total_marathons_count(self) -> int:
+        pass
+
+    @abstractmethod
+    async def get_total_donations_amount(self) -> int:
+        pass
+
+    # Рейтинг
+    @abstractmethod
+    async def verify_leaderboard(self) -> List[int]:
+        """Сверить рейтинг с базой, вернуть user_id с расхождениями"""
+
+    @abstractmethod
+    async def get_marathon_top(self, marathon_id: int, limit: int = 10) -> List[Tuple[int, int, int]]:
+        """Первые места рейтинга: список (место, user_id, сумма)"""
+
+    @abstractmethod
+    async def get_marathon_neighbours(self, user_id: int, marathon_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        """Соседи пользователя по рейтингу: список (место, user_id, сумма)"""
+
+    @abstractmethod
+    async def get_marathon_ranking(self, user_id: int, marathon_id: int) -> Tuple[int, int]:
+        """Место пользователя и его сумма"""
+
+    # Очередь рассылок
+    @abstractmethod
+    async def create_broadcast_job(
+        self,
+        job_key: str,
+        kind: str,
+        audience: str,
+        payload: Optional[dict] = None,
+        **parameters
+    ) -> Optional[int]:
+        """Создать задание со списком получателей; None, если ключ уже был"""
+
+    @abstractmethod
+    async def get_unfinished_broadcast_jobs(self, reset_claimed: bool = True) -> List[dict]:
+        pass
+
+    @abstractmethod
+    async def get_broadcast_job(self, job_id: int) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def count_pending_broadcast_recipients(self, job_id: int) -> int:
+        pass
+
+    @abstractmethod
+    async def claim_broadcast_recipients(self, job_id: int, limit: int) -> List[dict]:
+        pass
+
+    @abstractmethod
+    async def record_broadcast_results(self, job_id: int, results: Dict[str, list]):
+        pass
+
+    @abstractmethod
+    async def finish_broadcast_job(self, job_id: int):
+        pass
+
+    # Несколько процессов
+    @abstractmethod
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду name на ttl секунд"""
+
+    @abstractmethod
+    async def release_lease(self, name: str, holder: str):
+        pass
+
+    # Сообщения бота
+    @abstractmethod
+    async def add_bot_message(self, user_id: int, chat_id: int, message_id: int):
+        pass
+
+    @abstractmethod
+    async def get_bot_messages(self, user_id: int, chat_id: int) -> List[dict]:
+        """Сообщения чата от старых к новым: message_id, created_at"""
+
+    @abstractmethod
+    async def remove_bot_messages(self, message_ids: list, chat_id: Optional[int] = None):
+        pass
+
+    @abstractmethod
+    async def clear_old_bot_messages(self, days: int = 7):
+        pass
+
+    # Состояния FSM
+    @abstractmethod
+    async def load_fsm_state(self, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Состояние и данные (JSON) ключа FSM или None"""
+
+    @abstractmethod
+    async def save_fsm_states(self, upserts: List[Tuple[str, Optional[str], str]], deletes: List[str]):
+        """Записать (ключ, состояние, JSON данных) и удалить пустые ключи одной транзакцией"""
+
+    # Обслуживание
+    @abstractmethod
+    async def run_maintenance(self, batch_size: Optional[int] = None) -> Dict[str, object]:
+        """Очистка по срокам хранения и архивирование; вернуть отчет"""
@@ -0,0 +1,81 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Растет при каждой инвалидации: значение, прочитанное до нее, не кэшируется
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        """Найти запись: (найдена ли, значение)"""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None):
+        if version is not None and version != self.version:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self.version += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+
+class MarathonSnapshot:
+    """Снимок активного марафона в памяти процесса.
+
+    Заполняется при первом чтении, сбрасывается при создании марафона,
+    а current_amount обновляется после каждой записи отметки дня.
+    """
+
+    def __init__(self):
+        self._marathon: Optional[dict] = None
+        self._loaded = False
+        self.version = 0
+
+    def get(self) -> Tuple[bool, Optional[dict]]:
+        """Получить снимок: (загружен ли, копия марафона или None)"""
+        if not self._loaded:
+            return False, None
+        return True, dict(self._marathon) if self._marathon else None
+
+    def set(self, marathon: Optional[dict], version: Optional[int] = None):
+        if version is not None and version != self.version:
+            return
+        self._marathon = dict(marathon) if marathon else None
+        self._loaded = True
+
+    def update_amount(self, marathon_id: int, current_amount: int):
+        if self._marathon and self._marathon['id'] == marathon_id:
+            self._marathon['current_amount'] = current_amount
+
+    def invalidate(self):
+        self.version += 1
+        self._marathon = None
+        self._loaded = False
@@ -0,0 +1,68 @@
+"""
+Лимиты дуа на неделю Джума в памяти.
+
+Счетчики текущей недели (по пользователям и общий) загружаются из базы
+при первом обращении и при смене недели. Место резервируется синхронно,
+поэтому два одновременных запроса не могут занять одно и то же место:
+проверка и увеличение счетчика происходят без переключения корутин.
+Если запись в базу не удалась, место освобождается.
+"""
+from typing import Dict, Iterable, Optional, Tuple
+
+# Причины отказа
+LIMIT_USER = "user"
+LIMIT_TOTAL = "total"
+
+
+class DuaQuota:
+    """Счетчики дуа одной недели Джума"""
+
+    def __init__(self, per_user: int, total: int):
+        self.per_user = per_user
+        self.total = total
+        # Неделя, для которой загружены счетчики; None - нужно загрузить
+        self.week: Optional[int] = None
+        self._users: Dict[int, int] = {}
+        self._total = 0
+
+    def load(self, week: int, rows: Iterable[Tuple[int, int]]):
+        """Заменить счетчики строками (user_id, количество дуа за неделю)"""
+        self._users = {user_id: count for user_id, count in rows}
+        self._total = sum(self._users.values())
+        self.week = week
+
+    def invalidate(self):
+        self.week = None
+
+    def user_count(self, user_id: int) -> int:
+        return self._users.get(user_id, 0)
+
+    def total_count(self) -> int:
+        return self._total
+
+    def check(self, user_id: int) -> Optional[str]:
+        """Причина отказа или None, если пользователь еще может отправить дуа"""
+        if self._users.get(user_id, 0) >= self.per_user:
+            return LIMIT_USER
+        if self._total >= self.total:
+            return LIMIT_TOTAL
+        return None
+
+    def reserve(self, user_id: int) -> Optional[str]:
+        """Занять место под дуа; вернуть причину отказа, если мест нет"""
+        reason = self.check(user_id)
+        if reason is None:
+            self._users[user_id] = self._users.get(user_id, 0) + 1
+            self._total += 1
+        return reason
+
+    def release(self, user_id: int):
+        """Вернуть место, занятое reserve"""
+        count = self._users.get(user_id, 0)
+        if count <= 0:
+            return
+        if count == 1:
+            del self._users[user_id]
+        else:
+            self._users[user_id] = count - 1
+        self._total -= 1
@@ -0,0 +1,152 @@
+"""
+Хранилище состояний FSM aiogram в базе бота.
+
+Состояние и данные каждого ключа хранятся одной строкой fsm_states
+(данные - компактный JSON). Чтения обслуживаются кэшем в памяти процесса,
+изменения помечаются и записываются в базу пачками (write-back) по таймеру
+и при закрытии. Записи кэша, к которым давно не обращались, вытесняются
+из памяти, а брошенные состояния удаляются из таблицы при обслуживании базы.
+
+Если базу используют несколько экземпляров бота, кэш и отложенная запись
+отключаются (cache_ttl=0, flush_interval=0): каждое чтение идет в базу,
+каждое изменение сразу записывается.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from bot.database.base import Repository
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'accessed_at')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.accessed_at = time.monotonic()
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM-хранилище в базе бота с кэшем отложенной записи"""
+
+    def __init__(
+        self,
+        db: Repository,
+        key_builder: Optional[KeyBuilder] = None,
+        flush_interval: float = 1.0,
+        cache_ttl: float = 600
+    ):
+        self.db = db
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self._records: Dict[str, _Record] = {}
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._flush_task is None and self.flush_interval > 0:
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Остановить таймер и записать накопленные изменения"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        await self._changed(key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            msg = f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            raise DataNotDictLikeError(msg)
+        record = await self._record(key)
+        record.data = data.copy()
+        await self._changed(key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(key)).data.copy()
+
+    async def flush(self):
+        """Записать измененные состояния одной транзакцией"""
+        if not self._dirty:
+            return
+        keys = list(self._dirty)
+        self._dirty = set()
+        upserts = []
+        deletes = []
+        for storage_key in keys:
+            record = self._records.get(storage_key)
+            if record is None or (record.state is None and not record.data):
+                deletes.append(storage_key)
+            else:
+                upserts.append((
+                    storage_key,
+                    record.state,
+                    json.dumps(record.data, ensure_ascii=False, separators=(',', ':'))
+                ))
+
+        try:
+            await self.db.save_fsm_states(upserts, deletes)
+        except Exception:
+            # Повторим запись при следующем сбросе
+            self._dirty.update(keys)
+            raise
+        if self.cache_ttl <= 0:
+            for storage_key in keys:
+                if storage_key not in self._dirty:
+                    self._records.pop(storage_key, None)
+
+    async def _record(self, key: StorageKey) -> _Record:
+        storage_key = self.key_builder.build(key)
+        record = self._records.get(storage_key)
+        if record is None:
+            row = await self.db.load_fsm_state(storage_key)
+            record = _Record(row[0], json.loads(row[1]) if row[1] else None) if row else _Record()
+            if self.cache_ttl > 0:
+                # Пока шел запрос, запись могла появиться в кэше - она новее
+                record = self._records.setdefault(storage_key, record)
+        record.accessed_at = time.monotonic()
+        return record
+
+    async def _changed(self, key: StorageKey, record: _Record):
+        storage_key = self.key_builder.build(key)
+        self._records[storage_key] = record
+        self._dirty.add(storage_key)
+        if self.flush_interval <= 0:
+            await self.flush()
+
+    def _evict_idle(self):
+        """Убрать из памяти давно не использованные и уже записанные состояния"""
+        expired_before = time.monotonic() - self.cache_ttl
+        for storage_key in [
+            storage_key for storage_key, record in self._records.items()
+            if record.accessed_at < expired_before and storage_key not in self._dirty
+        ]:
+            del self._records[storage_key]
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush FSM states: {e}")
+            self._evict_idle()
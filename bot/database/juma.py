@@ -0,0 +1,64 @@
+"""
+Недели Джума.
+
+Неделя длится с субботы по пятницу включительно по времени JUMA_TIMEZONE
+и обозначается порядковым номером своей пятницы (date.toordinal()).
+Ключи соседних недель отличаются на 7 и, в отличие от строк "%Y-%W",
+не зависят от границ года. Текущий ключ вычисляется один раз и хранится
+до конца недели.
+"""
+import time
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+import pytz
+
+from bot.config import JUMA_TIMEZONE
+
+FRIDAY = 4
+
+
+def juma_friday_for(day: date) -> date:
+    """Пятница недели Джума, в которую попадает день day"""
+    return day + timedelta((FRIDAY - day.weekday()) % 7)
+
+
+def juma_friday(key: int) -> date:
+    return date.fromordinal(key)
+
+
+def juma_week_key(at: Optional[datetime] = None, timezone: str = JUMA_TIMEZONE) -> int:
+    """Ключ недели Джума для момента at (по умолчанию - сейчас)"""
+    zone = pytz.timezone(timezone)
+    local = datetime.now(zone) if at is None else at.astimezone(zone)
+    return juma_friday_for(local.date()).toordinal()
+
+
+def legacy_week_key(value: str) -> int:
+    """Ключ недели из прежнего формата: строка "%Y-%W" ее пятницы"""
+    return datetime.strptime(f"{value}-5", "%Y-%W-%w").date().toordinal()
+
+
+class JumaCalendar:
+    """Текущая неделя Джума, пересчитывается только после ее окончания"""
+
+    def __init__(self, timezone: str = JUMA_TIMEZONE):
+        self.timezone = pytz.timezone(timezone)
+        self._key = 0
+        self._ends_at = 0.0
+
+    def current(self) -> int:
+        if time.time() >= self._ends_at:
+            friday = juma_friday_for(datetime.now(self.timezone).date())
+            saturday = datetime.combine(friday + timedelta(days=1), datetime.min.time())
+            self._key = friday.toordinal()
+            self._ends_at = self.timezone.localize(saturday).timestamp()
+        return self._key
+
+
+_calendar = JumaCalendar()
+
+
+def current_juma_week() -> int:
+    """Ключ текущей недели Джума"""
+    return _calendar.current()
@@ -0,0 +1,190 @@
+"""
+Рейтинг марафона в памяти.
+
+Суммы участников хранятся в отсортированном контейнере из корзин
+ограниченного размера с деревом Фенвика по размерам корзин, поэтому место
+в рейтинге, топ-N и соседи по рейтингу находятся за логарифмическое время.
+"""
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class _SortedKeys:
+    """Отсортированный список ключей с позиционным доступом"""
+
+    LOAD = 256
+
+    def __init__(self):
+        self._buckets: List[list] = []
+        self._maxes: list = []
+        self._tree: Optional[List[int]] = None
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def clear(self):
+        self._buckets = []
+        self._maxes = []
+        self._tree = None
+        self._len = 0
+
+    def add(self, key):
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._tree = None
+            self._len = 1
+            return
+
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            i -= 1
+        bucket = self._buckets[i]
+        insort(bucket, key)
+        self._maxes[i] = bucket[-1]
+        self._len += 1
+
+        if len(bucket) > 2 * self.LOAD:
+            self._buckets[i:i + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self._maxes[i:i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+            self._tree = None
+        else:
+            self._tree_update(i, 1)
+
+    def remove(self, key):
+        i = bisect_left(self._maxes, key)
+        bucket = self._buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self._len -= 1
+
+        if bucket:
+            self._maxes[i] = bucket[-1]
+            self._tree_update(i, -1)
+        else:
+            del self._buckets[i]
+            del self._maxes[i]
+            self._tree = None
+
+    def index(self, key) -> int:
+        """Количество ключей строго меньше key"""
+        i = bisect_left(self._maxes, key)
+        if i == len(self._maxes):
+            return self._len
+        return self._prefix(i) + bisect_left(self._buckets[i], key)
+
+    def slice(self, start: int, stop: int) -> list:
+        """Ключи с позициями [start, stop)"""
+        start = max(0, start)
+        stop = min(self._len, stop)
+        if start >= stop:
+            return []
+        i, offset = self._locate(start)
+        result = []
+        remaining = stop - start
+        while remaining > 0:
+            chunk = self._buckets[i][offset:offset + remaining]
+            result.extend(chunk)
+            remaining -= len(chunk)
+            i += 1
+            offset = 0
+        return result
+
+    # Дерево Фенвика по размерам корзин
+
+    def _build_tree(self):
+        tree = [len(bucket) for bucket in self._buckets]
+        for i in range(len(tree)):
+            parent = i | (i + 1)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _tree_update(self, i: int, delta: int):
+        if self._tree is None:
+            return
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i |= i + 1
+
+    def _prefix(self, i: int) -> int:
+        """Количество ключей в первых i корзинах"""
+        if self._tree is None:
+            self._build_tree()
+        total = 0
+        tree = self._tree
+        while i > 0:
+            total += tree[i - 1]
+            i &= i - 1
+        return total
+
+    def _locate(self, position: int) -> Tuple[int, int]:
+        """Найти корзину и смещение для позиции"""
+        if self._tree is None:
+            self._build_tree()
+        tree = self._tree
+        i = 0
+        step = 1 << (len(tree).bit_length())
+        while step:
+            candidate = i + step
+            if candidate <= len(tree) and tree[candidate - 1] <= position:
+                i = candidate
+                position -= tree[candidate - 1]
+            step >>= 1
+        return i, position
+
+
+class Leaderboard:
+    """Рейтинг участников одного марафона по сумме пожертвований"""
+
+    def __init__(self, marathon_id: int):
+        self.marathon_id = marathon_id
+        self._totals: Dict[int, int] = {}
+        # Ключ (-сумма, user_id): по возрастанию ключа - по убыванию суммы
+        self._keys = _SortedKeys()
+
+    def __len__(self) -> int:
+        return len(self._totals)
+
+    def load(self, rows: Iterable[Tuple[int, int]]):
+        """Заполнить рейтинг парами (user_id, сумма)"""
+        self._totals = {}
+        self._keys.clear()
+        for user_id, total in rows:
+            self.update(user_id, total)
+
+    def update(self, user_id: int, total: int):
+        """Установить новую сумму участника"""
+        previous = self._totals.get(user_id)
+        if previous == total:
+            return
+        if previous is not None:
+            self._keys.remove((-previous, user_id))
+        self._totals[user_id] = total
+        self._keys.add((-total, user_id))
+
+    def get_total(self, user_id: int) -> int:
+        return self._totals.get(user_id, 0)
+
+    def rank(self, user_id: int) -> Tuple[int, int]:
+        """Место участника (1 + количество участников с большей суммой) и его сумма"""
+        total = self.get_total(user_id)
+        return self._keys.index((-total,)) + 1, total
+
+    def top(self, limit: int) -> List[Tuple[int, int, int]]:
+        """Первые limit участников: (место, user_id, сумма)"""
+        return self._with_ranks(self._keys.slice(0, limit))
+
+    def around(self, user_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        """Участники рядом с пользователем в рейтинге: (место, user_id, сумма)"""
+        if user_id not in self._totals:
+            return []
+        position = self._keys.index((-self._totals[user_id], user_id))
+        return self._with_ranks(self._keys.slice(position - radius, position + radius + 1))
+
+    def snapshot(self) -> Dict[int, int]:
+        return dict(self._totals)
+
+    def _with_ranks(self, keys: list) -> List[Tuple[int, int, int]]:
+        return [(self._keys.index((negative_total,)) + 1, user_id, -negative_total) for negative_total, user_id in keys]
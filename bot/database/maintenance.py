@@ -0,0 +1,216 @@
+"""
+Обслуживание базы данных.
+
+Запускается планировщиком раз в сутки:
+- удаляет устаревшие записи по срокам хранения таблиц (дуа - только если
+  задан DUAS_RETENTION_DAYS);
+- переносит отметки завершенных марафонов в daily_completions_archive;
+- выполняет PRAGMA optimize и инкрементальную очистку свободных страниц
+  (не больше MAINTENANCE_VACUUM_PAGES страниц за запуск).
+
+Режим auto_vacuum = INCREMENTAL включается один раз отдельной командой
+при остановленном боте, так как для этого нужен полный VACUUM:
+
+    python tools/enable_incremental_vacuum.py
+
+Пока режим не включен, бот при запуске предупреждает об этом в логе.
+
+Удаление идет небольшими пачками, каждая - отдельной операцией писателя,
+поэтому обычные записи не ждут, пока обслуживание держит блокировку.
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Tuple
+
+import aiosqlite
+
+from bot.config import (
+    ARCHIVE_MARATHONS_AFTER_DAYS,
+    BOT_MESSAGES_RETENTION_DAYS,
+    BROADCAST_JOBS_RETENTION_DAYS,
+    DUAS_RETENTION_DAYS,
+    FSM_STATES_RETENTION_DAYS,
+    MAINTENANCE_BATCH_SIZE,
+    MAINTENANCE_VACUUM_PAGES
+)
+
+logger = logging.getLogger(__name__)
+
+# Сроки хранения: таблица, условие устаревания записи (параметр - срок в днях), срок.
+# Порядок важен: получатели рассылок удаляются раньше своих заданий
+RETENTION_POLICIES: List[Tuple[str, str, int]] = [
+    ("bot_messages",
+     "created_at < datetime('now', '-' || ? || ' days')",
+     BOT_MESSAGES_RETENTION_DAYS),
+    ("duas",
+     "created_at < datetime('now', '-' || ? || ' days')",
+     DUAS_RETENTION_DAYS),
+    ("broadcast_recipients",
+     """job_id IN (
+            SELECT id FROM broadcast_jobs
+            WHERE status = 'done' AND finished_at < datetime('now', '-' || ? || ' days')
+        )""",
+     BROADCAST_JOBS_RETENTION_DAYS),
+    ("broadcast_jobs",
+     """status = 'done' AND finished_at < datetime('now', '-' || ? || ' days')
+        AND NOT EXISTS (SELECT 1 FROM broadcast_recipients WHERE job_id = broadcast_jobs.id)""",
+     BROADCAST_JOBS_RETENTION_DAYS),
+    # Состояния FSM, которые давно не менялись (брошенные диалоги)
+    ("fsm_states",
+     "updated_at < datetime('now', '-' || ? || ' days')",
+     FSM_STATES_RETENTION_DAYS),
+]
+
+
+async def run_maintenance(db, batch_size: int = MAINTENANCE_BATCH_SIZE) -> Dict[str, object]:
+    """Выполнить все задачи обслуживания и вернуть отчет"""
+    started = time.monotonic()
+    size_before = await _database_size(db)
+
+    report: Dict[str, object] = {'deleted': {}}
+    for table, condition, days in RETENTION_POLICIES:
+        if days <= 0:
+            # Срок не задан - записи таблицы не удаляются
+            continue
+        report['deleted'][table] = await delete_in_batches(db, table, condition, (days,), batch_size)
+    report['archived'] = await archive_closed_marathons(db, ARCHIVE_MARATHONS_AFTER_DAYS, batch_size)
+    await optimize(db)
+
+    size_after = await _database_size(db)
+    report['bytes_reclaimed'] = size_before - size_after
+    report['seconds'] = round(time.monotonic() - started, 2)
+    logger.info(
+        f"Database maintenance finished in {report['seconds']}s, "
+        f"reclaimed {report['bytes_reclaimed']} bytes: {report}"
+    )
+    return report
+
+
+async def delete_in_batches(db, table: str, condition: str, parameters: tuple, batch_size: int) -> int:
+    """Удалить записи по условию пачками по batch_size строк"""
+    deleted = 0
+    while True:
+        count = await db.writer.execute(
+            f"""DELETE FROM {table} WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE {condition} LIMIT ?
+                )""",
+            (*parameters, batch_size)
+        )
+        deleted += count
+        if count < batch_size:
+            break
+        # Даем выполниться записям, накопившимся за время пачки
+        await asyncio.sleep(0)
+    if deleted:
+        logger.info(f"Retention: deleted {deleted} rows from {table}")
+    return deleted
+
+
+async def archive_closed_marathons(db, after_days: int, batch_size: int) -> Dict[int, int]:
+    """Перенести отметки завершенных марафонов в архив.
+
+    Марафон сначала помечается archived_at: триггеры daily_completions не
+    меняют суммы архивных марафонов, поэтому current_amount и
+    marathon_user_totals сохраняются. Перенос, прерванный перезапуском,
+    продолжается при следующем запуске.
+    """
+    await db.writer.execute(
+        """UPDATE marathons SET archived_at = CURRENT_TIMESTAMP
+           WHERE archived_at IS NULL AND is_active = 0
+           AND end_date < date('now', '-' || ? || ' days')""",
+        (after_days,)
+    )
+    async with db.pool.acquire() as connection:
+        async with connection.execute(
+            "SELECT id FROM marathons WHERE archived_at IS NOT NULL"
+        ) as cursor:
+            marathon_ids = [row[0] for row in await cursor.fetchall()]
+
+    archived = {}
+    for marathon_id in marathon_ids:
+        moved = 0
+        while True:
+            count = await db.writer.submit(_archive_batch_operation(marathon_id, batch_size))
+            moved += count
+            if count < batch_size:
+                break
+            await asyncio.sleep(0)
+        if moved:
+            logger.info(f"Archived {moved} daily completions of marathon {marathon_id}")
+            archived[marathon_id] = moved
+    return archived
+
+
+def _archive_batch_operation(marathon_id: int, batch_size: int):
+    async def operation(connection: aiosqlite.Connection) -> int:
+        async with connection.execute(
+            "SELECT id FROM daily_completions WHERE marathon_id = ? LIMIT ?",
+            (marathon_id, batch_size)
+        ) as cursor:
+            ids = [row[0] for row in await cursor.fetchall()]
+        if not ids:
+            return 0
+        placeholders = ','.join('?' * len(ids))
+        await connection.execute(
+            f"""INSERT OR REPLACE INTO daily_completions_archive
+                (id, user_id, marathon_id, completion_date, is_completed, amount, created_at)
+                SELECT id, user_id, marathon_id, completion_date, is_completed, amount, created_at
+                FROM daily_completions WHERE id IN ({placeholders})""",
+            ids
+        )
+        await connection.execute(
+            f"DELETE FROM daily_completions WHERE id IN ({placeholders})",
+            ids
+        )
+        return len(ids)
+
+    return operation
+
+
+async def incremental_vacuum_enabled(connection: aiosqlite.Connection) -> bool:
+    """Включен ли режим auto_vacuum = INCREMENTAL"""
+    async with connection.execute("PRAGMA auto_vacuum") as cursor:
+        return (await cursor.fetchone())[0] == 2
+
+
+async def enable_incremental_vacuum(connection: aiosqlite.Connection) -> bool:
+    """Включить auto_vacuum = INCREMENTAL, если он еще не включен.
+
+    Режим вступает в силу только после полного VACUUM, который перестраивает
+    весь файл базы, поэтому вызывается только из tools/enable_incremental_vacuum.py.
+    Вернуть True, если база была перестроена.
+    """
+    if await incremental_vacuum_enabled(connection):
+        return False
+    logger.info("Switching database to incremental auto_vacuum, running full VACUUM")
+    await connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    await connection.execute("VACUUM")
+    return True
+
+
+async def optimize(db, vacuum_pages: int = MAINTENANCE_VACUUM_PAGES):
+    """PRAGMA optimize, возврат не больше vacuum_pages свободных страниц и усечение WAL"""
+    async def operation(connection: aiosqlite.Connection):
+        if await incremental_vacuum_enabled(connection):
+            async with connection.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})") as cursor:
+                await cursor.fetchall()
+        else:
+            logger.warning("Incremental auto_vacuum is not enabled, free pages are not reclaimed")
+        async with connection.execute("PRAGMA optimize") as cursor:
+            await cursor.fetchall()
+        async with connection.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cursor:
+            await cursor.fetchall()
+
+    # Контрольная точка не выполняется внутри транзакции
+    await db.writer.submit(operation, transaction=False)
+
+
+async def _database_size(db) -> int:
+    """Размер файла базы в байтах"""
+    async with db.pool.acquire() as connection:
+        async with connection.execute(
+            """SELECT page_count * page_size
+               FROM pragma_page_count(), pragma_page_size()"""
+        ) as cursor:
+            return (await cursor.fetchone())[0]
@@ -0,0 +1,131 @@
+"""
+Учет сообщений бота в памяти.
+
+Для каждого чата хранится кольцевой буфер последних сообщений бота, поэтому
+track_bot_message и get_bot_messages не обращаются к базе. Изменения
+копятся и записываются в bot_messages пачками по таймеру и при остановке,
+а при запуске буферы заполняются из базы. Если процесс упадет, могут
+потеряться изменения за последний интервал записи: такие сообщения просто
+не будут удалены из чата.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (user_id, chat_id)
+ChatKey = Tuple[int, int]
+# (chat_id, message_id)
+MessageKey = Tuple[int, int]
+
+# Сообщения старше 48 часов Telegram удалить не даст, их нет смысла загружать
+RELOAD_WINDOW = timedelta(hours=48)
+
+# (добавленные строки (user_id, chat_id, message_id, created_at), удаленные (chat_id, message_id))
+SaveMessages = Callable[[List[tuple], List[MessageKey]], Awaitable[None]]
+
+
+class MessageTracker:
+    """Кольцевые буферы сообщений бота по чатам с отложенной записью в базу"""
+
+    def __init__(self, save: SaveMessages, buffer_size: int = 50, flush_interval: float = 5.0):
+        self.save = save
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._buffers: Dict[ChatKey, Deque[dict]] = {}
+        # Еще не записанные в базу добавления и удаления
+        self._pending_inserts: Dict[MessageKey, tuple] = {}
+        self._pending_deletes: Set[MessageKey] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    def load(self, rows: Iterable[tuple]):
+        """Заполнить буферы строками (user_id, chat_id, message_id, created_at) от старых к новым"""
+        self._buffers.clear()
+        for user_id, chat_id, message_id, created_at in rows:
+            self._buffer(user_id, chat_id).append({'message_id': message_id, 'created_at': created_at})
+        logger.info(f"Message tracker loaded {len(self)} messages in {len(self._buffers)} chats")
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить таймер и записать накопленные изменения"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+            self._flush_task = None
+        await self.flush()
+
+    def add(self, user_id: int, chat_id: int, message_id: int):
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        buffer = self._buffer(user_id, chat_id)
+        if len(buffer) == buffer.maxlen:
+            # Самое старое сообщение вытесняется из буфера и забывается
+            self._forget(chat_id, buffer[0]['message_id'])
+        buffer.append({'message_id': message_id, 'created_at': created_at})
+        self._pending_inserts[(chat_id, message_id)] = (user_id, chat_id, message_id, created_at)
+
+    def get(self, user_id: int, chat_id: int) -> List[dict]:
+        """Сообщения чата от старых к новым"""
+        return [dict(message) for message in self._buffers.get((user_id, chat_id), ())]
+
+    def remove(self, message_ids: list, chat_id: Optional[int] = None):
+        ids = set(message_ids)
+        for (buffer_user_id, buffer_chat_id), buffer in list(self._buffers.items()):
+            if chat_id is not None and buffer_chat_id != chat_id:
+                continue
+            kept = [message for message in buffer if message['message_id'] not in ids]
+            if len(kept) != len(buffer):
+                for message in buffer:
+                    if message['message_id'] in ids:
+                        self._forget(buffer_chat_id, message['message_id'])
+                if kept:
+                    self._buffers[(buffer_user_id, buffer_chat_id)] = deque(kept, maxlen=self.buffer_size)
+                else:
+                    del self._buffers[(buffer_user_id, buffer_chat_id)]
+
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._pending_inserts and not self._pending_deletes:
+            return
+        inserts = list(self._pending_inserts.values())
+        deletes = list(self._pending_deletes)
+        self._pending_inserts = {}
+        self._pending_deletes = set()
+
+        try:
+            await self.save(inserts, deletes)
+        except Exception:
+            # Вернем изменения в очередь, чтобы записать их в следующий раз
+            for row in inserts:
+                self._pending_inserts.setdefault((row[1], row[2]), row)
+            self._pending_deletes.update(deletes)
+            raise
+
+    def _buffer(self, user_id: int, chat_id: int) -> Deque[dict]:
+        key = (user_id, chat_id)
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = deque(maxlen=self.buffer_size)
+        return buffer
+
+    def _forget(self, chat_id: int, message_id: int):
+        key = (chat_id, message_id)
+        # Еще не записанное сообщение достаточно не записывать
+        if self._pending_inserts.pop(key, None) is None:
+            self._pending_deletes.add(key)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush tracked bot messages: {e}")
@@ -0,0 +1,440 @@
+"""
+Версионированные миграции схемы базы данных.
+
+Каждая миграция - это номер версии, описание и список шагов. Шаг - либо
+SQL-запрос, либо асинхронная функция, принимающая соединение. Примененные
+версии записываются в таблицу schema_migrations, при запуске бота
+применяются только недостающие миграции, каждая в своей транзакции.
+"""
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Tuple, Union
+
+import aiosqlite
+
+from bot.database.juma import current_juma_week, juma_friday, juma_week_key, legacy_week_key
+from bot.database.reminders import default_reminder_slots, utc_offset_minutes
+
+logger = logging.getLogger(__name__)
+
+MigrationStep = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+Migration = Tuple[int, str, List[MigrationStep]]
+
+
+async def _backfill_reminder_slots(db: aiosqlite.Connection):
+    """Назначить существующим пользователям напоминания в окнах по умолчанию"""
+    async with db.execute("SELECT user_id, timezone FROM users") as cursor:
+        users = await cursor.fetchall()
+    await db.executemany(
+        """INSERT OR IGNORE INTO reminder_slots (user_id, kind, local_minute, utc_minute)
+           VALUES (?, ?, ?, ?)""",
+        [slot[:4] for user_id, timezone in users for slot in default_reminder_slots(user_id, timezone)]
+    )
+
+
+async def _backfill_reminder_offsets(db: aiosqlite.Connection):
+    """Сохранить в слотах текущее смещение часового пояса пользователя"""
+    async with db.execute("SELECT DISTINCT timezone FROM users") as cursor:
+        timezones = [row[0] for row in await cursor.fetchall()]
+    for timezone_name in timezones:
+        offset = utc_offset_minutes(timezone_name)
+        await db.execute(
+            """UPDATE reminder_slots
+               SET utc_offset = ?, utc_minute = (local_minute - ? + 1440) % 1440
+               WHERE user_id IN (SELECT user_id FROM users WHERE timezone IS ?)""",
+            (offset, offset, timezone_name)
+        )
+
+
+async def _convert_juma_weeks(db: aiosqlite.Connection):
+    """Перевести недели дуа из строк "%Y-%W" в ключи-порядковые номера пятниц"""
+    async with db.execute("SELECT id, juma_week, created_at FROM duas WHERE juma_key IS NULL") as cursor:
+        rows = await cursor.fetchall()
+    updates = []
+    for dua_id, juma_week, created_at in rows:
+        try:
+            key = legacy_week_key(juma_week)
+        except (TypeError, ValueError):
+            # Неизвестный формат: неделя по времени создания (CURRENT_TIMESTAMP - UTC)
+            try:
+                created = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+            except (TypeError, ValueError):
+                logger.warning(
+                    f"Dua {dua_id}: cannot parse juma_week {juma_week!r} or created_at {created_at!r}, "
+                    f"assigning current Juma week"
+                )
+                key = current_juma_week()
+            else:
+                key = juma_week_key(created)
+        updates.append((key, juma_friday(key).isoformat(), dua_id))
+    await db.executemany("UPDATE duas SET juma_key = ?, juma_week = ? WHERE id = ?", updates)
+
+
+MIGRATIONS: List[Migration] = [
+    (1, "Covering indexes for hot queries", [
+        # get_daily_global_stats: marathon_id + completion_date
+        """CREATE INDEX IF NOT EXISTS idx_daily_completions_marathon_date
+           ON daily_completions (marathon_id, completion_date, is_completed, user_id, amount)""",
+        # get_marathon_ranking: GROUP BY user_id внутри марафона
+        """CREATE INDEX IF NOT EXISTS idx_daily_completions_marathon_user
+           ON daily_completions (marathon_id, is_completed, user_id, amount)""",
+        # count_user_duas_this_juma / count_total_duas_this_juma
+        """CREATE INDEX IF NOT EXISTS idx_duas_juma_week_user
+           ON duas (juma_week, user_id)""",
+        # get_bot_messages: user_id + chat_id с сортировкой по created_at
+        """CREATE INDEX IF NOT EXISTS idx_bot_messages_user_chat
+           ON bot_messages (user_id, chat_id, created_at, message_id)""",
+        # remove_bot_messages: удаление по message_id
+        """CREATE INDEX IF NOT EXISTS idx_bot_messages_message_id
+           ON bot_messages (message_id)""",
+        # Марафоны пользователя
+        """CREATE INDEX IF NOT EXISTS idx_marathon_participants_user
+           ON marathon_participants (user_id, marathon_id)""",
+    ]),
+    (2, "Incremental marathon totals via triggers", [
+        # Вклад строки в сумму марафона: amount, если день выполнен
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_total_insert
+           AFTER INSERT ON daily_completions
+           WHEN NEW.is_completed = 1 AND NEW.amount != 0
+           BEGIN
+               UPDATE marathons
+               SET current_amount = COALESCE(current_amount, 0) + NEW.amount
+               WHERE id = NEW.marathon_id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_total_update
+           AFTER UPDATE OF marathon_id, is_completed, amount ON daily_completions
+           BEGIN
+               UPDATE marathons
+               SET current_amount = COALESCE(current_amount, 0)
+                   - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END
+               WHERE id = OLD.marathon_id;
+               UPDATE marathons
+               SET current_amount = COALESCE(current_amount, 0)
+                   + CASE WHEN NEW.is_completed = 1 THEN NEW.amount ELSE 0 END
+               WHERE id = NEW.marathon_id;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_total_delete
+           AFTER DELETE ON daily_completions
+           WHEN OLD.is_completed = 1 AND OLD.amount != 0
+           BEGIN
+               UPDATE marathons
+               SET current_amount = COALESCE(current_amount, 0) - OLD.amount
+               WHERE id = OLD.marathon_id;
+           END""",
+        # Синхронизируем уже накопленные суммы с триггерами
+        """UPDATE marathons
+           SET current_amount = (
+               SELECT COALESCE(SUM(amount), 0)
+               FROM daily_completions
+               WHERE marathon_id = marathons.id AND is_completed = 1
+           )""",
+    ]),
+    (3, "Materialized per-user marathon totals", [
+        """CREATE TABLE IF NOT EXISTS marathon_user_totals (
+               marathon_id INTEGER NOT NULL,
+               user_id INTEGER NOT NULL,
+               total_contribution INTEGER NOT NULL DEFAULT 0,
+               completed_days INTEGER NOT NULL DEFAULT 0,
+               total_days INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (marathon_id, user_id)
+           )""",
+        # Место в рейтинге - диапазонный COUNT по этому индексу
+        """CREATE INDEX IF NOT EXISTS idx_marathon_user_totals_rank
+           ON marathon_user_totals (marathon_id, total_contribution)""",
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_user_insert
+           AFTER INSERT ON daily_completions
+           BEGIN
+               INSERT INTO marathon_user_totals
+                   (marathon_id, user_id, total_contribution, completed_days, total_days)
+               VALUES (
+                   NEW.marathon_id, NEW.user_id,
+                   CASE WHEN NEW.is_completed = 1 THEN NEW.amount ELSE 0 END,
+                   CASE WHEN NEW.is_completed = 1 THEN 1 ELSE 0 END,
+                   1
+               )
+               ON CONFLICT (marathon_id, user_id) DO UPDATE SET
+                   total_contribution = total_contribution + excluded.total_contribution,
+                   completed_days = completed_days + excluded.completed_days,
+                   total_days = total_days + excluded.total_days;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_user_update
+           AFTER UPDATE OF user_id, marathon_id, is_completed, amount ON daily_completions
+           BEGIN
+               UPDATE marathon_user_totals SET
+                   total_contribution = total_contribution
+                       - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END,
+                   completed_days = completed_days
+                       - CASE WHEN OLD.is_completed = 1 THEN 1 ELSE 0 END,
+                   total_days = total_days - 1
+               WHERE marathon_id = OLD.marathon_id AND user_id = OLD.user_id;
+               INSERT INTO marathon_user_totals
+                   (marathon_id, user_id, total_contribution, completed_days, total_days)
+               VALUES (
+                   NEW.marathon_id, NEW.user_id,
+                   CASE WHEN NEW.is_completed = 1 THEN NEW.amount ELSE 0 END,
+                   CASE WHEN NEW.is_completed = 1 THEN 1 ELSE 0 END,
+                   1
+               )
+               ON CONFLICT (marathon_id, user_id) DO UPDATE SET
+                   total_contribution = total_contribution + excluded.total_contribution,
+                   completed_days = completed_days + excluded.completed_days,
+                   total_days = total_days + excluded.total_days;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_daily_completions_user_delete
+           AFTER DELETE ON daily_completions
+           BEGIN
+               UPDATE marathon_user_totals SET
+                   total_contribution = total_contribution
+                       - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END,
+                   completed_days = completed_days
+                       - CASE WHEN OLD.is_completed = 1 THEN 1 ELSE 0 END,
+                   total_days = total_days - 1
+               WHERE marathon_id = OLD.marathon_id AND user_id = OLD.user_id;
+           END""",
+        """INSERT OR REPLACE INTO marathon_user_totals
+               (marathon_id, user_id, total_contribution, completed_days, total_days)
+           SELECT
+               marathon_id, user_id,
+               COALESCE(SUM(CASE WHEN is_completed = 1 THEN amount ELSE 0 END), 0),
+               COUNT(CASE WHEN is_completed = 1 THEN 1 END),
+               COUNT(*)
+           FROM daily_completions
+           GROUP BY marathon_id, user_id""",
+    ]),
+    (4, "Durable broadcast outbox", [
+        # job_key - ключ идемпотентности, например evening_reminder:2024-03-15
+        """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               job_key TEXT NOT NULL UNIQUE,
+               kind TEXT NOT NULL,
+               payload TEXT,
+               status TEXT NOT NULL DEFAULT 'pending',
+               total INTEGER NOT NULL DEFAULT 0,
+               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+               finished_at TIMESTAMP
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status
+           ON broadcast_jobs (status, id)""",
+        # status: pending -> claimed -> sent / failed
+        """CREATE TABLE IF NOT EXISTS broadcast_recipients (
+               job_id INTEGER NOT NULL,
+               user_id INTEGER NOT NULL,
+               language TEXT,
+               status TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               updated_at TIMESTAMP,
+               PRIMARY KEY (job_id, user_id)
+           )""",
+        # Захват очередной порции: job_id + status по возрастанию user_id
+        """CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+           ON broadcast_recipients (job_id, status, user_id)""",
+    ]),
+    (5, "Per-user reminder schedule", [
+        # NULL - часовой пояс по умолчанию (DEFAULT_TIMEZONE)
+        "ALTER TABLE users ADD COLUMN timezone TEXT",
+        # local_minute - минута суток по местному времени, utc_minute - она же в UTC
+        """CREATE TABLE IF NOT EXISTS reminder_slots (
+               user_id INTEGER NOT NULL,
+               kind TEXT NOT NULL,
+               local_minute INTEGER NOT NULL,
+               utc_minute INTEGER NOT NULL,
+               PRIMARY KEY (user_id, kind)
+           )""",
+        # Диспетчер выбирает пользователей, чье время наступило
+        """CREATE INDEX IF NOT EXISTS idx_reminder_slots_due
+           ON reminder_slots (utc_minute, kind, user_id)""",
+        _backfill_reminder_slots,
+    ]),
+    (6, "Delivery failure tracking for users", [
+        # Пользователь заблокировал бота (TelegramForbiddenError)
+        "ALTER TABLE users ADD COLUMN is_blocked INTEGER NOT NULL DEFAULT 0",
+        # Аккаунт удален или чат не найден
+        "ALTER TABLE users ADD COLUMN is_deactivated INTEGER NOT NULL DEFAULT 0",
+        # Подряд идущие временные ошибки доставки и время следующей попытки (UTC)
+        "ALTER TABLE users ADD COLUMN failure_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN next_attempt_at TIMESTAMP",
+    ]),
+    (7, "Archive for closed marathons", [
+        # Отметки архивного марафона перенесены в daily_completions_archive
+        "ALTER TABLE marathons ADD COLUMN archived_at TIMESTAMP",
+        """CREATE TABLE IF NOT EXISTS daily_completions_archive (
+               id INTEGER PRIMARY KEY,
+               user_id INTEGER,
+               marathon_id INTEGER,
+               completion_date DATE NOT NULL,
+               is_completed INTEGER DEFAULT 0,
+               amount INTEGER DEFAULT 0,
+               created_at TIMESTAMP,
+               archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_daily_completions_archive_marathon_user
+           ON daily_completions_archive (marathon_id, user_id)""",
+        # Перенос в архив не должен менять суммы марафона и итоги участников
+        "DROP TRIGGER IF EXISTS trg_daily_completions_total_delete",
+        """CREATE TRIGGER trg_daily_completions_total_delete
+           AFTER DELETE ON daily_completions
+           WHEN OLD.is_completed = 1 AND OLD.amount != 0
+           AND NOT EXISTS (
+               SELECT 1 FROM marathons WHERE id = OLD.marathon_id AND archived_at IS NOT NULL
+           )
+           BEGIN
+               UPDATE marathons
+               SET current_amount = COALESCE(current_amount, 0) - OLD.amount
+               WHERE id = OLD.marathon_id;
+           END""",
+        "DROP TRIGGER IF EXISTS trg_daily_completions_user_delete",
+        """CREATE TRIGGER trg_daily_completions_user_delete
+           AFTER DELETE ON daily_completions
+           WHEN NOT EXISTS (
+               SELECT 1 FROM marathons WHERE id = OLD.marathon_id AND archived_at IS NOT NULL
+           )
+           BEGIN
+               UPDATE marathon_user_totals SET
+                   total_contribution = total_contribution
+                       - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END,
+                   completed_days = completed_days
+                       - CASE WHEN OLD.is_completed = 1 THEN 1 ELSE 0 END,
+                   total_days = total_days - 1
+               WHERE marathon_id = OLD.marathon_id AND user_id = OLD.user_id;
+           END""",
+        # Для очистки по сроку хранения
+        """CREATE INDEX IF NOT EXISTS idx_duas_created_at
+           ON duas (created_at)""",
+        """CREATE INDEX IF NOT EXISTS idx_bot_messages_created_at
+           ON bot_messages (created_at)""",
+    ]),
+    (8, "Persistent FSM storage", [
+        # key - ключ DefaultKeyBuilder, data - компактный JSON
+        """CREATE TABLE IF NOT EXISTS fsm_states (
+               key TEXT PRIMARY KEY,
+               state TEXT,
+               data TEXT,
+               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        # Удаление брошенных состояний по сроку хранения
+        """CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at
+           ON fsm_states (updated_at)""",
+    ]),
+    (9, "Leases for multi-process mode", [
+        # Аренда роли (например, запуска планировщика) одним процессом;
+        # expires_at - unix-время окончания аренды
+        """CREATE TABLE IF NOT EXISTS leases (
+               name TEXT PRIMARY KEY,
+               holder TEXT NOT NULL,
+               expires_at REAL NOT NULL
+           )""",
+    ]),
+    (10, "Integer Juma week keys for duas", [
+        # juma_key - порядковый номер пятницы недели; juma_week остается
+        # для чтения человеком и теперь хранит дату пятницы YYYY-MM-DD
+        "ALTER TABLE duas ADD COLUMN juma_key INTEGER",
+        _convert_juma_weeks,
+        """CREATE INDEX IF NOT EXISTS idx_duas_juma_key_user
+           ON duas (juma_key, user_id)""",
+        "DROP INDEX IF EXISTS idx_duas_juma_week_user",
+    ]),
+    (11, "Dua delivery tracking", [
+        # Время пересылки дуа администратору сводкой; NULL - еще не переслана
+        "ALTER TABLE duas ADD COLUMN delivered_at TIMESTAMP",
+        # Раньше дуа пересылались сразу при отправке
+        "UPDATE duas SET delivered_at = created_at",
+        """CREATE INDEX IF NOT EXISTS idx_duas_undelivered
+           ON duas (id) WHERE delivered_at IS NULL""",
+    ]),
+    (12, "Version counter of marathon totals", [
+        # Увеличивается при каждом изменении итогов участников и марафонов;
+        # по нему процессы узнают, что рейтинг изменили другие процессы
+        """CREATE TABLE IF NOT EXISTS marathon_totals_version (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               version INTEGER NOT NULL
+           )""",
+        "INSERT OR IGNORE INTO marathon_totals_version (id, version) VALUES (1, 0)",
+        """CREATE TRIGGER IF NOT EXISTS trg_marathon_user_totals_version_insert
+           AFTER INSERT ON marathon_user_totals
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_marathon_user_totals_version_update
+           AFTER UPDATE ON marathon_user_totals
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_marathon_user_totals_version_delete
+           AFTER DELETE ON marathon_user_totals
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+        # Новый или завершенный марафон меняет активный рейтинг
+        """CREATE TRIGGER IF NOT EXISTS trg_marathons_version_insert
+           AFTER INSERT ON marathons
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_marathons_version_update
+           AFTER UPDATE OF is_active, goal_amount, start_date, end_date ON marathons
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_marathons_version_delete
+           AFTER DELETE ON marathons
+           BEGIN
+               UPDATE marathon_totals_version SET version = version + 1 WHERE id = 1;
+           END""",
+    ]),
+    (13, "Local dates of reminder recipients", [
+        # Смещение пояса от UTC в минутах на момент расчета utc_minute:
+        # по нему определяется местная дата получателя в минуту напоминания
+        "ALTER TABLE reminder_slots ADD COLUMN utc_offset INTEGER NOT NULL DEFAULT 0",
+        _backfill_reminder_offsets,
+        # Последняя минута, обработанная диспетчером напоминаний (UTC)
+        """CREATE TABLE IF NOT EXISTS reminder_dispatch (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               last_minute TIMESTAMP NOT NULL
+           )""",
+    ]),
+]
+
+
+async def ensure_migrations_table(db: aiosqlite.Connection):
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    """Получить текущую версию схемы"""
+    async with db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations") as cursor:
+        result = await cursor.fetchone()
+        return result[0] if result else 0
+
+
+def make_migration_operation(version: int, description: str, steps: List[MigrationStep]):
+    """Создать операцию записи, применяющую одну миграцию"""
+    async def operation(db: aiosqlite.Connection):
+        for step in steps:
+            if isinstance(step, str):
+                await db.execute(step)
+            else:
+                await step(db)
+        await db.execute(
+            "INSERT INTO schema_migrations (version, description) VALUES (?, ?)",
+            (version, description)
+        )
+
+    return operation
+
+
+async def apply_migrations(writer, current_version: int) -> int:
+    """Применить недостающие миграции через писателя, вернуть итоговую версию"""
+    version = current_version
+    for migration_version, description, steps in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logger.info(f"Applying schema migration {migration_version}: {description}")
+        await writer.submit(make_migration_operation(migration_version, description, steps))
+        version = migration_version
+    return version
@@ -1,219 +1,566 @@
+import asyncio
+import json
+import logging
+import time
+
 import aiosqlite
+import pytz
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
+
+from bot.database.base import Repository
+from bot.database.cache import MarathonSnapshot, TTLCache
+from bot.database.dua_quota import LIMIT_TOTAL, DuaQuota
+from bot.database.juma import juma_friday
+from bot.database.leaderboard import Leaderboard
+from bot.database.maintenance import incremental_vacuum_enabled, run_maintenance
+from bot.database.message_tracker import RELOAD_WINDOW, MessageTracker
+from bot.database.migrations import apply_migrations, ensure_migrations_table, get_schema_version
+from bot.database.pool import ConnectionPool
+from bot.database.reminders import (
+    MINUTES_PER_DAY,
+    check_reminder_kind,
+    default_reminder_slots,
+    parse_minute,
+    spread_minute,
+    utc_offset_minutes
+)
+from bot.database.writer import WriteQueue
+
+logger = logging.getLogger(__name__)
+
+# Пользователь доступен для рассылок: не заблокировал бота, аккаунт не удален
+# и не истекла задержка после временных ошибок доставки
+_REACHABLE = """u.is_blocked = 0 AND u.is_deactivated = 0
+        AND (u.next_attempt_at IS NULL OR u.next_attempt_at <= CURRENT_TIMESTAMP)"""
+
+# Местная дата получателя в минуту :utc_minute дня :date (UTC): смещение пояса
+# переносит напоминание на предыдущие (:previous_date) или следующие сутки (:next_date)
+_LOCAL_DATE = """CASE (rs.utc_minute + rs.utc_offset - rs.local_minute) / 1440
+                WHEN -1 THEN :previous_date
+                WHEN 1 THEN :next_date
+                ELSE :date
+            END"""
+
+# Аудитории рассылок: запросы возвращают user_id и language получателей
+BROADCAST_AUDIENCES = {
+    'all': f"""
+        SELECT u.user_id, u.language
+        FROM users u
+        WHERE {_REACHABLE}""",
+    'participants': f"""
+        SELECT u.user_id, u.language
+        FROM marathon_participants mp
+        INNER JOIN users u ON u.user_id = mp.user_id
+        WHERE mp.marathon_id = :marathon_id AND {_REACHABLE}""",
+    # Участники, еще не отметившие день :date
+    'without_completion': f"""
+        SELECT u.user_id, u.language
+        FROM marathon_participants mp
+        INNER JOIN users u ON u.user_id = mp.user_id
+        WHERE mp.marathon_id = :marathon_id AND {_REACHABLE}
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_completions dc
+            WHERE dc.user_id = mp.user_id
+            AND dc.marathon_id = mp.marathon_id
+            AND dc.completion_date = :date
+        )""",
+    # Участники, чье напоминание :reminder_kind назначено на минуту :utc_minute;
+    # день для отметки - местная дата получателя в эту минуту (см. _LOCAL_DATE)
+    'due_participants': f"""
+        SELECT u.user_id, u.language
+        FROM reminder_slots rs
+        INNER JOIN marathon_participants mp
+            ON mp.marathon_id = :marathon_id AND mp.user_id = rs.user_id
+        INNER JOIN users u ON u.user_id = rs.user_id
+        WHERE rs.utc_minute = :utc_minute AND rs.kind = :reminder_kind
+        AND {_REACHABLE}""",
+    'due_without_completion': f"""
+        SELECT u.user_id, u.language
+        FROM reminder_slots rs
+        INNER JOIN marathon_participants mp
+            ON mp.marathon_id = :marathon_id AND mp.user_id = rs.user_id
+        INNER JOIN users u ON u.user_id = rs.user_id
+        WHERE rs.utc_minute = :utc_minute AND rs.kind = :reminder_kind
+        AND {_REACHABLE}
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_completions dc
+            WHERE dc.user_id = rs.user_id
+            AND dc.marathon_id = :marathon_id
+            AND dc.completion_date = {_LOCAL_DATE}
+        )""",
+}
+
+# Изменение состояния доставки пользователя по результату отправки
+_DELIVERY_STATE_UPDATES = {
+    'sent': """UPDATE users SET failure_count = 0, next_attempt_at = NULL
+               WHERE user_id = ? AND failure_count > 0""",
+    'blocked': "UPDATE users SET is_blocked = 1 WHERE user_id = ?",
+    'deactivated': "UPDATE users SET is_deactivated = 1 WHERE user_id = ?",
+    # Задержка 10 минут, удваивается с каждой неудачей, но не больше суток
+    'failed': """UPDATE users SET
+                     failure_count = failure_count + 1,
+                     next_attempt_at = datetime(
+                         'now', '+' || min(1440, 10 << min(failure_count, 8)) || ' minutes'
+                     )
+                 WHERE user_id = ?""",
+}
 
 
-class Database:
-    def __init__(self, db_path: str):
+class Database(Repository):
+    """Хранилище в SQLite: единственный писатель, пул читателей и кэши в памяти процесса"""
+
+    def __init__(
+        self,
+        db_path: str,
+        pool_size: int = 4,
+        pragmas: Optional[Dict[str, object]] = None,
+        write_batch_size: int = 64,
+        user_cache_size: int = 10000,
+        user_cache_ttl: float = 300,
+        message_buffer_size: int = 50,
+        message_flush_interval: float = 5.0,
+        shared: bool = False,
+        sync_interval: float = 5.0,
+        dua_limit_per_user: int = 2,
+        dua_limit_total: int = 20
+    ):
         self.db_path = db_path
+        # Все записи идут через единственного писателя, чтение - через пул соединений
+        self.writer = WriteQueue(db_path, pragmas=pragmas, max_batch=write_batch_size)
+        self.pool = ConnectionPool(db_path, size=pool_size, pragmas=pragmas)
+        self.schema_version = 0
+        # Профили пользователей; сбрасываются методами, изменяющими users
+        self.user_cache = TTLCache(maxsize=user_cache_size, ttl=user_cache_ttl)
+        # Активный марафон; сбрасывается create_marathon, сумма обновляется отметками
+        self.active_marathon = MarathonSnapshot()
+        # Рейтинг активного марафона в памяти
+        self.leaderboard: Optional[Leaderboard] = None
+        # Счетчики дуа текущей недели Джума
+        self.dua_quota = DuaQuota(dua_limit_per_user, dua_limit_total)
+        self._dua_quota_lock = asyncio.Lock()
+        # Последние сообщения бота по чатам; в bot_messages пишутся пачками
+        self.messages = MessageTracker(
+            self._save_bot_messages,
+            buffer_size=message_buffer_size,
+            flush_interval=message_flush_interval
+        )
+        # shared=True - в базу пишут и другие процессы: кэши выше сбрасываются,
+        # если за sync_interval секунд в базе появились чужие изменения
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self._data_version: Optional[int] = None
+        # Версия итогов марафонов, которой соответствует рейтинг в памяти
+        self._totals_version: Optional[int] = None
+        self._sync_task: Optional[asyncio.Task] = None
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    display_name TEXT,
-                    language TEXT DEFAULT 'uz_latin',
-                    is_anonymous INTEGER DEFAULT 0,
-                    daily_plan INTEGER DEFAULT 0,
-                    state TEXT DEFAULT 'NEW',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS duas (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    text TEXT NOT NULL,
-                    sender_name TEXT NOT NULL,
-                    is_anonymous INTEGER DEFAULT 0,
-                    juma_week TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS marathons (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    goal_amount INTEGER NOT NULL,
-                    current_amount INTEGER DEFAULT 0,
-                    start_date DATE NOT NULL,
-                    end_date DATE NOT NULL,
-                    is_active INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS marathon_participants (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    marathon_id INTEGER,
-                    user_id INTEGER,
-                    joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (marathon_id) REFERENCES marathons(id),
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    UNIQUE(marathon_id, user_id)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS daily_completions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    marathon_id INTEGER,
-                    completion_date DATE NOT NULL,
-                    is_completed INTEGER DEFAULT 0,
-                    amount INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id),
-                    FOREIGN KEY (marathon_id) REFERENCES marathons(id),
-                    UNIQUE(user_id, marathon_id, completion_date)
-                )
-            """)
-
-            await db.execute("""
-                CREATE TABLE IF NOT EXISTS bot_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    chat_id INTEGER NOT NULL,
-                    message_id INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(user_id)
-                )
-            """)
+        await self.writer.start()
+        await self.writer.submit(self._create_schema)
+        version = await self.writer.submit(get_schema_version)
+        self.schema_version = await apply_migrations(self.writer, version)
+        if not await self.writer.submit(incremental_vacuum_enabled, transaction=False):
+            # Полный VACUUM блокирует базу, поэтому при запуске не выполняется
+            logger.warning(
+                "Incremental auto_vacuum is not enabled, free pages are not reclaimed. "
+                "Stop the bot and run 'python tools/enable_incremental_vacuum.py' once"
+            )
+        # Пул читателей открываем после миграций, чтобы соединения видели актуальную схему
+        await self.pool.open()
+        await self.load_leaderboard()
+        self.messages.load(await self._get_recent_bot_messages())
+        self.messages.start()
+        if self.shared:
+            self._data_version = await self.writer.submit(_get_data_version, transaction=False)
+            self._totals_version = await self.writer.submit(_get_totals_version, transaction=False)
+            self._sync_task = asyncio.create_task(self._run_sync())
+
+    async def _create_schema(self, db: aiosqlite.Connection):
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                display_name TEXT,
+                language TEXT DEFAULT 'uz_latin',
+                is_anonymous INTEGER DEFAULT 0,
+                daily_plan INTEGER DEFAULT 0,
+                state TEXT DEFAULT 'NEW',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS duas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                text TEXT NOT NULL,
+                sender_name TEXT NOT NULL,
+                is_anonymous INTEGER DEFAULT 0,
+                juma_week TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS marathons (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                goal_amount INTEGER NOT NULL,
+                current_amount INTEGER DEFAULT 0,
+                start_date DATE NOT NULL,
+                end_date DATE NOT NULL,
+                is_active INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS marathon_participants (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                marathon_id INTEGER,
+                user_id INTEGER,
+                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (marathon_id) REFERENCES marathons(id),
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                UNIQUE(marathon_id, user_id)
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS daily_completions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                marathon_id INTEGER,
+                completion_date DATE NOT NULL,
+                is_completed INTEGER DEFAULT 0,
+                amount INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id),
+                FOREIGN KEY (marathon_id) REFERENCES marathons(id),
+                UNIQUE(user_id, marathon_id, completion_date)
+            )
+        """)
+
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        await ensure_migrations_table(db)
 
-            await db.commit()
+    async def close(self):
+        """Дописать очередь записи и закрыть соединения с базой данных"""
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.gather(self._sync_task, return_exceptions=True)
+            self._sync_task = None
+        await self.messages.stop()
+        await self.writer.stop()
+        await self.pool.close()
 
     async def get_user(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        found, user = self.user_cache.lookup(user_id)
+        if found:
+            return user
+
+        version = self.user_cache.version
+        async with self.pool.acquire() as db:
             async with db.execute(
                 "SELECT * FROM users WHERE user_id = ?", (user_id,)
             ) as cursor:
-                return await cursor.fetchone()
+                user = await cursor.fetchone()
+        # Отсутствие пользователя тоже кэшируем, create_user сбросит запись
+        self.user_cache.set(user_id, user, version)
+        return user
 
     async def create_user(self, user_id: int, username: str, first_name: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async def operation(db: aiosqlite.Connection):
             await db.execute(
                 """INSERT INTO users (user_id, username, first_name)
                    VALUES (?, ?, ?)""",
                 (user_id, username, first_name)
             )
-            await db.commit()
+            # Напоминания в окнах по умолчанию
+            await db.executemany(
+                """INSERT OR IGNORE INTO reminder_slots (user_id, kind, local_minute, utc_minute, utc_offset)
+                   VALUES (?, ?, ?, ?, ?)""",
+                default_reminder_slots(user_id)
+            )
+
+        try:
+            await self.writer.submit(operation)
+        finally:
+            self.user_cache.invalidate(user_id)
 
     async def update_user_language(self, user_id: int, language: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET language = ? WHERE user_id = ?",
-                (language, user_id)
-            )
-            await db.commit()
+        await self._update_user(
+            user_id,
+            "UPDATE users SET language = ? WHERE user_id = ?",
+            (language, user_id)
+        )
 
     async def update_user_state(self, user_id: int, state: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        await self._update_user(
+            user_id,
+            "UPDATE users SET state = ? WHERE user_id = ?",
+            (state, user_id)
+        )
+
+    async def update_user_timezone(self, user_id: int, timezone: str):
+        """Сменить часовой пояс пользователя и пересчитать время его напоминаний"""
+        if timezone not in pytz.all_timezones_set:
+            raise ValueError(f"Unknown timezone: {timezone}")
+        offset = utc_offset_minutes(timezone)
+
+        async def operation(db: aiosqlite.Connection):
             await db.execute(
-                "UPDATE users SET state = ? WHERE user_id = ?",
-                (state, user_id)
+                "UPDATE users SET timezone = ? WHERE user_id = ?",
+                (timezone, user_id)
+            )
+            await db.execute(
+                """UPDATE reminder_slots
+                   SET utc_minute = (local_minute - ? + 1440) % 1440, utc_offset = ?
+                   WHERE user_id = ?""",
+                (offset, offset, user_id)
             )
-            await db.commit()
 
-    async def get_current_juma_week(self) -> str:
-        now = datetime.now()
-        friday = now + timedelta((4 - now.weekday()) % 7)
-        return friday.strftime("%Y-%W")
+        try:
+            await self.writer.submit(operation)
+        finally:
+            self.user_cache.invalidate(user_id)
 
-    async def count_user_duas_this_juma(self, user_id: int) -> int:
-        juma_week = await self.get_current_juma_week()
-        async with aiosqlite.connect(self.db_path) as db:
+    async def update_reminder_window(self, user_id: int, kind: str, start: str, length: int):
+        """Задать окно напоминания kind: начало HH:MM по местному времени и длительность в минутах"""
+        check_reminder_kind(kind)
+        user = await self.get_user(user_id)
+        timezone = user['timezone'] if user else None
+        local_minute = spread_minute(user_id, parse_minute(start), length)
+        offset = utc_offset_minutes(timezone)
+        await self.writer.execute(
+            """INSERT INTO reminder_slots (user_id, kind, local_minute, utc_minute, utc_offset)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT (user_id, kind) DO UPDATE SET
+                   local_minute = excluded.local_minute,
+                   utc_minute = excluded.utc_minute,
+                   utc_offset = excluded.utc_offset""",
+            (user_id, kind, local_minute, (local_minute - offset) % MINUTES_PER_DAY, offset)
+        )
+
+    async def refresh_reminder_slots(self) -> int:
+        """Пересчитать utc_minute по текущим смещениям часовых поясов (переход на летнее время)"""
+        async with self.pool.acquire() as db:
+            async with db.execute("SELECT DISTINCT timezone FROM users") as cursor:
+                offsets = {row[0]: utc_offset_minutes(row[0]) for row in await cursor.fetchall()}
+
+        async def operation(db: aiosqlite.Connection) -> int:
+            updated = 0
+            for timezone, offset in offsets.items():
+                async with db.execute(
+                    """UPDATE reminder_slots
+                       SET utc_minute = (local_minute - ? + 1440) % 1440, utc_offset = ?
+                       WHERE user_id IN (SELECT user_id FROM users WHERE timezone IS ?)
+                       AND utc_offset != ?""",
+                    (offset, offset, timezone, offset)
+                ) as cursor:
+                    updated += cursor.rowcount
+            return updated
+
+        return await self.writer.submit(operation)
+
+    async def get_due_reminder_kinds(self, utc_minute: int):
+        """Виды напоминаний, у которых есть получатели в минуту utc_minute"""
+        async with self.pool.acquire() as db:
             async with db.execute(
-                "SELECT COUNT(*) FROM duas WHERE user_id = ? AND juma_week = ?",
-                (user_id, juma_week)
+                "SELECT DISTINCT kind FROM reminder_slots WHERE utc_minute = ?",
+                (utc_minute,)
             ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else 0
+                return [row[0] for row in await cursor.fetchall()]
 
-    async def count_total_duas_this_juma(self) -> int:
-        juma_week = await self.get_current_juma_week()
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_last_reminder_minute(self) -> Optional[datetime]:
+        async with self.pool.acquire() as db:
+            async with db.execute("SELECT last_minute FROM reminder_dispatch WHERE id = 1") as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S").replace(tzinfo=pytz.utc)
+
+    async def set_last_reminder_minute(self, minute: datetime):
+        await self.writer.execute(
+            """INSERT INTO reminder_dispatch (id, last_minute) VALUES (1, ?)
+               ON CONFLICT (id) DO UPDATE SET last_minute = max(last_minute, excluded.last_minute)""",
+            (minute.astimezone(pytz.utc).strftime("%Y-%m-%d %H:%M:%S"),)
+        )
+
+    async def mark_user_reachable(self, user_id: int):
+        """Снять отметки о недоступности: пользователь снова написал боту"""
+        await self._update_user(
+            user_id,
+            """UPDATE users
+               SET is_blocked = 0, is_deactivated = 0, failure_count = 0, next_attempt_at = NULL
+               WHERE user_id = ?""",
+            (user_id,)
+        )
+
+    async def _update_user(self, user_id: int, sql: str, parameters: tuple):
+        """Изменить строку users и сбросить профиль в кэше"""
+        try:
+            await self.writer.execute(sql, parameters)
+        finally:
+            self.user_cache.invalidate(user_id)
+
+    async def _get_dua_quota(self) -> DuaQuota:
+        """Счетчики дуа текущей недели; загружаются при первом обращении и смене недели"""
+        juma_week = self.get_current_juma_week()
+        if self.dua_quota.week == juma_week:
+            return self.dua_quota
+
+        async def operation(db: aiosqlite.Connection):
             async with db.execute(
-                "SELECT COUNT(*) FROM duas WHERE juma_week = ?",
+                "SELECT user_id, COUNT(*) FROM duas WHERE juma_key = ? GROUP BY user_id",
                 (juma_week,)
             ) as cursor:
-                result = await cursor.fetchone()
-                return result[0] if result else 0
+                return await cursor.fetchall()
 
-    async def add_dua(self, user_id: int, text: str, sender_name: str, is_anonymous: bool):
-        juma_week = await self.get_current_juma_week()
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT INTO duas (user_id, text, sender_name, is_anonymous, juma_week)
-                   VALUES (?, ?, ?, ?, ?)""",
-                (user_id, text, sender_name, 1 if is_anonymous else 0, juma_week)
+        async with self._dua_quota_lock:
+            if self.dua_quota.week != juma_week:
+                # Читаем через писателя: в результат попадут все уже поставленные в очередь дуа
+                self.dua_quota.load(juma_week, await self.writer.submit(operation, transaction=False))
+        return self.dua_quota
+
+    async def count_user_duas_this_juma(self, user_id: int) -> int:
+        return (await self._get_dua_quota()).user_count(user_id)
+
+    async def count_total_duas_this_juma(self) -> int:
+        return (await self._get_dua_quota()).total_count()
+
+    async def add_dua(self, user_id: int, text: str, sender_name: str, is_anonymous: bool) -> Optional[str]:
+        """Сохранить дуа, если лимиты недели позволяют; иначе вернуть причину отказа"""
+        quota = await self._get_dua_quota()
+        juma_week = quota.week
+        reason = quota.reserve(user_id)
+        if reason:
+            return reason
+
+        try:
+            # Лимиты проверяются и в транзакции записи: в базу могут писать другие процессы
+            inserted = await self.writer.execute(
+                """INSERT INTO duas (user_id, text, sender_name, is_anonymous, juma_week, juma_key)
+                   SELECT ?, ?, ?, ?, ?, ?
+                   WHERE (SELECT COUNT(*) FROM duas WHERE juma_key = ? AND user_id = ?) < ?
+                   AND (SELECT COUNT(*) FROM duas WHERE juma_key = ?) < ?""",
+                (
+                    user_id, text, sender_name, 1 if is_anonymous else 0,
+                    juma_friday(juma_week).isoformat(), juma_week,
+                    juma_week, user_id, quota.per_user,
+                    juma_week, quota.total
+                )
             )
-            await db.commit()
+        except Exception:
+            if quota.week == juma_week:
+                quota.release(user_id)
+            raise
+
+        if not inserted:
+            # Места заняли другие процессы: перечитать счетчики
+            quota.invalidate()
+            return (await self._get_dua_quota()).check(user_id) or LIMIT_TOTAL
+        return None
 
     async def get_total_duas_count(self) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
             async with db.execute("SELECT COUNT(*) FROM duas") as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else 0
 
+    async def get_undelivered_duas(self, limit: int = 200) -> List[dict]:
+        """Дуа, еще не пересланные администратору, в порядке отправки"""
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                """SELECT id, user_id, text, sender_name, is_anonymous, created_at
+                   FROM duas
+                   WHERE delivered_at IS NULL
+                   ORDER BY id LIMIT ?""",
+                (limit,)
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def mark_duas_delivered(self, dua_ids: List[int]):
+        if not dua_ids:
+            return
+
+        async def operation(db: aiosqlite.Connection):
+            await db.executemany(
+                "UPDATE duas SET delivered_at = CURRENT_TIMESTAMP WHERE id = ?",
+                [(dua_id,) for dua_id in dua_ids]
+            )
+
+        await self.writer.submit(operation)
+
     # Marathon methods
     async def create_marathon(self, goal_amount: int, start_date: str, end_date: str):
         """Создать новый марафон"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async def operation(db: aiosqlite.Connection):
             # Деактивируем все существующие марафоны
             await db.execute(
                 "UPDATE marathons SET is_active = 0 WHERE is_active = 1"
             )
             # Создаем новый марафон
-            await db.execute(
+            async with db.execute(
                 """INSERT INTO marathons (goal_amount, start_date, end_date, is_active, current_amount)
                    VALUES (?, ?, ?, 1, 0)""",
                 (goal_amount, start_date, end_date)
-            )
-            await db.commit()
+            ) as cursor:
+                return cursor.lastrowid
+
+        try:
+            marathon_id = await self.writer.submit(operation)
+        finally:
+            self.active_marathon.invalidate()
+        # Новый марафон начинается с пустого рейтинга
+        self.leaderboard = Leaderboard(marathon_id)
 
     async def get_active_marathon(self):
         """Получить активный марафон"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        loaded, marathon = self.active_marathon.get()
+        if loaded:
+            return marathon
+
+        version = self.active_marathon.version
+        async with self.pool.acquire() as db:
             async with db.execute(
                 "SELECT * FROM marathons WHERE is_active = 1 LIMIT 1"
             ) as cursor:
                 row = await cursor.fetchone()
-                if row:
-                    return dict(row)
-                return None
+                marathon = dict(row) if row else None
+        self.active_marathon.set(marathon, version)
+        return marathon
 
     async def join_marathon(self, user_id: int, marathon_id: int):
         """Присоединиться к марафону"""
-        async with aiosqlite.connect(self.db_path) as db:
-            try:
-                await db.execute(
-                    """INSERT OR IGNORE INTO marathon_participants (marathon_id, user_id)
-                       VALUES (?, ?)""",
-                    (marathon_id, user_id)
-                )
-                await db.commit()
-            except aiosqlite.IntegrityError:
-                # Уже участник, игнорируем
-                pass
+        try:
+            await self.writer.execute(
+                """INSERT OR IGNORE INTO marathon_participants (marathon_id, user_id)
+                   VALUES (?, ?)""",
+                (marathon_id, user_id)
+            )
+        except aiosqlite.IntegrityError:
+            # Уже участник, игнорируем
+            pass
 
     async def get_user_marathon_stats(self, user_id: int, marathon_id: int):
         """Получить статистику пользователя по марафону"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Подсчитываем общий вклад пользователя (сумма всех amount из daily_completions)
+        async with self.pool.acquire() as db:
+            # Итоги пользователя поддерживаются триггерами daily_completions
             async with db.execute(
-                """SELECT 
-                    COALESCE(SUM(amount), 0) as total_contribution,
-                    COUNT(CASE WHEN is_completed = 1 THEN 1 END) as completed_days,
-                    COUNT(*) as total_days
-                   FROM daily_completions
+                """SELECT total_contribution, completed_days, total_days
+                   FROM marathon_user_totals
                    WHERE user_id = ? AND marathon_id = ?""",
                 (user_id, marathon_id)
             ) as cursor:
@@ -228,54 +575,135 @@ class Database:
 
     async def mark_day_completed(self, user_id: int, marathon_id: int, date: str, amount: int):
         """Отметить день как выполненный"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Используем INSERT OR REPLACE для обновления существующей записи
-            await db.execute(
-                """INSERT OR REPLACE INTO daily_completions 
-                   (user_id, marathon_id, completion_date, is_completed, amount)
-                   VALUES (?, ?, ?, 1, ?)""",
-                (user_id, marathon_id, date, amount)
-            )
-            # Обновляем текущую сумму марафона
-            await db.execute(
-                """UPDATE marathons 
-                   SET current_amount = (
-                       SELECT COALESCE(SUM(amount), 0)
-                       FROM daily_completions
-                       WHERE marathon_id = ? AND is_completed = 1
-                   )
-                   WHERE id = ?""",
-                (marathon_id, marathon_id)
-            )
-            await db.commit()
+        await self._save_completion(user_id, marathon_id, date, True, amount)
 
     async def mark_day_not_completed(self, user_id: int, marathon_id: int, date: str):
         """Отметить день как невыполненный"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Используем INSERT OR REPLACE для обновления существующей записи
+        await self._save_completion(user_id, marathon_id, date, False, 0)
+
+    async def _save_completion(self, user_id: int, marathon_id: int, date: str, is_completed: bool, amount: int):
+        """Сохранить отметку дня и обновить снимок марафона и рейтинг в памяти"""
+        async def operation(db: aiosqlite.Connection):
+            totals_version = await _get_totals_version(db) if self.shared else None
+            # UPSERT обновляет существующую запись, а триггеры daily_completions
+            # применяют разницу сумм к marathons.current_amount в той же транзакции
             await db.execute(
-                """INSERT OR REPLACE INTO daily_completions 
+                """INSERT INTO daily_completions
                    (user_id, marathon_id, completion_date, is_completed, amount)
-                   VALUES (?, ?, ?, 0, 0)""",
-                (user_id, marathon_id, date)
+                   VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT (user_id, marathon_id, completion_date)
+                   DO UPDATE SET is_completed = excluded.is_completed, amount = excluded.amount""",
+                (user_id, marathon_id, date, 1 if is_completed else 0, amount)
             )
-            # Обновляем текущую сумму марафона (пересчитываем)
-            await db.execute(
-                """UPDATE marathons 
-                   SET current_amount = (
-                       SELECT COALESCE(SUM(amount), 0)
+            async with db.execute(
+                """SELECT
+                       (SELECT total_contribution FROM marathon_user_totals
+                        WHERE marathon_id = ? AND user_id = ?),
+                       (SELECT current_amount FROM marathons WHERE id = ?)""",
+                (marathon_id, user_id, marathon_id)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if self.shared:
+                return row[0] or 0, row[1] or 0, (totals_version, await _get_totals_version(db))
+            return row[0] or 0, row[1] or 0, None
+
+        user_total, current_amount, totals_versions = await self.writer.submit(operation)
+        self.active_marathon.update_amount(marathon_id, current_amount)
+        if self.leaderboard and self.leaderboard.marathon_id == marathon_id:
+            self.leaderboard.update(user_id, user_total)
+        if totals_versions and totals_versions[0] == self._totals_version:
+            # Итоги менял только этот процесс, рейтинг в памяти уже учитывает отметку
+            self._totals_version = totals_versions[1]
+
+    async def reconcile_marathon_totals(self):
+        """Пересчитать суммы марафонов и итоги участников с нуля и исправить расхождения.
+
+        Архивные марафоны пропускаются: их отметки перенесены в архив,
+        а суммы зафиксированы на момент переноса.
+
+        Returns:
+            Список расхождений: marathon_id, user_id (для итогов участника),
+            сохраненная и фактическая сумма
+        """
+        async def operation(db: aiosqlite.Connection):
+            async with db.execute(
+                """SELECT m.id, COALESCE(m.current_amount, 0) AS stored, COALESCE(t.actual, 0) AS actual
+                   FROM marathons m
+                   LEFT JOIN (
+                       SELECT marathon_id, SUM(amount) AS actual
                        FROM daily_completions
-                       WHERE marathon_id = ? AND is_completed = 1
-                   )
-                   WHERE id = ?""",
-                (marathon_id, marathon_id)
-            )
-            await db.commit()
+                       WHERE is_completed = 1
+                       GROUP BY marathon_id
+                   ) t ON t.marathon_id = m.id
+                   WHERE m.archived_at IS NULL
+                   AND COALESCE(m.current_amount, 0) != COALESCE(t.actual, 0)"""
+            ) as cursor:
+                drifts = [
+                    {'marathon_id': row['id'], 'stored': row['stored'], 'actual': row['actual']}
+                    for row in await cursor.fetchall()
+                ]
+            for drift in drifts:
+                await db.execute(
+                    "UPDATE marathons SET current_amount = ? WHERE id = ?",
+                    (drift['actual'], drift['marathon_id'])
+                )
+            drifts.extend(await self._reconcile_user_totals(db))
+            return drifts
+
+        try:
+            return await self.writer.submit(operation)
+        finally:
+            self.active_marathon.invalidate()
+
+    async def _reconcile_user_totals(self, db: aiosqlite.Connection):
+        """Сверить marathon_user_totals с daily_completions внутри транзакции писателя"""
+        async with db.execute(
+            """SELECT marathon_id, user_id,
+                      COALESCE(SUM(CASE WHEN is_completed = 1 THEN amount ELSE 0 END), 0),
+                      COUNT(CASE WHEN is_completed = 1 THEN 1 END),
+                      COUNT(*)
+               FROM daily_completions
+               WHERE marathon_id NOT IN (SELECT id FROM marathons WHERE archived_at IS NOT NULL)
+               GROUP BY marathon_id, user_id"""
+        ) as cursor:
+            actual = {(row[0], row[1]): tuple(row[2:]) for row in await cursor.fetchall()}
+        async with db.execute(
+            """SELECT marathon_id, user_id, total_contribution, completed_days, total_days
+               FROM marathon_user_totals
+               WHERE marathon_id NOT IN (SELECT id FROM marathons WHERE archived_at IS NOT NULL)"""
+        ) as cursor:
+            stored = {(row[0], row[1]): tuple(row[2:]) for row in await cursor.fetchall()}
+
+        drifts = []
+        for key in actual.keys() | stored.keys():
+            expected = actual.get(key, (0, 0, 0))
+            current = stored.get(key, (0, 0, 0))
+            if expected == current:
+                continue
+            marathon_id, user_id = key
+            drifts.append({
+                'marathon_id': marathon_id,
+                'user_id': user_id,
+                'stored': current[0],
+                'actual': expected[0]
+            })
+            if key in actual:
+                await db.execute(
+                    """INSERT OR REPLACE INTO marathon_user_totals
+                       (marathon_id, user_id, total_contribution, completed_days, total_days)
+                       VALUES (?, ?, ?, ?, ?)""",
+                    (marathon_id, user_id, *expected)
+                )
+            else:
+                await db.execute(
+                    "DELETE FROM marathon_user_totals WHERE marathon_id = ? AND user_id = ?",
+                    (marathon_id, user_id)
+                )
+        return drifts
 
     async def get_user_daily_completions(self, user_id: int, marathon_id: int, year: int, month: int):
         """Получить отметки пользователя за месяц"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.acquire() as db:
             # Формируем дату начала и конца месяца
             start_date = f"{year}-{month:02d}-01"
             # Вычисляем последний день месяца
@@ -308,27 +736,24 @@ class Database:
 
     async def update_user_daily_plan(self, user_id: int, daily_plan: int):
         """Обновить дневной план пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET daily_plan = ? WHERE user_id = ?",
-                (daily_plan, user_id)
-            )
-            await db.commit()
+        await self._update_user(
+            user_id,
+            "UPDATE users SET daily_plan = ? WHERE user_id = ?",
+            (daily_plan, user_id)
+        )
 
     async def update_user_display_name(self, user_id: int, display_name: str, is_anonymous: bool):
         """Обновить отображаемое имя пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET display_name = ?, is_anonymous = ? WHERE user_id = ?",
-                (display_name, 1 if is_anonymous else 0, user_id)
-            )
-            await db.commit()
+        await self._update_user(
+            user_id,
+            "UPDATE users SET display_name = ?, is_anonymous = ? WHERE user_id = ?",
+            (display_name, 1 if is_anonymous else 0, user_id)
+        )
 
     async def get_marathon_stats(self, marathon_id: int):
         """Получить общую статистику марафона"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
             # Получаем информацию о марафоне
-            db.row_factory = aiosqlite.Row
             async with db.execute(
                 "SELECT goal_amount, current_amount FROM marathons WHERE id = ?",
                 (marathon_id,)
@@ -362,47 +787,116 @@ class Database:
 
     async def get_total_users_count(self) -> int:
         """Получить общее количество пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
             async with db.execute("SELECT COUNT(*) FROM users") as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else 0
 
+    async def get_unreachable_users_count(self):
+        """Количество пользователей, исключенных из рассылок"""
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                """SELECT
+                       COUNT(CASE WHEN is_blocked = 1 THEN 1 END),
+                       COUNT(CASE WHEN is_deactivated = 1 AND is_blocked = 0 THEN 1 END),
+                       COUNT(CASE WHEN is_blocked = 0 AND is_deactivated = 0
+                                  AND next_attempt_at > CURRENT_TIMESTAMP THEN 1 END)
+                   FROM users"""
+            ) as cursor:
+                row = await cursor.fetchone()
+                return {'blocked': row[0], 'deactivated': row[1], 'backoff': row[2]}
+
     async def get_total_marathons_count(self) -> int:
         """Получить общее количество марафонов"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
             async with db.execute("SELECT COUNT(*) FROM marathons") as cursor:
                 result = await cursor.fetchone()
                 return result[0] if result else 0
 
     async def get_total_donations_amount(self) -> int:
         """Получить общую сумму всех пожертвований"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
+            # Суммы марафонов поддерживаются триггерами и включают архивные отметки
             async with db.execute(
-                "SELECT COALESCE(SUM(amount), 0) FROM daily_completions WHERE is_completed = 1"
+                "SELECT COALESCE(SUM(current_amount), 0) FROM marathons"
             ) as cursor:
                 result = await cursor.fetchone()
                 return int(result[0]) if result and result[0] else 0
 
+    async def load_leaderboard(self):
+        """Загрузить рейтинг активного марафона в память"""
+        marathon = await self.get_active_marathon()
+        if not marathon:
+            self.leaderboard = None
+            return
+        leaderboard = Leaderboard(marathon['id'])
+        leaderboard.load(await self._get_user_totals(marathon['id']))
+        self.leaderboard = leaderboard
+
+    async def _get_user_totals(self, marathon_id: int):
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                """SELECT user_id, total_contribution
+                   FROM marathon_user_totals
+                   WHERE marathon_id = ?""",
+                (marathon_id,)
+            ) as cursor:
+                return [(row[0], row[1]) for row in await cursor.fetchall()]
+
+    async def _get_leaderboard(self, marathon_id: int) -> Leaderboard:
+        """Рейтинг марафона: из памяти для активного, из базы для остальных"""
+        if self.leaderboard and self.leaderboard.marathon_id == marathon_id:
+            return self.leaderboard
+        leaderboard = Leaderboard(marathon_id)
+        leaderboard.load(await self._get_user_totals(marathon_id))
+        return leaderboard
+
+    async def verify_leaderboard(self):
+        """Сверить рейтинг в памяти с базой данных.
+
+        Returns:
+            Список user_id с расхождениями (рейтинг при этом перезагружается)
+        """
+        if not self.leaderboard:
+            return []
+        actual = dict(await self._get_user_totals(self.leaderboard.marathon_id))
+        cached = self.leaderboard.snapshot()
+        mismatched = [
+            user_id for user_id in actual.keys() | cached.keys()
+            if actual.get(user_id, 0) != cached.get(user_id, 0)
+        ]
+        if mismatched:
+            self.leaderboard.load(actual.items())
+        return mismatched
+
+    async def get_marathon_top(self, marathon_id: int, limit: int = 10):
+        """Получить первые места рейтинга: список (место, user_id, сумма)"""
+        return (await self._get_leaderboard(marathon_id)).top(limit)
+
+    async def get_marathon_neighbours(self, user_id: int, marathon_id: int, radius: int = 2):
+        """Получить соседей пользователя по рейтингу: список (место, user_id, сумма)"""
+        return (await self._get_leaderboard(marathon_id)).around(user_id, radius)
+
     async def get_marathon_ranking(self, user_id: int, marathon_id: int):
         """Получить место пользователя в рейтинге марафона"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Считаем сумму для текущего пользователя
+        if self.leaderboard and self.leaderboard.marathon_id == marathon_id:
+            return self.leaderboard.rank(user_id)
+
+        async with self.pool.acquire() as db:
+            # Сумма текущего пользователя из агрегатной таблицы
             async with db.execute(
-                """SELECT COALESCE(SUM(amount), 0) 
-                   FROM daily_completions 
-                   WHERE user_id = ? AND marathon_id = ? AND is_completed = 1""",
-                (user_id, marathon_id)
+                """SELECT total_contribution
+                   FROM marathon_user_totals
+                   WHERE marathon_id = ? AND user_id = ?""",
+                (marathon_id, user_id)
             ) as cursor:
-                user_total = (await cursor.fetchone())[0]
+                row = await cursor.fetchone()
+                user_total = row[0] if row else 0
 
-            # Считаем, сколько людей пожертвовали больше
+            # Считаем, сколько людей пожертвовали больше (диапазон по индексу)
             async with db.execute(
-                """SELECT COUNT(*) FROM (
-                       SELECT SUM(amount) as total 
-                       FROM daily_completions 
-                       WHERE marathon_id = ? AND is_completed = 1 
-                       GROUP BY user_id
-                   ) WHERE total > ?""",
+                """SELECT COUNT(*) FROM marathon_user_totals
+                   WHERE marathon_id = ? AND total_contribution > ?""",
                 (marathon_id, user_total)
             ) as cursor:
                 rank = (await cursor.fetchone())[0] + 1
@@ -411,7 +905,7 @@ class Database:
 
     async def get_daily_global_stats(self, marathon_id: int, date: str):
         """Получить общую статистику за день"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.acquire() as db:
             async with db.execute(
                 """SELECT 
                     COALESCE(SUM(amount), 0) as total_amount,
@@ -426,56 +920,304 @@ class Database:
                     'participants_count': row[1] or 0
                 }
 
-    async def get_all_users(self):
-        """Получить список всех пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT user_id, language FROM users") as cursor:
+    # Очередь рассылок
+    async def create_broadcast_job(
+        self,
+        job_key: str,
+        kind: str,
+        audience: str,
+        payload: Optional[dict] = None,
+        **parameters
+    ) -> Optional[int]:
+        """Создать задание рассылки вместе со списком получателей.
+
+        job_key - ключ идемпотентности: если задание с таким ключом уже
+        есть, ничего не создается и возвращается None. Получатели выбираются
+        одним INSERT ... SELECT по аудитории из BROADCAST_AUDIENCES.
+        """
+        audience_query = BROADCAST_AUDIENCES[audience]
+
+        async def operation(db: aiosqlite.Connection):
+            async with db.execute(
+                """INSERT INTO broadcast_jobs (job_key, kind, payload)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT (job_key) DO NOTHING""",
+                (job_key, kind, json.dumps(payload) if payload is not None else None)
+            ) as cursor:
+                if cursor.rowcount == 0:
+                    return None
+                job_id = cursor.lastrowid
+            async with db.execute(
+                f"""INSERT INTO broadcast_recipients (job_id, user_id, language)
+                    SELECT :job_id, user_id, language FROM ({audience_query})""",
+                {'job_id': job_id, **parameters}
+            ) as cursor:
+                total = cursor.rowcount
+            await db.execute(
+                "UPDATE broadcast_jobs SET total = ? WHERE id = ?",
+                (total, job_id)
+            )
+            return job_id
+
+        return await self.writer.submit(operation)
+
+    async def get_unfinished_broadcast_jobs(self, reset_claimed: bool = True):
+        """Незавершенные задания рассылки.
+
+        Получатели, захваченные до перезапуска, возвращаются в очередь
+        (reset_claimed=False - только если никто больше не может их рассылать).
+        """
+        if reset_claimed:
+            await self.writer.execute(
+                """UPDATE broadcast_recipients SET status = 'pending'
+                   WHERE status = 'claimed' AND job_id IN (
+                       SELECT id FROM broadcast_jobs WHERE status = 'pending'
+                   )"""
+            )
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                """SELECT id, job_key, kind, payload, total
+                   FROM broadcast_jobs
+                   WHERE status = 'pending'
+                   ORDER BY id"""
+            ) as cursor:
                 rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        return [self._broadcast_job_from_row(row) for row in rows]
+
+    async def get_broadcast_job(self, job_id: int):
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                "SELECT id, job_key, kind, payload, total FROM broadcast_jobs WHERE id = ?",
+                (job_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return self._broadcast_job_from_row(row) if row else None
+
+    @staticmethod
+    def _broadcast_job_from_row(row) -> dict:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        return job
+
+    async def count_pending_broadcast_recipients(self, job_id: int) -> int:
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                """SELECT COUNT(*) FROM broadcast_recipients
+                   WHERE job_id = ? AND status = 'pending'""",
+                (job_id,)
+            ) as cursor:
+                result = await cursor.fetchone()
+                return result[0] if result else 0
+
+    async def claim_broadcast_recipients(self, job_id: int, limit: int):
+        """Захватить очередную порцию получателей задания"""
+        async def operation(db: aiosqlite.Connection):
+            async with db.execute(
+                """UPDATE broadcast_recipients
+                   SET status = 'claimed', attempts = attempts + 1
+                   WHERE job_id = ? AND user_id IN (
+                       SELECT user_id FROM broadcast_recipients
+                       WHERE job_id = ? AND status = 'pending'
+                       ORDER BY user_id LIMIT ?
+                   )
+                   RETURNING user_id, language""",
+                (job_id, job_id, limit)
+            ) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+        return await self.writer.submit(operation)
+
+    async def record_broadcast_results(self, job_id: int, results: Dict[str, list]):
+        """Записать результаты доставки захваченных получателей.
+
+        results - результат доставки (sent, blocked, deactivated, failed) -> user_id.
+        Заодно обновляется состояние доставки пользователей: заблокировавшие
+        бота и удаленные аккаунты исключаются из рассылок, а после временных
+        ошибок следующая попытка откладывается с экспоненциальной задержкой.
+        """
+        results = {outcome: user_ids for outcome, user_ids in results.items() if user_ids}
+        if not results:
+            return
+
+        async def operation(db: aiosqlite.Connection):
+            for outcome, user_ids in results.items():
+                await db.executemany(
+                    """UPDATE broadcast_recipients
+                       SET status = ?, updated_at = CURRENT_TIMESTAMP
+                       WHERE job_id = ? AND user_id = ?""",
+                    [(outcome, job_id, user_id) for user_id in user_ids]
+                )
+                delivery_update = _DELIVERY_STATE_UPDATES.get(outcome)
+                if delivery_update:
+                    await db.executemany(delivery_update, [(user_id,) for user_id in user_ids])
+
+        await self.writer.submit(operation)
+        # Флаги доставки входят в профиль пользователя
+        for outcome, user_ids in results.items():
+            if outcome != 'sent':
+                for user_id in user_ids:
+                    self.user_cache.invalidate(user_id)
+
+    async def finish_broadcast_job(self, job_id: int):
+        await self.writer.execute(
+            """UPDATE broadcast_jobs
+               SET status = 'done', finished_at = CURRENT_TIMESTAMP
+               WHERE id = ?""",
+            (job_id,)
+        )
+
+    # Multi-process methods
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Взять или продлить аренду name на ttl секунд.
+
+        Возвращает True, если аренда принадлежит holder: она была свободна,
+        истекла или уже была его.
+        """
+        async def operation(db: aiosqlite.Connection) -> bool:
+            now = time.time()
+            async with db.execute(
+                """INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT (name) DO UPDATE SET
+                       holder = excluded.holder,
+                       expires_at = excluded.expires_at
+                   WHERE leases.holder = excluded.holder OR leases.expires_at < ?
+                   RETURNING holder""",
+                (name, holder, now + ttl, now)
+            ) as cursor:
+                return await cursor.fetchone() is not None
+
+        return await self.writer.submit(operation)
+
+    async def release_lease(self, name: str, holder: str):
+        """Освободить аренду, если она принадлежит holder"""
+        await self.writer.execute(
+            "DELETE FROM leases WHERE name = ? AND holder = ?",
+            (name, holder)
+        )
+
+    async def sync_external_changes(self) -> bool:
+        """Сбросить кэши, если базу изменили другие процессы.
+
+        PRAGMA data_version соединения писателя меняется только после
+        фиксаций других соединений, а в этом процессе пишет только писатель.
+        Рейтинг перезагружается, только если изменилась версия итогов
+        марафонов (marathon_totals_version).
+        """
+        version = await self.writer.submit(_get_data_version, transaction=False)
+        if version == self._data_version:
+            return False
+        self._data_version = version
+        self.user_cache.clear()
+        # Счетчики дуа перечитываются лениво, при следующем add_dua
+        self.dua_quota.invalidate()
+        totals_version = await self.writer.submit(_get_totals_version, transaction=False)
+        if totals_version != self._totals_version:
+            self._totals_version = totals_version
+            self.active_marathon.invalidate()
+            await self.load_leaderboard()
+        return True
+
+    async def _run_sync(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync_external_changes()
+            except Exception as e:
+                logger.error(f"Failed to sync external database changes: {e}")
 
     # Bot messages management methods
     async def add_bot_message(self, user_id: int, chat_id: int, message_id: int):
         """Сохранить ID сообщения бота для последующего удаления"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT INTO bot_messages (user_id, chat_id, message_id)
-                   VALUES (?, ?, ?)""",
-                (user_id, chat_id, message_id)
-            )
-            await db.commit()
+        self.messages.add(user_id, chat_id, message_id)
 
     async def get_bot_messages(self, user_id: int, chat_id: int):
         """Получить список сообщений бота для пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        return self.messages.get(user_id, chat_id)
+
+    async def remove_bot_messages(self, message_ids: list, chat_id: Optional[int] = None):
+        """Удалить записи о сообщениях"""
+        self.messages.remove(message_ids, chat_id)
+
+    async def _get_recent_bot_messages(self):
+        """Сообщения бота за последние 48 часов для заполнения буферов"""
+        since = (datetime.utcnow() - RELOAD_WINDOW).strftime("%Y-%m-%d %H:%M:%S")
+        async with self.pool.acquire() as db:
             async with db.execute(
-                """SELECT id, message_id, created_at 
-                   FROM bot_messages 
-                   WHERE user_id = ? AND chat_id = ?
-                   ORDER BY created_at ASC""",
-                (user_id, chat_id)
+                """SELECT user_id, chat_id, message_id, created_at
+                   FROM bot_messages
+                   WHERE created_at >= ?
+                   ORDER BY created_at, id""",
+                (since,)
             ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+                return await cursor.fetchall()
 
-    async def remove_bot_messages(self, message_ids: list):
-        """Удалить записи о сообщениях из базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            placeholders = ','.join('?' * len(message_ids))
-            await db.execute(
-                f"DELETE FROM bot_messages WHERE message_id IN ({placeholders})",
-                message_ids
-            )
-            await db.commit()
+    async def _save_bot_messages(self, inserts: List[tuple], deletes: List[tuple]):
+        """Записать накопленные трекером изменения одной транзакцией"""
+        async def operation(db: aiosqlite.Connection):
+            if deletes:
+                await db.executemany(
+                    "DELETE FROM bot_messages WHERE chat_id = ? AND message_id = ?",
+                    deletes
+                )
+            if inserts:
+                await db.executemany(
+                    """INSERT INTO bot_messages (user_id, chat_id, message_id, created_at)
+                       VALUES (?, ?, ?, ?)""",
+                    inserts
+                )
+
+        await self.writer.submit(operation)
 
     async def clear_old_bot_messages(self, days: int = 7):
         """Очистить старые записи о сообщениях (старше N дней)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """DELETE FROM bot_messages 
-                   WHERE created_at < datetime('now', '-' || ? || ' days')""",
-                (days,)
-            )
-            await db.commit()
+        await self.writer.execute(
+            """DELETE FROM bot_messages 
+               WHERE created_at < datetime('now', '-' || ? || ' days')""",
+            (days,)
+        )
+
+
+    # FSM states
+    async def load_fsm_state(self, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        async with self.pool.acquire() as db:
+            async with db.execute(
+                "SELECT state, data FROM fsm_states WHERE key = ?",
+                (key,)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return (row[0], row[1]) if row else None
+
+    async def save_fsm_states(self, upserts: List[Tuple[str, Optional[str], str]], deletes: List[str]):
+        async def operation(db: aiosqlite.Connection):
+            if deletes:
+                await db.executemany("DELETE FROM fsm_states WHERE key = ?", [(key,) for key in deletes])
+            if upserts:
+                await db.executemany(
+                    """INSERT INTO fsm_states (key, state, data, updated_at)
+                       VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                       ON CONFLICT (key) DO UPDATE SET
+                           state = excluded.state,
+                           data = excluded.data,
+                           updated_at = excluded.updated_at""",
+                    upserts
+                )
+
+        await self.writer.submit(operation)
+
+    # Maintenance
+    async def run_maintenance(self, batch_size: Optional[int] = None) -> Dict[str, object]:
+        """Очистка по срокам хранения, архивирование марафонов и сжатие файла базы"""
+        if batch_size is None:
+            return await run_maintenance(self)
+        return await run_maintenance(self, batch_size)
+
+
+async def _get_data_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA data_version") as cursor:
+        return (await cursor.fetchone())[0]
+
 
+async def _get_totals_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("SELECT version FROM marathon_totals_version WHERE id = 1") as cursor:
+        row = await cursor.fetchone()
+        return row[0] if row else 0
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений aiosqlite.
+
+    Соединения открываются один раз в open(), PRAGMA применяются к каждому
+    соединению сразу после открытия, а закрываются все вместе в close().
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        size: int = 4,
+        pragmas: Optional[Dict[str, object]] = None,
+        isolation_level: Optional[str] = None
+    ):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.pragmas = pragmas or {}
+        # None - режим autocommit: транзакции открываются только явно (BEGIN)
+        self.isolation_level = isolation_level
+        self._connections = []
+        self._idle: Optional[asyncio.Queue] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._idle is not None
+
+    async def open(self):
+        """Открыть все соединения пула"""
+        if self.is_open:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            connection = await self._connect()
+            self._connections.append(connection)
+            self._idle.put_nowait(connection)
+        logger.info(f"Database pool opened: {self.size} connections to {self.db_path}")
+
+    async def _connect(self) -> aiosqlite.Connection:
+        connection = await aiosqlite.connect(self.db_path, isolation_level=self.isolation_level)
+        connection.row_factory = aiosqlite.Row
+        for name, value in self.pragmas.items():
+            # Курсор нужно дочитать: PRAGMA journal_mode возвращает строку и иначе держит блокировку
+            async with connection.execute(f"PRAGMA {name} = {value}") as cursor:
+                await cursor.fetchall()
+        return connection
+
+    async def close(self):
+        """Закрыть все соединения пула"""
+        if not self.is_open:
+            return
+        for connection in self._connections:
+            try:
+                await connection.close()
+            except Exception as e:
+                logger.error(f"Error closing database connection: {e}")
+        self._connections = []
+        self._idle = None
+        logger.info("Database pool closed")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Взять соединение из пула на время блока"""
+        if not self.is_open:
+            raise RuntimeError("Database pool is not open, call Database.init_db() first")
+        idle = self._idle
+        connection = await idle.get()
+        try:
+            yield connection
+        except BaseException:
+            # Не возвращаем в пул соединение с незавершенной транзакцией
+            if connection.in_transaction:
+                await connection.rollback()
+            raise
+        finally:
+            idle.put_nowait(connection)
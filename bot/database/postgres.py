@@ -0,0 +1,1074 @@
+"""
+Хранилище в PostgreSQL (asyncpg).
+
+В отличие от SQLite писателей может быть сколько угодно: запросы идут
+через пул соединений, конкурентные записи разводит сам сервер. Суммы
+марафонов и итоги участников поддерживаются триггером, место в рейтинге,
+топ и соседи считаются оконными функциями на сервере, поэтому данные в
+памяти процесса не хранятся и базу могут одновременно использовать
+несколько экземпляров бота.
+
+Схема повторяет схему SQLite: даты марафонов и отметок - строки
+YYYY-MM-DD, флаги - INTEGER 0/1, поэтому обработчики получают те же
+значения, что и от Database.
+
+Драйвер asyncpg - необязательная зависимость: pip install -r requirements-postgres.txt
+"""
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import pytz
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from bot.config import (
+    ARCHIVE_MARATHONS_AFTER_DAYS,
+    BOT_MESSAGES_RETENTION_DAYS,
+    BROADCAST_JOBS_RETENTION_DAYS,
+    DUAS_RETENTION_DAYS,
+    FSM_STATES_RETENTION_DAYS,
+    MAINTENANCE_BATCH_SIZE
+)
+from bot.database.base import Repository
+from bot.database.dua_quota import LIMIT_TOTAL, LIMIT_USER
+from bot.database.juma import juma_friday
+from bot.database.reminders import (
+    MINUTES_PER_DAY,
+    check_reminder_kind,
+    default_reminder_slots,
+    parse_minute,
+    spread_minute,
+    utc_offset_minutes
+)
+
+logger = logging.getLogger(__name__)
+
+# Блокировка на время применения миграций несколькими экземплярами сразу
+_MIGRATION_LOCK_ID = 7_240_051
+
+POSTGRES_MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "Initial schema", [
+        """CREATE TABLE IF NOT EXISTS users (
+               user_id BIGINT PRIMARY KEY,
+               username TEXT,
+               first_name TEXT,
+               display_name TEXT,
+               language TEXT DEFAULT 'uz_latin',
+               is_anonymous INTEGER DEFAULT 0,
+               daily_plan BIGINT DEFAULT 0,
+               state TEXT DEFAULT 'NEW',
+               created_at TIMESTAMPTZ DEFAULT now(),
+               timezone TEXT,
+               is_blocked INTEGER NOT NULL DEFAULT 0,
+               is_deactivated INTEGER NOT NULL DEFAULT 0,
+               failure_count INTEGER NOT NULL DEFAULT 0,
+               next_attempt_at TIMESTAMPTZ
+           )""",
+        """CREATE TABLE IF NOT EXISTS duas (
+               id BIGSERIAL PRIMARY KEY,
+               user_id BIGINT,
+               text TEXT NOT NULL,
+               sender_name TEXT NOT NULL,
+               is_anonymous INTEGER DEFAULT 0,
+               juma_week TEXT NOT NULL,
+               juma_key BIGINT NOT NULL,
+               created_at TIMESTAMPTZ DEFAULT now(),
+               delivered_at TIMESTAMPTZ
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_duas_juma_key_user ON duas (juma_key, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_duas_created_at ON duas (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_duas_undelivered ON duas (id) WHERE delivered_at IS NULL",
+        """CREATE TABLE IF NOT EXISTS marathons (
+               id BIGSERIAL PRIMARY KEY,
+               goal_amount BIGINT NOT NULL,
+               current_amount BIGINT NOT NULL DEFAULT 0,
+               start_date TEXT NOT NULL,
+               end_date TEXT NOT NULL,
+               is_active INTEGER DEFAULT 1,
+               created_at TIMESTAMPTZ DEFAULT now(),
+               archived_at TIMESTAMPTZ
+           )""",
+        """CREATE TABLE IF NOT EXISTS marathon_participants (
+               id BIGSERIAL PRIMARY KEY,
+               marathon_id BIGINT,
+               user_id BIGINT,
+               joined_at TIMESTAMPTZ DEFAULT now(),
+               UNIQUE (marathon_id, user_id)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_marathon_participants_user
+           ON marathon_participants (user_id, marathon_id)""",
+        """CREATE TABLE IF NOT EXISTS daily_completions (
+               id BIGSERIAL PRIMARY KEY,
+               user_id BIGINT,
+               marathon_id BIGINT,
+               completion_date TEXT NOT NULL,
+               is_completed INTEGER DEFAULT 0,
+               amount BIGINT DEFAULT 0,
+               created_at TIMESTAMPTZ DEFAULT now(),
+               UNIQUE (user_id, marathon_id, completion_date)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_daily_completions_marathon_date
+           ON daily_completions (marathon_id, completion_date) INCLUDE (is_completed, user_id, amount)""",
+        """CREATE TABLE IF NOT EXISTS daily_completions_archive (
+               id BIGINT PRIMARY KEY,
+               user_id BIGINT,
+               marathon_id BIGINT,
+               completion_date TEXT NOT NULL,
+               is_completed INTEGER DEFAULT 0,
+               amount BIGINT DEFAULT 0,
+               created_at TIMESTAMPTZ,
+               archived_at TIMESTAMPTZ DEFAULT now()
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_daily_completions_archive_marathon_user
+           ON daily_completions_archive (marathon_id, user_id)""",
+        """CREATE TABLE IF NOT EXISTS marathon_user_totals (
+               marathon_id BIGINT NOT NULL,
+               user_id BIGINT NOT NULL,
+               total_contribution BIGINT NOT NULL DEFAULT 0,
+               completed_days INTEGER NOT NULL DEFAULT 0,
+               total_days INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (marathon_id, user_id)
+           )""",
+        # Рейтинг: порядок по убыванию суммы, при равенстве - по user_id
+        """CREATE INDEX IF NOT EXISTS idx_marathon_user_totals_rank
+           ON marathon_user_totals (marathon_id, total_contribution DESC, user_id)""",
+        # Суммы марафона и итоги участника меняются в транзакции отметки;
+        # отметки архивных марафонов при переносе в архив их не меняют
+        """CREATE OR REPLACE FUNCTION daily_completions_totals() RETURNS trigger AS $$
+           BEGIN
+               IF TG_OP IN ('UPDATE', 'DELETE') AND NOT EXISTS (
+                   SELECT 1 FROM marathons WHERE id = OLD.marathon_id AND archived_at IS NOT NULL
+               ) THEN
+                   UPDATE marathons
+                   SET current_amount = current_amount
+                       - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END
+                   WHERE id = OLD.marathon_id;
+                   UPDATE marathon_user_totals SET
+                       total_contribution = total_contribution
+                           - CASE WHEN OLD.is_completed = 1 THEN OLD.amount ELSE 0 END,
+                       completed_days = completed_days
+                           - CASE WHEN OLD.is_completed = 1 THEN 1 ELSE 0 END,
+                       total_days = total_days - 1
+                   WHERE marathon_id = OLD.marathon_id AND user_id = OLD.user_id;
+               END IF;
+               IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                   UPDATE marathons
+                   SET current_amount = current_amount
+                       + CASE WHEN NEW.is_completed = 1 THEN NEW.amount ELSE 0 END
+                   WHERE id = NEW.marathon_id;
+                   INSERT INTO marathon_user_totals
+                       (marathon_id, user_id, total_contribution, completed_days, total_days)
+                   VALUES (
+                       NEW.marathon_id, NEW.user_id,
+                       CASE WHEN NEW.is_completed = 1 THEN NEW.amount ELSE 0 END,
+                       CASE WHEN NEW.is_completed = 1 THEN 1 ELSE 0 END,
+                       1
+                   )
+                   ON CONFLICT (marathon_id, user_id) DO UPDATE SET
+                       total_contribution = marathon_user_totals.total_contribution + EXCLUDED.total_contribution,
+                       completed_days = marathon_user_totals.completed_days + EXCLUDED.completed_days,
+                       total_days = marathon_user_totals.total_days + EXCLUDED.total_days;
+               END IF;
+               RETURN NULL;
+           END
+           $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS trg_daily_completions_totals ON daily_completions",
+        """CREATE TRIGGER trg_daily_completions_totals
+           AFTER INSERT OR DELETE OR UPDATE OF user_id, marathon_id, is_completed, amount
+           ON daily_completions
+           FOR EACH ROW EXECUTE FUNCTION daily_completions_totals()""",
+        """CREATE TABLE IF NOT EXISTS bot_messages (
+               id BIGSERIAL PRIMARY KEY,
+               user_id BIGINT NOT NULL,
+               chat_id BIGINT NOT NULL,
+               message_id BIGINT NOT NULL,
+               created_at TIMESTAMPTZ DEFAULT now()
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_bot_messages_user_chat
+           ON bot_messages (user_id, chat_id, id)""",
+        """CREATE INDEX IF NOT EXISTS idx_bot_messages_chat_message
+           ON bot_messages (chat_id, message_id)""",
+        "CREATE INDEX IF NOT EXISTS idx_bot_messages_created_at ON bot_messages (created_at)",
+        """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+               id BIGSERIAL PRIMARY KEY,
+               job_key TEXT NOT NULL UNIQUE,
+               kind TEXT NOT NULL,
+               payload TEXT,
+               status TEXT NOT NULL DEFAULT 'pending',
+               total INTEGER NOT NULL DEFAULT 0,
+               created_at TIMESTAMPTZ DEFAULT now(),
+               finished_at TIMESTAMPTZ
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status, id)",
+        """CREATE TABLE IF NOT EXISTS broadcast_recipients (
+               job_id BIGINT NOT NULL,
+               user_id BIGINT NOT NULL,
+               language TEXT,
+               status TEXT NOT NULL DEFAULT 'pending',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               updated_at TIMESTAMPTZ,
+               PRIMARY KEY (job_id, user_id)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+           ON broadcast_recipients (job_id, status, user_id)""",
+        """CREATE TABLE IF NOT EXISTS reminder_slots (
+               user_id BIGINT NOT NULL,
+               kind TEXT NOT NULL,
+               local_minute INTEGER NOT NULL,
+               utc_minute INTEGER NOT NULL,
+               utc_offset INTEGER NOT NULL,
+               PRIMARY KEY (user_id, kind)
+           )""",
+        """CREATE INDEX IF NOT EXISTS idx_reminder_slots_due
+           ON reminder_slots (utc_minute, kind, user_id)""",
+        """CREATE TABLE IF NOT EXISTS reminder_dispatch (
+               id INTEGER PRIMARY KEY CHECK (id = 1),
+               last_minute TIMESTAMPTZ NOT NULL
+           )""",
+        """CREATE TABLE IF NOT EXISTS fsm_states (
+               key TEXT PRIMARY KEY,
+               state TEXT,
+               data TEXT,
+               updated_at TIMESTAMPTZ DEFAULT now()
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+        """CREATE TABLE IF NOT EXISTS leases (
+               name TEXT PRIMARY KEY,
+               holder TEXT NOT NULL,
+               expires_at DOUBLE PRECISION NOT NULL
+           )""",
+    ]),
+]
+
+# Изменение состояния доставки пользователей по результату отправки ($1 - массив user_id)
+_DELIVERY_STATE_UPDATES = {
+    'sent': """UPDATE users SET failure_count = 0, next_attempt_at = NULL
+               WHERE user_id = ANY($1::bigint[]) AND failure_count > 0""",
+    'blocked': "UPDATE users SET is_blocked = 1 WHERE user_id = ANY($1::bigint[])",
+    'deactivated': "UPDATE users SET is_deactivated = 1 WHERE user_id = ANY($1::bigint[])",
+    # Задержка 10 минут, удваивается с каждой неудачей, но не больше суток
+    'failed': """UPDATE users SET
+                     failure_count = failure_count + 1,
+                     next_attempt_at = now() + make_interval(
+                         mins => LEAST(1440, 10 << LEAST(failure_count, 8))
+                     )
+                 WHERE user_id = ANY($1::bigint[])""",
+}
+
+# Пользователь доступен для рассылок: не заблокировал бота, аккаунт не удален
+# и не истекла задержка после временных ошибок доставки
+_REACHABLE = """u.is_blocked = 0 AND u.is_deactivated = 0
+        AND (u.next_attempt_at IS NULL OR u.next_attempt_at <= now())"""
+
+# Местная дата получателя в минуту $3 дня $5 (UTC): смещение пояса
+# переносит напоминание на предыдущие ($6) или следующие сутки ($7)
+_LOCAL_DATE = """CASE (rs.utc_minute + rs.utc_offset - rs.local_minute) / 1440
+                WHEN -1 THEN $6::text
+                WHEN 1 THEN $7::text
+                ELSE $5::text
+            END"""
+
+# Аудитории рассылок: имена параметров задания и запрос, возвращающий
+# user_id и language получателей. $1 - id задания, $2... - параметры по порядку
+_BROADCAST_AUDIENCES: Dict[str, Tuple[Tuple[str, ...], str]] = {
+    'all': ((), f"""
+        SELECT u.user_id, u.language
+        FROM users u
+        WHERE {_REACHABLE}"""),
+    'participants': (("marathon_id",), f"""
+        SELECT u.user_id, u.language
+        FROM marathon_participants mp
+        INNER JOIN users u ON u.user_id = mp.user_id
+        WHERE mp.marathon_id = $2::bigint AND {_REACHABLE}"""),
+    # Участники, еще не отметившие день $3
+    'without_completion': (("marathon_id", "date"), f"""
+        SELECT u.user_id, u.language
+        FROM marathon_participants mp
+        INNER JOIN users u ON u.user_id = mp.user_id
+        WHERE mp.marathon_id = $2::bigint AND {_REACHABLE}
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_completions dc
+            WHERE dc.user_id = mp.user_id
+            AND dc.marathon_id = mp.marathon_id
+            AND dc.completion_date = $3::text
+        )"""),
+    # Участники, чье напоминание $4 назначено на минуту $3;
+    # день для отметки - местная дата получателя в эту минуту (см. _LOCAL_DATE)
+    'due_participants': (("marathon_id", "utc_minute", "reminder_kind"), f"""
+        SELECT u.user_id, u.language
+        FROM reminder_slots rs
+        INNER JOIN marathon_participants mp
+            ON mp.marathon_id = $2::bigint AND mp.user_id = rs.user_id
+        INNER JOIN users u ON u.user_id = rs.user_id
+        WHERE rs.utc_minute = $3::int AND rs.kind = $4::text
+        AND {_REACHABLE}"""),
+    'due_without_completion': (
+        ("marathon_id", "utc_minute", "reminder_kind", "date", "previous_date", "next_date"), f"""
+        SELECT u.user_id, u.language
+        FROM reminder_slots rs
+        INNER JOIN marathon_participants mp
+            ON mp.marathon_id = $2::bigint AND mp.user_id = rs.user_id
+        INNER JOIN users u ON u.user_id = rs.user_id
+        WHERE rs.utc_minute = $3::int AND rs.kind = $4::text
+        AND {_REACHABLE}
+        AND NOT EXISTS (
+            SELECT 1 FROM daily_completions dc
+            WHERE dc.user_id = rs.user_id
+            AND dc.marathon_id = $2::bigint
+            AND dc.completion_date = {_LOCAL_DATE}
+        )"""),
+}
+
+# Сроки хранения: таблица, условие устаревания ($1 - срок в днях), срок (0 - не удалять)
+_RETENTION_POLICIES: List[Tuple[str, str, int]] = [
+    ("bot_messages", "created_at < now() - make_interval(days => $1)", BOT_MESSAGES_RETENTION_DAYS),
+    ("duas", "created_at < now() - make_interval(days => $1)", DUAS_RETENTION_DAYS),
+    ("broadcast_recipients",
+     """job_id IN (
+            SELECT id FROM broadcast_jobs
+            WHERE status = 'done' AND finished_at < now() - make_interval(days => $1)
+        )""",
+     BROADCAST_JOBS_RETENTION_DAYS),
+    ("broadcast_jobs",
+     """status = 'done' AND finished_at < now() - make_interval(days => $1)
+        AND NOT EXISTS (SELECT 1 FROM broadcast_recipients WHERE job_id = broadcast_jobs.id)""",
+     BROADCAST_JOBS_RETENTION_DAYS),
+    ("fsm_states", "updated_at < now() - make_interval(days => $1)", FSM_STATES_RETENTION_DAYS),
+]
+
+
+def _as_dict(record) -> Optional[dict]:
+    """Строка результата в том же виде, что и у SQLite: время - строкой в UTC"""
+    if record is None:
+        return None
+    row = dict(record)
+    for key, value in row.items():
+        if isinstance(value, datetime):
+            row[key] = value.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return row
+
+
+def _count(status: str) -> int:
+    """Количество строк из статуса команды asyncpg, например 'DELETE 42'"""
+    return int(status.split()[-1])
+
+
+class PostgresDatabase(Repository):
+    """Хранилище в PostgreSQL с пулом соединений asyncpg"""
+
+    multi_instance = True
+
+    def __init__(
+        self,
+        dsn: str,
+        min_pool_size: int = 2,
+        max_pool_size: int = 10,
+        message_buffer_size: int = 50,
+        dua_limit_per_user: int = 2,
+        dua_limit_total: int = 20
+    ):
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is required for PostgreSQL, install it with 'pip install -r requirements-postgres.txt'")
+        self.dsn = dsn
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        # Сколько последних сообщений бота на чат учитывать, как буфер у SQLite
+        self.message_buffer_size = message_buffer_size
+        self.dua_limit_per_user = dua_limit_per_user
+        self.dua_limit_total = dua_limit_total
+        self.pool: Optional["asyncpg.Pool"] = None
+        self.schema_version = 0
+
+    async def init_db(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_pool_size, max_size=self.max_pool_size)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("SELECT pg_advisory_xact_lock($1)", _MIGRATION_LOCK_ID)
+                await connection.execute(
+                    """CREATE TABLE IF NOT EXISTS schema_migrations (
+                           version INTEGER PRIMARY KEY,
+                           description TEXT NOT NULL,
+                           applied_at TIMESTAMPTZ DEFAULT now()
+                       )"""
+                )
+                version = await connection.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+                for migration_version, description, steps in POSTGRES_MIGRATIONS:
+                    if migration_version <= version:
+                        continue
+                    logger.info(f"Applying PostgreSQL schema migration {migration_version}: {description}")
+                    for step in steps:
+                        await connection.execute(step)
+                    await connection.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                        migration_version, description
+                    )
+                    version = migration_version
+        self.schema_version = version
+        logger.info(f"PostgreSQL pool opened: up to {self.max_pool_size} connections, schema version {version}")
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    # Users
+    async def get_user(self, user_id: int):
+        return _as_dict(await self.pool.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id))
+
+    async def create_user(self, user_id: int, username: str, first_name: str):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    "INSERT INTO users (user_id, username, first_name) VALUES ($1, $2, $3)",
+                    user_id, username, first_name
+                )
+                await connection.executemany(
+                    """INSERT INTO reminder_slots (user_id, kind, local_minute, utc_minute, utc_offset)
+                       VALUES ($1, $2, $3, $4, $5)
+                       ON CONFLICT DO NOTHING""",
+                    default_reminder_slots(user_id)
+                )
+
+    async def update_user_language(self, user_id: int, language: str):
+        await self.pool.execute("UPDATE users SET language = $1 WHERE user_id = $2", language, user_id)
+
+    async def update_user_state(self, user_id: int, state: str):
+        await self.pool.execute("UPDATE users SET state = $1 WHERE user_id = $2", state, user_id)
+
+    async def update_user_timezone(self, user_id: int, timezone: str):
+        if timezone not in pytz.all_timezones_set:
+            raise ValueError(f"Unknown timezone: {timezone}")
+        offset = utc_offset_minutes(timezone)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("UPDATE users SET timezone = $1 WHERE user_id = $2", timezone, user_id)
+                await connection.execute(
+                    """UPDATE reminder_slots
+                       SET utc_minute = (local_minute - $1 + 1440) % 1440, utc_offset = $1
+                       WHERE user_id = $2""",
+                    offset, user_id
+                )
+
+    async def update_reminder_window(self, user_id: int, kind: str, start: str, length: int):
+        check_reminder_kind(kind)
+        timezone = await self.pool.fetchval("SELECT timezone FROM users WHERE user_id = $1", user_id)
+        local_minute = spread_minute(user_id, parse_minute(start), length)
+        offset = utc_offset_minutes(timezone)
+        await self.pool.execute(
+            """INSERT INTO reminder_slots (user_id, kind, local_minute, utc_minute, utc_offset)
+               VALUES ($1, $2, $3, $4, $5)
+               ON CONFLICT (user_id, kind) DO UPDATE SET
+                   local_minute = EXCLUDED.local_minute,
+                   utc_minute = EXCLUDED.utc_minute,
+                   utc_offset = EXCLUDED.utc_offset""",
+            user_id, kind, local_minute, (local_minute - offset) % MINUTES_PER_DAY, offset
+        )
+
+    async def refresh_reminder_slots(self) -> int:
+        timezones = [row[0] for row in await self.pool.fetch("SELECT DISTINCT timezone FROM users")]
+        updated = 0
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                for timezone in timezones:
+                    offset = utc_offset_minutes(timezone)
+                    updated += _count(await connection.execute(
+                        """UPDATE reminder_slots
+                           SET utc_minute = (local_minute - $1 + 1440) % 1440, utc_offset = $1
+                           WHERE user_id IN (SELECT user_id FROM users WHERE timezone IS NOT DISTINCT FROM $2)
+                           AND utc_offset != $1""",
+                        offset, timezone
+                    ))
+        return updated
+
+    async def get_due_reminder_kinds(self, utc_minute: int) -> List[str]:
+        rows = await self.pool.fetch(
+            "SELECT DISTINCT kind FROM reminder_slots WHERE utc_minute = $1",
+            utc_minute
+        )
+        return [row[0] for row in rows]
+
+    async def get_last_reminder_minute(self) -> Optional[datetime]:
+        return await self.pool.fetchval("SELECT last_minute FROM reminder_dispatch WHERE id = 1")
+
+    async def set_last_reminder_minute(self, minute: datetime):
+        await self.pool.execute(
+            """INSERT INTO reminder_dispatch (id, last_minute) VALUES (1, $1)
+               ON CONFLICT (id) DO UPDATE SET last_minute = GREATEST(reminder_dispatch.last_minute, EXCLUDED.last_minute)""",
+            minute
+        )
+
+    async def mark_user_reachable(self, user_id: int):
+        await self.pool.execute(
+            """UPDATE users
+               SET is_blocked = 0, is_deactivated = 0, failure_count = 0, next_attempt_at = NULL
+               WHERE user_id = $1""",
+            user_id
+        )
+
+    async def update_user_daily_plan(self, user_id: int, daily_plan: int):
+        await self.pool.execute("UPDATE users SET daily_plan = $1 WHERE user_id = $2", daily_plan, user_id)
+
+    async def update_user_display_name(self, user_id: int, display_name: str, is_anonymous: bool):
+        await self.pool.execute(
+            "UPDATE users SET display_name = $1, is_anonymous = $2 WHERE user_id = $3",
+            display_name, 1 if is_anonymous else 0, user_id
+        )
+
+    # Duas
+    async def count_user_duas_this_juma(self, user_id: int) -> int:
+        return await self.pool.fetchval(
+            "SELECT COUNT(*) FROM duas WHERE user_id = $1 AND juma_key = $2",
+            user_id, self.get_current_juma_week()
+        )
+
+    async def count_total_duas_this_juma(self) -> int:
+        return await self.pool.fetchval(
+            "SELECT COUNT(*) FROM duas WHERE juma_key = $1",
+            self.get_current_juma_week()
+        )
+
+    async def add_dua(self, user_id: int, text: str, sender_name: str, is_anonymous: bool) -> Optional[str]:
+        """Сохранить дуа, если лимиты недели позволяют; иначе вернуть причину отказа"""
+        juma_week = self.get_current_juma_week()
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                # Дуа одной недели добавляются по очереди, поэтому лимит нельзя превысить
+                await connection.execute("SELECT pg_advisory_xact_lock(hashtext($1))", f"duas:{juma_week}")
+                row = await connection.fetchrow(
+                    """SELECT COUNT(*) FILTER (WHERE user_id = $1), COUNT(*)
+                       FROM duas WHERE juma_key = $2""",
+                    user_id, juma_week
+                )
+                if row[0] >= self.dua_limit_per_user:
+                    return LIMIT_USER
+                if row[1] >= self.dua_limit_total:
+                    return LIMIT_TOTAL
+                await connection.execute(
+                    """INSERT INTO duas (user_id, text, sender_name, is_anonymous, juma_week, juma_key)
+                       VALUES ($1, $2, $3, $4, $5, $6)""",
+                    user_id, text, sender_name, 1 if is_anonymous else 0,
+                    juma_friday(juma_week).isoformat(), juma_week
+                )
+        return None
+
+    async def get_total_duas_count(self) -> int:
+        return await self.pool.fetchval("SELECT COUNT(*) FROM duas")
+
+    async def get_undelivered_duas(self, limit: int = 200) -> List[dict]:
+        rows = await self.pool.fetch(
+            """SELECT id, user_id, text, sender_name, is_anonymous, created_at
+               FROM duas
+               WHERE delivered_at IS NULL
+               ORDER BY id LIMIT $1""",
+            limit
+        )
+        return [_as_dict(row) for row in rows]
+
+    async def mark_duas_delivered(self, dua_ids: List[int]):
+        if dua_ids:
+            await self.pool.execute(
+                "UPDATE duas SET delivered_at = now() WHERE id = ANY($1::bigint[])",
+                list(dua_ids)
+            )
+
+    # Marathons
+    async def create_marathon(self, goal_amount: int, start_date: str, end_date: str):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                await connection.execute("UPDATE marathons SET is_active = 0 WHERE is_active = 1")
+                return await connection.fetchval(
+                    """INSERT INTO marathons (goal_amount, start_date, end_date, is_active, current_amount)
+                       VALUES ($1, $2, $3, 1, 0)
+                       RETURNING id""",
+                    goal_amount, start_date, end_date
+                )
+
+    async def get_active_marathon(self) -> Optional[dict]:
+        return _as_dict(await self.pool.fetchrow("SELECT * FROM marathons WHERE is_active = 1 LIMIT 1"))
+
+    async def join_marathon(self, user_id: int, marathon_id: int):
+        await self.pool.execute(
+            """INSERT INTO marathon_participants (marathon_id, user_id)
+               VALUES ($1, $2)
+               ON CONFLICT DO NOTHING""",
+            marathon_id, user_id
+        )
+
+    async def get_user_marathon_stats(self, user_id: int, marathon_id: int) -> dict:
+        row = await self.pool.fetchrow(
+            """SELECT total_contribution, completed_days, total_days
+               FROM marathon_user_totals
+               WHERE user_id = $1 AND marathon_id = $2""",
+            user_id, marathon_id
+        )
+        if not row:
+            return {'total_contribution': 0, 'completed_days': 0, 'total_days': 0}
+        return {
+            'total_contribution': row[0] or 0,
+            'completed_days': row[1] or 0,
+            'total_days': row[2] or 0
+        }
+
+    async def mark_day_completed(self, user_id: int, marathon_id: int, date: str, amount: int):
+        await self._save_completion(user_id, marathon_id, date, True, amount)
+
+    async def mark_day_not_completed(self, user_id: int, marathon_id: int, date: str):
+        await self._save_completion(user_id, marathon_id, date, False, 0)
+
+    async def _save_completion(self, user_id: int, marathon_id: int, date: str, is_completed: bool, amount: int):
+        # Триггер применяет разницу к сумме марафона и итогам участника в той же транзакции
+        await self.pool.execute(
+            """INSERT INTO daily_completions
+               (user_id, marathon_id, completion_date, is_completed, amount)
+               VALUES ($1, $2, $3, $4, $5)
+               ON CONFLICT (user_id, marathon_id, completion_date)
+               DO UPDATE SET is_completed = EXCLUDED.is_completed, amount = EXCLUDED.amount""",
+            user_id, marathon_id, date, 1 if is_completed else 0, amount
+        )
+
+    async def reconcile_marathon_totals(self) -> List[dict]:
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                # Отметки не меняются, пока идет сверка
+                await connection.execute("LOCK TABLE daily_completions IN SHARE MODE")
+                rows = await connection.fetch(
+                    """UPDATE marathons m SET current_amount = t.actual
+                       FROM (
+                           SELECT m2.id, m2.current_amount AS stored, COALESCE(SUM(dc.amount), 0) AS actual
+                           FROM marathons m2
+                           LEFT JOIN daily_completions dc
+                               ON dc.marathon_id = m2.id AND dc.is_completed = 1
+                           WHERE m2.archived_at IS NULL
+                           GROUP BY m2.id
+                       ) t
+                       WHERE m.id = t.id AND m.current_amount != t.actual
+                       RETURNING m.id, t.stored, t.actual"""
+                )
+                drifts = [{'marathon_id': row['id'], 'stored': row['stored'], 'actual': row['actual']} for row in rows]
+
+                rows = await connection.fetch(
+                    """WITH archived AS (
+                           SELECT id FROM marathons WHERE archived_at IS NOT NULL
+                       ), actual AS (
+                           SELECT marathon_id, user_id,
+                                  COALESCE(SUM(amount) FILTER (WHERE is_completed = 1), 0) AS total,
+                                  COUNT(*) FILTER (WHERE is_completed = 1) AS completed,
+                                  COUNT(*) AS days
+                           FROM daily_completions
+                           WHERE marathon_id NOT IN (SELECT id FROM archived)
+                           GROUP BY marathon_id, user_id
+                       ), stored AS (
+                           SELECT * FROM marathon_user_totals
+                           WHERE marathon_id NOT IN (SELECT id FROM archived)
+                       )
+                       SELECT COALESCE(a.marathon_id, s.marathon_id) AS marathon_id,
+                              COALESCE(a.user_id, s.user_id) AS user_id,
+                              COALESCE(s.total_contribution, 0) AS stored,
+                              COALESCE(a.total, 0) AS actual,
+                              a.completed, a.days,
+                              a.user_id IS NOT NULL AS present
+                       FROM actual a
+                       FULL JOIN stored s ON s.marathon_id = a.marathon_id AND s.user_id = a.user_id
+                       WHERE (COALESCE(a.total, 0), COALESCE(a.completed, 0), COALESCE(a.days, 0))
+                           IS DISTINCT FROM
+                           (COALESCE(s.total_contribution, 0), COALESCE(s.completed_days, 0), COALESCE(s.total_days, 0))"""
+                )
+                for row in rows:
+                    drifts.append({
+                        'marathon_id': row['marathon_id'],
+                        'user_id': row['user_id'],
+                        'stored': row['stored'],
+                        'actual': row['actual']
+                    })
+                    if row['present']:
+                        await connection.execute(
+                            """INSERT INTO marathon_user_totals
+                               (marathon_id, user_id, total_contribution, completed_days, total_days)
+                               VALUES ($1, $2, $3, $4, $5)
+                               ON CONFLICT (marathon_id, user_id) DO UPDATE SET
+                                   total_contribution = EXCLUDED.total_contribution,
+                                   completed_days = EXCLUDED.completed_days,
+                                   total_days = EXCLUDED.total_days""",
+                            row['marathon_id'], row['user_id'], row['actual'], row['completed'], row['days']
+                        )
+                    else:
+                        await connection.execute(
+                            "DELETE FROM marathon_user_totals WHERE marathon_id = $1 AND user_id = $2",
+                            row['marathon_id'], row['user_id']
+                        )
+        return drifts
+
+    async def get_user_daily_completions(self, user_id: int, marathon_id: int, year: int, month: int) -> Dict[int, str]:
+        last_day = ((date(year + month // 12, month % 12 + 1, 1)) - timedelta(days=1)).day
+        rows = await self.pool.fetch(
+            """SELECT completion_date, is_completed
+               FROM daily_completions
+               WHERE user_id = $1 AND marathon_id = $2
+               AND completion_date >= $3 AND completion_date <= $4
+               ORDER BY completion_date""",
+            user_id, marathon_id, f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day:02d}"
+        )
+        return {
+            int(row['completion_date'].split('-')[2]): "completed" if row['is_completed'] == 1 else "not_completed"
+            for row in rows
+        }
+
+    async def get_marathon_stats(self, marathon_id: int) -> dict:
+        row = await self.pool.fetchrow(
+            """SELECT m.goal_amount, m.current_amount,
+                      (SELECT COUNT(*) FROM marathon_participants WHERE marathon_id = m.id) AS participants_count
+               FROM marathons m
+               WHERE m.id = $1""",
+            marathon_id
+        )
+        if not row:
+            return {'total_collected': 0, 'participants_count': 0, 'percent': 0}
+        current_amount = row['current_amount'] or 0
+        goal_amount = row['goal_amount']
+        return {
+            'total_collected': current_amount,
+            'participants_count': row['participants_count'],
+            'percent': int((current_amount / goal_amount * 100)) if goal_amount > 0 else 0
+        }
+
+    async def get_daily_global_stats(self, marathon_id: int, date: str) -> dict:
+        row = await self.pool.fetchrow(
+            """SELECT COALESCE(SUM(amount), 0), COUNT(DISTINCT user_id)
+               FROM daily_completions
+               WHERE marathon_id = $1 AND completion_date = $2 AND is_completed = 1""",
+            marathon_id, date
+        )
+        return {'total_amount': row[0] or 0, 'participants_count': row[1] or 0}
+
+    # Statistics
+    async def get_total_users_count(self) -> int:
+        return await self.pool.fetchval("SELECT COUNT(*) FROM users")
+
+    async def get_unreachable_users_count(self) -> Dict[str, int]:
+        row = await self.pool.fetchrow(
+            """SELECT
+                   COUNT(*) FILTER (WHERE is_blocked = 1),
+                   COUNT(*) FILTER (WHERE is_deactivated = 1 AND is_blocked = 0),
+                   COUNT(*) FILTER (WHERE is_blocked = 0 AND is_deactivated = 0 AND next_attempt_at > now())
+               FROM users"""
+        )
+        return {'blocked': row[0], 'deactivated': row[1], 'backoff': row[2]}
+
+    async def get_total_marathons_count(self) -> int:
+        return await self.pool.fetchval("SELECT COUNT(*) FROM marathons")
+
+    async def get_total_donations_amount(self) -> int:
+        return int(await self.pool.fetchval("SELECT COALESCE(SUM(current_amount), 0) FROM marathons"))
+
+    # Leaderboard
+    async def verify_leaderboard(self) -> List[int]:
+        """Рейтинг считается из marathon_user_totals при каждом запросе, сверять нечего"""
+        return []
+
+    async def get_marathon_top(self, marathon_id: int, limit: int = 10) -> List[Tuple[int, int, int]]:
+        rows = await self.pool.fetch(
+            """SELECT rank() OVER (ORDER BY total_contribution DESC), user_id, total_contribution
+               FROM marathon_user_totals
+               WHERE marathon_id = $1
+               ORDER BY total_contribution DESC, user_id
+               LIMIT $2""",
+            marathon_id, limit
+        )
+        return [tuple(row) for row in rows]
+
+    async def get_marathon_neighbours(self, user_id: int, marathon_id: int, radius: int = 2) -> List[Tuple[int, int, int]]:
+        rows = await self.pool.fetch(
+            """WITH ranked AS (
+                   SELECT user_id, total_contribution,
+                          rank() OVER (ORDER BY total_contribution DESC) AS place,
+                          row_number() OVER (ORDER BY total_contribution DESC, user_id) AS position
+                   FROM marathon_user_totals
+                   WHERE marathon_id = $1
+               )
+               SELECT place, user_id, total_contribution
+               FROM ranked
+               WHERE position BETWEEN
+                   (SELECT position FROM ranked WHERE user_id = $2) - $3
+                   AND (SELECT position FROM ranked WHERE user_id = $2) + $3
+               ORDER BY position""",
+            marathon_id, user_id, radius
+        )
+        return [tuple(row) for row in rows]
+
+    async def get_marathon_ranking(self, user_id: int, marathon_id: int) -> Tuple[int, int]:
+        row = await self.pool.fetchrow(
+            """WITH me AS (
+                   SELECT COALESCE(
+                       (SELECT total_contribution FROM marathon_user_totals
+                        WHERE marathon_id = $1 AND user_id = $2), 0
+                   ) AS total
+               )
+               SELECT (SELECT COUNT(*) FROM marathon_user_totals
+                       WHERE marathon_id = $1 AND total_contribution > me.total) + 1,
+                      me.total
+               FROM me""",
+            marathon_id, user_id
+        )
+        return row[0], row[1]
+
+    # Broadcast queue
+    async def create_broadcast_job(
+        self,
+        job_key: str,
+        kind: str,
+        audience: str,
+        payload: Optional[dict] = None,
+        **parameters
+    ) -> Optional[int]:
+        names, audience_query = _BROADCAST_AUDIENCES[audience]
+        arguments = [parameters[name] for name in names]
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                job_id = await connection.fetchval(
+                    """INSERT INTO broadcast_jobs (job_key, kind, payload)
+                       VALUES ($1, $2, $3)
+                       ON CONFLICT (job_key) DO NOTHING
+                       RETURNING id""",
+                    job_key, kind, json.dumps(payload) if payload is not None else None
+                )
+                if job_id is None:
+                    return None
+                total = _count(await connection.execute(
+                    f"""INSERT INTO broadcast_recipients (job_id, user_id, language)
+                        SELECT $1::bigint, user_id, language FROM ({audience_query}) AS audience""",
+                    job_id, *arguments
+                ))
+                await connection.execute("UPDATE broadcast_jobs SET total = $1 WHERE id = $2", total, job_id)
+                return job_id
+
+    async def get_unfinished_broadcast_jobs(self, reset_claimed: bool = True) -> List[dict]:
+        if reset_claimed:
+            await self.pool.execute(
+                """UPDATE broadcast_recipients SET status = 'pending'
+                   WHERE status = 'claimed' AND job_id IN (
+                       SELECT id FROM broadcast_jobs WHERE status = 'pending'
+                   )"""
+            )
+        rows = await self.pool.fetch(
+            """SELECT id, job_key, kind, payload, total
+               FROM broadcast_jobs
+               WHERE status = 'pending'
+               ORDER BY id"""
+        )
+        return [self._broadcast_job_from_row(row) for row in rows]
+
+    async def get_broadcast_job(self, job_id: int) -> Optional[dict]:
+        row = await self.pool.fetchrow(
+            "SELECT id, job_key, kind, payload, total FROM broadcast_jobs WHERE id = $1",
+            job_id
+        )
+        return self._broadcast_job_from_row(row) if row else None
+
+    @staticmethod
+    def _broadcast_job_from_row(row) -> dict:
+        job = dict(row)
+        job['payload'] = json.loads(job['payload']) if job['payload'] else {}
+        return job
+
+    async def count_pending_broadcast_recipients(self, job_id: int) -> int:
+        return await self.pool.fetchval(
+            "SELECT COUNT(*) FROM broadcast_recipients WHERE job_id = $1 AND status = 'pending'",
+            job_id
+        )
+
+    async def claim_broadcast_recipients(self, job_id: int, limit: int) -> List[dict]:
+        # SKIP LOCKED: несколько рассыльщиков одного задания не захватят одних и тех же получателей
+        rows = await self.pool.fetch(
+            """UPDATE broadcast_recipients r
+               SET status = 'claimed', attempts = r.attempts + 1
+               FROM (
+                   SELECT user_id FROM broadcast_recipients
+                   WHERE job_id = $1 AND status = 'pending'
+                   ORDER BY user_id LIMIT $2
+                   FOR UPDATE SKIP LOCKED
+               ) claimed
+               WHERE r.job_id = $1 AND r.user_id = claimed.user_id
+               RETURNING r.user_id, r.language""",
+            job_id, limit
+        )
+        return [dict(row) for row in rows]
+
+    async def record_broadcast_results(self, job_id: int, results: Dict[str, list]):
+        results = {outcome: user_ids for outcome, user_ids in results.items() if user_ids}
+        if not results:
+            return
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                for outcome, user_ids in results.items():
+                    await connection.execute(
+                        """UPDATE broadcast_recipients
+                           SET status = $1, updated_at = now()
+                           WHERE job_id = $2 AND user_id = ANY($3::bigint[])""",
+                        outcome, job_id, user_ids
+                    )
+                    delivery_update = _DELIVERY_STATE_UPDATES.get(outcome)
+                    if delivery_update:
+                        await connection.execute(delivery_update, user_ids)
+
+    async def finish_broadcast_job(self, job_id: int):
+        await self.pool.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = now() WHERE id = $1",
+            job_id
+        )
+
+    # Multi-process methods
+    async def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        now = time.time()
+        row = await self.pool.fetchrow(
+            """INSERT INTO leases (name, holder, expires_at) VALUES ($1, $2, $3)
+               ON CONFLICT (name) DO UPDATE SET
+                   holder = EXCLUDED.holder,
+                   expires_at = EXCLUDED.expires_at
+               WHERE leases.holder = EXCLUDED.holder OR leases.expires_at < $4
+               RETURNING holder""",
+            name, holder, now + ttl, now
+        )
+        return row is not None
+
+    async def release_lease(self, name: str, holder: str):
+        await self.pool.execute("DELETE FROM leases WHERE name = $1 AND holder = $2", name, holder)
+
+    # Bot messages management methods
+    async def add_bot_message(self, user_id: int, chat_id: int, message_id: int):
+        await self.pool.execute(
+            "INSERT INTO bot_messages (user_id, chat_id, message_id) VALUES ($1, $2, $3)",
+            user_id, chat_id, message_id
+        )
+
+    async def get_bot_messages(self, user_id: int, chat_id: int) -> List[dict]:
+        rows = await self.pool.fetch(
+            """SELECT message_id, created_at FROM (
+                   SELECT id, message_id,
+                          to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS') AS created_at
+                   FROM bot_messages
+                   WHERE user_id = $1 AND chat_id = $2
+                   ORDER BY id DESC
+                   LIMIT $3
+               ) latest
+               ORDER BY id""",
+            user_id, chat_id, self.message_buffer_size
+        )
+        return [dict(row) for row in rows]
+
+    async def remove_bot_messages(self, message_ids: list, chat_id: Optional[int] = None):
+        if not message_ids:
+            return
+        await self.pool.execute(
+            """DELETE FROM bot_messages
+               WHERE message_id = ANY($1::bigint[]) AND ($2::bigint IS NULL OR chat_id = $2)""",
+            list(message_ids), chat_id
+        )
+
+    async def clear_old_bot_messages(self, days: int = 7):
+        await self.pool.execute(
+            "DELETE FROM bot_messages WHERE created_at < now() - make_interval(days => $1)",
+            days
+        )
+
+    # FSM states
+    async def load_fsm_state(self, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        row = await self.pool.fetchrow("SELECT state, data FROM fsm_states WHERE key = $1", key)
+        return (row[0], row[1]) if row else None
+
+    async def save_fsm_states(self, upserts: List[Tuple[str, Optional[str], str]], deletes: List[str]):
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if deletes:
+                    await connection.execute("DELETE FROM fsm_states WHERE key = ANY($1::text[])", deletes)
+                if upserts:
+                    await connection.executemany(
+                        """INSERT INTO fsm_states (key, state, data, updated_at)
+                           VALUES ($1, $2, $3, now())
+                           ON CONFLICT (key) DO UPDATE SET
+                               state = EXCLUDED.state,
+                               data = EXCLUDED.data,
+                               updated_at = EXCLUDED.updated_at""",
+                        upserts
+                    )
+
+    # Maintenance
+    async def run_maintenance(self, batch_size: Optional[int] = None) -> Dict[str, object]:
+        """Очистка по срокам хранения, архивирование марафонов и ANALYZE.
+
+        Место освобождает autovacuum, поэтому VACUUM FULL не выполняется.
+        """
+        batch_size = batch_size or MAINTENANCE_BATCH_SIZE
+        started = time.monotonic()
+        size_before = await self.pool.fetchval("SELECT pg_database_size(current_database())")
+
+        report: Dict[str, object] = {'deleted': {}}
+        for table, condition, days in _RETENTION_POLICIES:
+            if days <= 0:
+                continue
+            deleted = 0
+            while True:
+                count = _count(await self.pool.execute(
+                    f"""DELETE FROM {table} WHERE ctid = ANY(ARRAY(
+                            SELECT ctid FROM {table} WHERE {condition} LIMIT $2
+                        ))""",
+                    days, batch_size
+                ))
+                deleted += count
+                if count < batch_size:
+                    break
+            if deleted:
+                logger.info(f"Retention: deleted {deleted} rows from {table}")
+            report['deleted'][table] = deleted
+
+        report['archived'] = await self._archive_closed_marathons(ARCHIVE_MARATHONS_AFTER_DAYS, batch_size)
+        await self.pool.execute("ANALYZE")
+
+        size_after = await self.pool.fetchval("SELECT pg_database_size(current_database())")
+        report['bytes_reclaimed'] = size_before - size_after
+        report['seconds'] = round(time.monotonic() - started, 2)
+        logger.info(f"Database maintenance finished in {report['seconds']}s: {report}")
+        return report
+
+    async def _archive_closed_marathons(self, after_days: int, batch_size: int) -> Dict[int, int]:
+        """Перенести отметки завершенных марафонов в архив, не меняя их сумм"""
+        await self.pool.execute(
+            """UPDATE marathons SET archived_at = now()
+               WHERE archived_at IS NULL AND is_active = 0
+               AND end_date < to_char(current_date - $1::int, 'YYYY-MM-DD')""",
+            after_days
+        )
+        marathon_ids = [row[0] for row in await self.pool.fetch(
+            "SELECT id FROM marathons WHERE archived_at IS NOT NULL"
+        )]
+
+        archived = {}
+        for marathon_id in marathon_ids:
+            moved = 0
+            while True:
+                count = await self.pool.fetchval(
+                    """WITH moved AS (
+                           DELETE FROM daily_completions
+                           WHERE id IN (SELECT id FROM daily_completions WHERE marathon_id = $1 LIMIT $2)
+                           RETURNING id, user_id, marathon_id, completion_date, is_completed, amount, created_at
+                       ), saved AS (
+                           INSERT INTO daily_completions_archive
+                               (id, user_id, marathon_id, completion_date, is_completed, amount, created_at)
+                           SELECT * FROM moved
+                           ON CONFLICT (id) DO NOTHING
+                       )
+                       SELECT COUNT(*) FROM moved""",
+                    marathon_id, batch_size
+                )
+                moved += count
+                if count < batch_size:
+                    break
+            if moved:
+                logger.info(f"Archived {moved} daily completions of marathon {marathon_id}")
+                archived[marathon_id] = moved
+        return archived
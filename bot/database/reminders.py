@@ -0,0 +1,82 @@
+"""
+Расписание напоминаний пользователей.
+
+Для каждого пользователя и вида напоминания хранится минута суток по его
+местному времени и соответствующая ей минута UTC. Диспетчер раз в минуту
+выбирает по индексу (utc_minute, kind) пользователей, чье время наступило.
+Время внутри окна выбирается по хэшу user_id, поэтому напоминания
+распределены по окну равномерно, а не приходят всем в одну минуту.
+Смещение пояса utc_offset хранится вместе со слотом, чтобы по минуте UTC
+можно было определить местную дату получателя.
+"""
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+import pytz
+
+from bot.config import DEFAULT_TIMEZONE, REMINDER_WINDOWS
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def parse_minute(value: str) -> int:
+    """Минута суток из строки HH:MM"""
+    hours, minutes = value.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def get_timezone(name: Optional[str]):
+    """Часовой пояс по имени, при неизвестном имени - пояс по умолчанию"""
+    try:
+        return pytz.timezone(name or DEFAULT_TIMEZONE)
+    except pytz.UnknownTimeZoneError:
+        return pytz.timezone(DEFAULT_TIMEZONE)
+
+
+def utc_offset_minutes(timezone_name: Optional[str], at: Optional[datetime] = None) -> int:
+    """Смещение часового пояса от UTC в минутах на момент at (без пояса - время UTC)"""
+    at = at or datetime.now(pytz.utc)
+    if at.tzinfo is None:
+        at = pytz.utc.localize(at)
+    offset = at.astimezone(get_timezone(timezone_name)).utcoffset()
+    return int(offset.total_seconds() // 60)
+
+
+def local_date(timezone_name: Optional[str], at: Optional[datetime] = None) -> str:
+    """Дата YYYY-MM-DD в часовом поясе пользователя на момент at (по умолчанию - сейчас)"""
+    at = at or datetime.now(pytz.utc)
+    if at.tzinfo is None:
+        at = pytz.utc.localize(at)
+    return at.astimezone(get_timezone(timezone_name)).strftime("%Y-%m-%d")
+
+
+def check_reminder_kind(kind: str):
+    """Проверить, что для вида напоминания есть окно в REMINDER_WINDOWS"""
+    if kind not in REMINDER_WINDOWS:
+        raise ValueError(f"Unknown reminder kind: {kind}")
+
+
+def spread_minute(user_id: int, window_start: int, window_length: int) -> int:
+    """Минута внутри окна, стабильно выбранная по user_id"""
+    if window_length <= 1:
+        return window_start % MINUTES_PER_DAY
+    # Мультипликативный хэш Кнута; остаток по модулю ограничивает произведение 64 битами
+    position = (user_id % 1000003) * 2654435761 % window_length
+    return (window_start + position) % MINUTES_PER_DAY
+
+
+def default_reminder_slots(
+    user_id: int,
+    timezone_name: Optional[str] = None,
+    kinds: Iterable[str] = REMINDER_WINDOWS
+) -> List[Tuple[int, str, int, int, int]]:
+    """Строки reminder_slots по окнам по умолчанию:
+    (user_id, kind, local_minute, utc_minute, utc_offset)
+    """
+    offset = utc_offset_minutes(timezone_name)
+    slots = []
+    for kind in kinds:
+        start, length = REMINDER_WINDOWS[kind]
+        local_minute = spread_minute(user_id, parse_minute(start), length)
+        slots.append((user_id, kind, local_minute, (local_minute - offset) % MINUTES_PER_DAY, offset))
+    return slots
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+import aiosqlite
+
+from bot.database.pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+WriteOperation = Callable[[aiosqlite.Connection], Awaitable[Any]]
+
+
+class WriteQueue:
+    """Единственный писатель в базу данных.
+
+    Все операции записи ставятся в очередь и выполняются отдельной задачей
+    через одно выделенное соединение. Операции, накопившиеся в очереди,
+    объединяются в одну транзакцию (group commit): каждая выполняется внутри
+    своего SAVEPOINT, поэтому ошибка одной операции не откатывает остальные.
+    Операции вне транзакции (VACUUM, контрольная точка WAL) выполняются
+    по одной между транзакциями.
+    """
+
+    def __init__(self, db_path: str, pragmas: Optional[Dict[str, object]] = None, max_batch: int = 64):
+        self.max_batch = max(1, max_batch)
+        self._pool = ConnectionPool(db_path, size=1, pragmas=pragmas)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Открыть соединение писателя и запустить задачу записи"""
+        if self.is_running:
+            return
+        await self._pool.open()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(), name="database-writer")
+
+    async def stop(self):
+        """Дописать очередь и остановить писателя"""
+        if not self.is_running:
+            await self._pool.close()
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        await self._pool.close()
+
+    async def submit(self, operation: WriteOperation, transaction: bool = True) -> Any:
+        """Выполнить операцию записи и дождаться фиксации транзакции.
+
+        transaction=False - выполнить операцию отдельно, вне транзакции.
+        """
+        if not self.is_running:
+            raise RuntimeError("Database writer is not running, call Database.init_db() first")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, future, transaction))
+        return await future
+
+    async def execute(self, sql: str, parameters: Iterable[Any] = ()) -> int:
+        """Выполнить один SQL-запрос записи, вернуть количество измененных строк"""
+        async def operation(db: aiosqlite.Connection) -> int:
+            async with db.execute(sql, parameters) as cursor:
+                return cursor.rowcount
+
+        return await self.submit(operation)
+
+    async def _run(self):
+        async with self._pool.acquire() as db:
+            stopping = False
+            while not stopping:
+                item = await self._queue.get()
+                batch = []
+                while item is not None:
+                    batch.append(item)
+                    if len(batch) >= self.max_batch or self._queue.empty():
+                        break
+                    item = self._queue.get_nowait()
+                stopping = item is None
+                try:
+                    await self._run_batch(db, batch)
+                except Exception as e:
+                    # Сбой BEGIN/COMMIT/ROLLBACK не должен останавливать писателя:
+                    # вызывающие получают ошибку, очередь продолжает обрабатываться
+                    logger.exception(f"Database writer failed on a batch of {len(batch)} operations: {e}")
+                    await self._rollback(db)
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+    async def _run_batch(self, db: aiosqlite.Connection, batch: list):
+        """Зафиксировать операции группами, выполняя операции вне транзакции отдельно"""
+        group = []
+        for operation, future, transaction in batch:
+            if transaction:
+                group.append((operation, future))
+                continue
+            if group:
+                await self._commit_batch(db, group)
+                group = []
+            await self._run_standalone(db, operation, future)
+        if group:
+            await self._commit_batch(db, group)
+
+    async def _run_standalone(self, db: aiosqlite.Connection, operation: WriteOperation, future: asyncio.Future):
+        try:
+            result = await operation(db)
+        except Exception as e:
+            await self._rollback(db)
+            if not future.cancelled():
+                future.set_exception(e)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
+
+    async def _commit_batch(self, db: aiosqlite.Connection, batch: list):
+        results = []
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            for operation, future in batch:
+                await db.execute("SAVEPOINT write_op")
+                try:
+                    result = await operation(db)
+                except Exception as e:
+                    await db.execute("ROLLBACK TO write_op")
+                    await db.execute("RELEASE write_op")
+                    results.append((future, None, e))
+                else:
+                    await db.execute("RELEASE write_op")
+                    results.append((future, result, None))
+            await db.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Database write batch of {len(batch)} operations failed: {e}")
+            await self._rollback(db)
+            results = [(future, None, e) for _, future in batch]
+
+        for future, result, error in results:
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    async def _rollback(db: aiosqlite.Connection):
+        """Закрыть незавершенную транзакцию; ошибка ROLLBACK только логируется"""
+        if not db.in_transaction:
+            return
+        try:
+            await db.execute("ROLLBACK")
+        except Exception as e:
+            logger.error(f"Failed to roll back database writer transaction: {e}")
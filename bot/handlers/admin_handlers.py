@@ -5,9 +5,10 @@ from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from bot.states import UserStates
-from bot.database.models import Database
+from bot.database.base import Repository
 from bot.locales.texts import get_text
 from bot.config import ADMIN_PASSWORD
+from bot.utils.outbox import get_outbox, register_message_builder
 
 router = Router()
 
@@ -21,7 +22,7 @@ async def cmd_admin(message: Message, state: FSMContext):
 
 
 @router.message(UserStates.ADMIN_MODE)
-async def check_admin_password(message: Message, state: FSMContext, db: Database):
+async def check_admin_password(message: Message, state: FSMContext, db: Repository):
     """Проверка пароля администратора"""
     data = await state.get_data()
 
@@ -39,12 +40,13 @@ async def check_admin_password(message: Message, state: FSMContext, db: Database
         await state.clear()
 
 
-async def show_admin_menu(message: Message, db: Database):
+async def show_admin_menu(message: Message, db: Repository):
     """Показать меню администратора"""
     builder = InlineKeyboardBuilder()
     builder.button(text="Добавить марафон", callback_data="admin_add_marathon")
     builder.button(text="Статистика марафона", callback_data="admin_marathon_stats")
     builder.button(text="Общая статистика", callback_data="admin_general_stats")
+    builder.button(text="Сверка сумм", callback_data="admin_reconcile")
     builder.button(text="Выход", callback_data="admin_exit")
     builder.adjust(1)
 
@@ -55,7 +57,7 @@ async def show_admin_menu(message: Message, db: Database):
 
 
 @router.callback_query(F.data == "admin_add_marathon")
-async def admin_add_marathon(callback: CallbackQuery, state: FSMContext, db: Database):
+async def admin_add_marathon(callback: CallbackQuery, state: FSMContext, db: Repository):
     """Начать процесс добавления марафона"""
     # Проверяем, есть ли активный марафон
     active_marathon = await db.get_active_marathon()
@@ -91,7 +93,7 @@ async def admin_confirm_add_marathon(callback: CallbackQuery, state: FSMContext)
     await callback.answer()
 
 
-async def handle_admin_input(message: Message, state: FSMContext, db: Database):
+async def handle_admin_input(message: Message, state: FSMContext, db: Repository):
     """Обработка текстового ввода от администратора"""
     data = await state.get_data()
     action = data.get("admin_action")
@@ -131,39 +133,42 @@ async def handle_admin_input(message: Message, state: FSMContext, db: Database):
             await message.answer("Неверный формат. Введите число:")
 
 
-async def notify_all_users_about_marathon(db: Database, goal_amount: int):
+async def notify_all_users_about_marathon(db: Repository, goal_amount: int):
     """Отправить уведомление всем пользователям о новом марафоне"""
     marathon = await db.get_active_marathon()
     if not marathon:
         return
-    
-    users = await db.get_all_users()
-    
+
     from bot import bot
-    from bot.locales.texts import get_text
-    
-    for user in users:
-        user_id = user['user_id']
-        language = user.get('language', 'uz_latin')
-        
-        notification_text = get_text(
-            language,
+
+    # Рассылка идет в фоне; ключ задания не дает повторить ее для того же марафона
+    await get_outbox(bot, db).enqueue(
+        f"new_marathon:{marathon['id']}",
+        "new_marathon",
+        "all",
+        payload={
+            'goal': goal_amount,
+            'start_date': marathon.get('start_date', ''),
+            'end_date': marathon.get('end_date', '')
+        }
+    )
+
+
+@register_message_builder("new_marathon")
+def build_new_marathon_message(language: str, payload: dict):
+    return {
+        'text': get_text(
+            language or 'uz_latin',
             "new_marathon_started",
-            goal=goal_amount,
-            start_date=marathon.get('start_date', ''),
-            end_date=marathon.get('end_date', '')
+            goal=payload['goal'],
+            start_date=payload['start_date'],
+            end_date=payload['end_date']
         )
-        
-        try:
-            await bot.send_message(user_id, notification_text)
-        except Exception as e:
-            # Пользователь заблокировал бота или другая ошибка
-            print(f"Failed to send marathon notification to {user_id}: {e}")
-            continue
+    }
 
 
 @router.callback_query(F.data == "admin_marathon_stats")
-async def admin_show_marathon_stats(callback: CallbackQuery, db: Database):
+async def admin_show_marathon_stats(callback: CallbackQuery, db: Repository):
     """Показать статистику текущего марафона"""
     marathon = await db.get_active_marathon()
 
@@ -194,16 +199,20 @@ async def admin_show_marathon_stats(callback: CallbackQuery, db: Database):
 
 
 @router.callback_query(F.data == "admin_general_stats")
-async def admin_show_general_stats(callback: CallbackQuery, db: Database):
+async def admin_show_general_stats(callback: CallbackQuery, db: Repository):
     """Показать общую статистику проекта"""
     users_count = await db.get_total_users_count()
     duas_count = await db.get_total_duas_count()
     marathons_count = await db.get_total_marathons_count()
     total_donations = await db.get_total_donations_amount()
+    unreachable = await db.get_unreachable_users_count()
 
     stats_text = (
         f"Общая статистика проекта\n\n"
         f"Всего пользователей: {users_count}\n"
+        f"Исключены из рассылок: {unreachable['blocked'] + unreachable['deactivated']} "
+        f"(заблокировали бота: {unreachable['blocked']}, удалены: {unreachable['deactivated']})\n"
+        f"Временно не получают рассылки: {unreachable['backoff']}\n"
         f"Всего дуа: {duas_count}\n"
         f"Проведено марафонов: {marathons_count}\n"
         f"Общая сумма пожертвований: {total_donations} сум"
@@ -216,8 +225,41 @@ async def admin_show_general_stats(callback: CallbackQuery, db: Database):
     await callback.answer()
 
 
+@router.callback_query(F.data == "admin_reconcile")
+async def admin_reconcile_totals(callback: CallbackQuery, db: Repository):
+    """Пересчитать суммы марафонов с нуля и показать расхождения"""
+    drifts = await db.reconcile_marathon_totals()
+    leaderboard_mismatches = await db.verify_leaderboard()
+
+    if drifts:
+        lines = []
+        for drift in drifts:
+            target = f"Марафон #{drift['marathon_id']}"
+            if drift.get('user_id') is not None:
+                target += f", пользователь {drift['user_id']}"
+            lines.append(
+                f"{target}: было {drift['stored']}, стало {drift['actual']} "
+                f"(расхождение {drift['actual'] - drift['stored']})"
+            )
+        report = (
+            f"Сверка сумм марафонов\n\n"
+            f"Исправлено расхождений: {len(drifts)}\n\n"
+        ) + "\n".join(lines)
+    else:
+        report = "Сверка сумм марафонов\n\nРасхождений не найдено."
+
+    if leaderboard_mismatches:
+        report += f"\n\nРейтинг в памяти перезагружен, расхождений: {len(leaderboard_mismatches)}"
+
+    await callback.message.edit_text(
+        report,
+        reply_markup=get_admin_back_button()
+    )
+    await callback.answer()
+
+
 @router.callback_query(F.data == "admin_menu")
-async def show_admin_menu_callback(callback: CallbackQuery, db: Database):
+async def show_admin_menu_callback(callback: CallbackQuery, db: Repository):
     """Вернуться в меню администратора"""
     await callback.message.delete()
     await show_admin_menu(callback.message, db)
@@ -1,21 +1,27 @@
+from functools import lru_cache
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 
 from bot.states import UserStates
-from bot.database.models import Database
+from bot.database.base import Repository, UserProfile
+from bot.database.dua_quota import LIMIT_USER
 from bot.locales.texts import get_text
-from bot.config import DUA_LIMIT_PER_USER, DUA_LIMIT_TOTAL, ADMIN_CHAT_ID
+from bot.config import DUA_LIMIT_PER_USER, DUA_LIMIT_TOTAL
+from bot.utils.dua_digest import get_dua_digest
+from bot import get_bot_instance
 
 router = Router()
 
 
-async def get_user_language(db: Database, user_id: int) -> str:
-    user = await db.get_user(user_id)
+def get_user_language(user: Optional[UserProfile]) -> str:
     return user['language'] if user else 'uz_latin'
 
 
+@lru_cache(maxsize=None)
 def get_main_menu_keyboard(language: str):
     builder = ReplyKeyboardBuilder()
     builder.button(text=get_text(language, "marathon_stats"))
@@ -26,16 +32,16 @@ def get_main_menu_keyboard(language: str):
 
 
 @router.callback_query(F.data == "send_dua")
-async def start_dua_process_callback(callback: CallbackQuery, state: FSMContext, db: Database):
-    await _start_dua_process(callback.message, state, db, callback.from_user.id, is_callback=True)
+async def start_dua_process_callback(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    await _start_dua_process(callback.message, state, db, callback.from_user.id, user, is_callback=True)
     await callback.answer()
 
 @router.message(F.text.in_([get_text("uz_latin", "dua_button"), get_text("uz_cyrillic", "dua_button"), get_text("ru", "dua_button")]))
-async def start_dua_process_message(message: Message, state: FSMContext, db: Database):
-    await _start_dua_process(message, state, db, message.from_user.id, is_callback=False)
+async def start_dua_process_message(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    await _start_dua_process(message, state, db, message.from_user.id, user, is_callback=False)
 
-async def _start_dua_process(message: Message, state: FSMContext, db: Database, user_id: int, is_callback: bool):
-    language = await get_user_language(db, user_id)
+async def _start_dua_process(message: Message, state: FSMContext, db: Repository, user_id: int, user: Optional[UserProfile], is_callback: bool):
+    language = get_user_language(user)
 
     user_duas_count = await db.count_user_duas_this_juma(user_id)
     total_duas_count = await db.count_total_duas_this_juma()
@@ -57,52 +63,59 @@ async def _start_dua_process(message: Message, state: FSMContext, db: Database,
             await message.edit_text(text, reply_markup=reply_markup)
         else:
             await message.answer(text, reply_markup=reply_markup)
+        return
 
     if total_duas_count >= DUA_LIMIT_TOTAL - 5:
-        builder = InlineKeyboardBuilder()
-        builder.button(text=get_text(language, "dua_send_now"), callback_data="dua_confirm_send")
-        builder.button(text=get_text(language, "dua_send_later"), callback_data="main_menu")
-        builder.adjust(1)
-
         text = get_text(language, "dua_limit_warning", total=total_duas_count)
+        reply_markup = _dua_warning_keyboard(language)
         if is_callback:
-            await message.edit_text(text, reply_markup=builder.as_markup())
+            await message.edit_text(text, reply_markup=reply_markup)
         else:
-            await message.answer(text, reply_markup=builder.as_markup())
+            await message.answer(text, reply_markup=reply_markup)
         return
 
     await ask_dua_name_choice(message, language, state, is_callback)
 
 
 @router.callback_query(F.data == "dua_confirm_send")
-async def confirm_dua_send(callback: CallbackQuery, state: FSMContext, db: Database):
-    user_id = callback.from_user.id
-    language = await get_user_language(db, user_id)
+async def confirm_dua_send(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    language = get_user_language(user)
 
     await ask_dua_name_choice(callback.message, language, state, is_callback=True)
     await callback.answer()
 
 
-async def ask_dua_name_choice(message: Message, language: str, state: FSMContext, is_callback: bool):
+@lru_cache(maxsize=None)
+def _dua_warning_keyboard(language: str):
+    builder = InlineKeyboardBuilder()
+    builder.button(text=get_text(language, "dua_send_now"), callback_data="dua_confirm_send")
+    builder.button(text=get_text(language, "dua_send_later"), callback_data="main_menu")
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@lru_cache(maxsize=None)
+def _dua_name_choice_keyboard(language: str):
     builder = InlineKeyboardBuilder()
     builder.button(text=get_text(language, "dua_my_name"), callback_data="dua_name_real")
     builder.button(text=get_text(language, "dua_anonymous"), callback_data="dua_name_anonymous")
     builder.button(text=get_text(language, "back_button"), callback_data="main_menu")
     builder.adjust(1)
+    return builder.as_markup()
+
 
+async def ask_dua_name_choice(message: Message, language: str, state: FSMContext, is_callback: bool):
     text = get_text(language, "dua_name_question")
     if is_callback:
-        await message.edit_text(text, reply_markup=builder.as_markup())
+        await message.edit_text(text, reply_markup=_dua_name_choice_keyboard(language))
     else:
-        await message.answer(text, reply_markup=builder.as_markup())
+        await message.answer(text, reply_markup=_dua_name_choice_keyboard(language))
     await state.set_state(UserStates.WAITING_DUA_NAME_CHOICE)
 
 
 @router.callback_query(UserStates.WAITING_DUA_NAME_CHOICE, F.data == "dua_name_real")
-async def choose_real_name(callback: CallbackQuery, state: FSMContext, db: Database):
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
-    language = user['language'] if user else 'uz_latin'
+async def choose_real_name(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    language = get_user_language(user)
 
     display_name = user['display_name'] if user and user['display_name'] else callback.from_user.first_name
 
@@ -114,9 +127,8 @@ async def choose_real_name(callback: CallbackQuery, state: FSMContext, db: Datab
 
 
 @router.callback_query(UserStates.WAITING_DUA_NAME_CHOICE, F.data == "dua_name_anonymous")
-async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Database):
-    user_id = callback.from_user.id
-    language = await get_user_language(db, user_id)
+async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    language = get_user_language(user)
 
     await state.update_data(dua_sender_name="Аноним", dua_is_anonymous=True)
 
@@ -126,46 +138,28 @@ async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Datab
 
 
 @router.message(UserStates.WAITING_DUA)
-async def receive_dua_text(message: Message, state: FSMContext, db: Database):
+async def receive_dua_text(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     user_id = message.from_user.id
-    language = await get_user_language(db, user_id)
+    language = get_user_language(user)
 
     dua_text = message.text
     data = await state.get_data()
     sender_name = data.get('dua_sender_name', 'Аноним')
     is_anonymous = data.get('dua_is_anonymous', True)
 
-    user_duas_count = await db.count_user_duas_this_juma(user_id)
-    total_duas_count = await db.count_total_duas_this_juma()
-
-    if user_duas_count >= DUA_LIMIT_PER_USER:
+    # Место под дуа резервируется вместе с записью: лимит нельзя превысить одновременными отправками
+    rejected = await db.add_dua(user_id, dua_text, sender_name, is_anonymous)
+    if rejected:
+        text_key = "dua_limit_user" if rejected == LIMIT_USER else "dua_limit_total"
         await message.answer(
-            get_text(language, "dua_limit_user"),
+            get_text(language, text_key),
             reply_markup=get_main_menu_keyboard(language)
         )
         await state.set_state(UserStates.IN_MARATHON)
         return
 
-    if total_duas_count >= DUA_LIMIT_TOTAL:
-        await message.answer(
-            get_text(language, "dua_limit_total"),
-            reply_markup=get_main_menu_keyboard(language)
-        )
-        await state.set_state(UserStates.IN_MARATHON)
-        return
-
-    await db.add_dua(user_id, dua_text, sender_name, is_anonymous)
-
-    if ADMIN_CHAT_ID:
-        admin_message = f"<b>Новая дуа</b>\n\n"
-        admin_message += f"От: {sender_name}\n"
-        admin_message += f"Текст: {dua_text}\n"
-
-        try:
-            from bot import bot
-            await bot.send_message(ADMIN_CHAT_ID, admin_message, parse_mode="HTML")
-        except Exception as e:
-            print(f"Error sending dua to admin: {e}")
+    # Администратору дуа придет в ближайшей сводке
+    get_dua_digest(get_bot_instance(), db).notify()
 
     await message.answer(
         get_text(language, "dua_sent_success"),
@@ -174,6 +168,7 @@ async def receive_dua_text(message: Message, state: FSMContext, db: Database):
     await state.set_state(UserStates.IN_MARATHON)
 
 
+@lru_cache(maxsize=None)
 def get_back_to_menu_keyboard(language: str):
     builder = InlineKeyboardBuilder()
     builder.button(text=get_text(language, "back_button"), callback_data="main_menu")
@@ -181,9 +176,8 @@ def get_back_to_menu_keyboard(language: str):
 
 
 @router.callback_query(F.data == "main_menu")
-async def show_main_menu(callback: CallbackQuery, state: FSMContext, db: Database):
-    user_id = callback.from_user.id
-    language = await get_user_language(db, user_id)
+async def show_main_menu(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
+    language = get_user_language(user)
 
     # Если пользователь нажал "Главное меню" (например кнопка Назад),
     # удаляем сообщение с инлайн меню (календарь, настройки и т.д.)
@@ -1,10 +1,14 @@
+from functools import lru_cache
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from bot.states import UserStates
-from bot.database.models import Database
+from bot.database.base import Repository, UserProfile
+from bot.database.reminders import local_date
 from bot.locales.texts import get_text
 from bot.utils.formatting import format_number, parse_amount
 from bot.utils.message_manager import delete_previous_messages, track_bot_message
@@ -14,19 +18,18 @@ router = Router()
 
 
 @router.callback_query(F.data == "marathon_stats")
-async def show_marathon_stats(callback: CallbackQuery, db: Database):
-    await _send_marathon_stats(callback.message, db, callback.from_user.id, is_callback=True)
+async def show_marathon_stats(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
+    await _send_marathon_stats(callback.message, db, callback.from_user.id, user, is_callback=True)
     await callback.answer()
 
 
 @router.message(F.text.in_([get_text("uz_latin", "marathon_stats"), get_text("uz_cyrillic", "marathon_stats"), get_text("ru", "marathon_stats")]))
-async def show_marathon_stats_message(message: Message, db: Database):
-    await _send_marathon_stats(message, db, message.from_user.id, is_callback=False)
+async def show_marathon_stats_message(message: Message, db: Repository, user: Optional[UserProfile]):
+    await _send_marathon_stats(message, db, message.from_user.id, user, is_callback=False)
 
 
-async def _send_marathon_stats(message: Message, db: Database, user_id: int, is_callback: bool):
+async def _send_marathon_stats(message: Message, db: Repository, user_id: int, user: Optional[UserProfile], is_callback: bool):
     """Internal function to show marathon stats"""
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     # Получаем активный марафон
@@ -93,41 +96,24 @@ async def _send_marathon_stats(message: Message, db: Database, user_id: int, is_
         global_contribution_percent=global_contribution_percent
     )
 
-    # Кнопки для просмотра календаря
-    builder = InlineKeyboardBuilder()
-    builder.button(
-        text=get_text(language, "view_calendar"),
-        callback_data="calendar_current"
-    )
-    # Кнопка назад нужна только если это было инлайн взаимодействие, или чтобы закрыть инлайн
-    # Если мы в Persistent Menu, кнопка назад в стате (которая пришла новым сообщением)
-    # может просто удалять сообщение статистики?
-    # Пока оставим как есть, она вернет "Main Menu" через callback
-    builder.button(
-        text=get_text(language, "back_button"),
-        callback_data="main_menu"
-    )
-    builder.adjust(1)
-
     if is_callback:
-        await message.edit_text(stats_text, reply_markup=builder.as_markup())
+        await message.edit_text(stats_text, reply_markup=_stats_keyboard(language))
     else:
         # Удаляем предыдущие сообщения бота
         bot = get_bot_instance()
         if bot:
             await delete_previous_messages(bot, db, user_id, message.chat.id)
         
-        sent_message = await message.answer(stats_text, reply_markup=builder.as_markup())
+        sent_message = await message.answer(stats_text, reply_markup=_stats_keyboard(language))
         
         # Сохраняем ID отправленного сообщения
         await track_bot_message(db, user_id, message.chat.id, sent_message.message_id)
 
 
 @router.callback_query(F.data.startswith("calendar_"))
-async def show_calendar(callback: CallbackQuery, db: Database):
+async def show_calendar(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
     """Показать календарь марафона"""
     user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     # Парсим данные callback
@@ -183,17 +169,16 @@ async def calendar_ignore_handler(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("day_"))
-async def handle_day_click(callback: CallbackQuery, db: Database):
+async def handle_day_click(callback: CallbackQuery, db: Repository):
     """Обработка клика на день в календаре"""
     # Согласно ответам заказчика: календарь только визуальная часть, при клике ничего не показываем
     await callback.answer()
 
 
 @router.callback_query(F.data == "mark_completed")
-async def mark_today_completed(callback: CallbackQuery, state: FSMContext, db: Database):
+async def mark_today_completed(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Отметить сегодняшний день как выполненный"""
     user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     # Получаем активный марафон
@@ -209,10 +194,9 @@ async def mark_today_completed(callback: CallbackQuery, state: FSMContext, db: D
 
 
 @router.message(UserStates.WAITING_DAILY_AMOUNT)
-async def receive_daily_amount(message: Message, state: FSMContext, db: Database):
+async def receive_daily_amount(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Обработчик ввода суммы за день"""
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     try:
@@ -228,14 +212,14 @@ async def receive_daily_amount(message: Message, state: FSMContext, db: Database
             await state.clear()
             return
 
-        from datetime import datetime
-        today = datetime.now().strftime("%Y-%m-%d")
+        # День марафона - по местной дате пользователя, как и в напоминаниях
+        today = local_date(user['timezone'] if user else None)
 
         # Сохраняем выполнение
         await db.mark_day_completed(user_id, marathon['id'], today, amount)
         
         # Отправляем статистику
-        await send_daily_stats(message, db, user_id, marathon['id'], today, language, True, amount)
+        await send_daily_stats(message, db, user_id, marathon, today, language, True, amount)
         
         await state.clear()
 
@@ -244,10 +228,9 @@ async def receive_daily_amount(message: Message, state: FSMContext, db: Database
 
 
 @router.callback_query(F.data == "mark_not_completed")
-async def mark_today_not_completed(callback: CallbackQuery, db: Database):
+async def mark_today_not_completed(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
     """Отметить сегодняшний день как невыполненный"""
     user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     # Получаем активный марафон
@@ -257,8 +240,7 @@ async def mark_today_not_completed(callback: CallbackQuery, db: Database):
         return
 
     # Отмечаем день как невыполненный
-    from datetime import datetime
-    today = datetime.now().strftime("%Y-%m-%d")
+    today = local_date(user['timezone'] if user else None)
     
     await db.mark_day_not_completed(user_id, marathon['id'], today)
 
@@ -267,18 +249,17 @@ async def mark_today_not_completed(callback: CallbackQuery, db: Database):
     await callback.message.edit_text(motivational_text)
     
     # Отправляем статистику отдельным сообщением (так как edit_text выше мог изменить тип контента)
-    await send_daily_stats(callback.message, db, user_id, marathon['id'], today, language, False, 0)
+    await send_daily_stats(callback.message, db, user_id, marathon, today, language, False, 0)
     
     await callback.answer()
 
 
-async def send_daily_stats(message: Message, db: Database, user_id: int, marathon_id: int, date: str, language: str, completed: bool, amount: int):
+async def send_daily_stats(message: Message, db: Repository, user_id: int, marathon: dict, date: str, language: str, completed: bool, amount: int):
     """Отправить ежедневную статистику"""
     # Получаем общую статистику за день
-    daily_stats = await db.get_daily_global_stats(marathon_id, date)
+    daily_stats = await db.get_daily_global_stats(marathon['id'], date)
     
-    # Получаем данные о марафоне для расчета прогресса
-    marathon = await db.get_active_marathon()
+    # Цель марафона для расчета прогресса
     goal = marathon['goal_amount']
     # Простая аппроксимация дней в месяце = 30
     daily_goal = goal / 30 if goal > 0 else 1
@@ -306,10 +287,8 @@ async def send_daily_stats(message: Message, db: Database, user_id: int, maratho
 
 
 @router.callback_query(F.data == "morning_yes")
-async def morning_yes_handler(callback: CallbackQuery, db: Database):
+async def morning_yes_handler(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
     """Обработчик кнопки 'Да' на утреннее напоминание"""
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
     
     await callback.answer(get_text(language, "yes"))
@@ -317,10 +296,8 @@ async def morning_yes_handler(callback: CallbackQuery, db: Database):
 
 
 @router.callback_query(F.data == "morning_no")
-async def morning_no_handler(callback: CallbackQuery, db: Database):
+async def morning_no_handler(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
     """Обработчик кнопки 'Нет' на утреннее напоминание"""
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
     
     # Отправляем мягкое мотивационное сообщение
@@ -328,6 +305,27 @@ async def morning_no_handler(callback: CallbackQuery, db: Database):
     await callback.answer()
 
 
+@lru_cache(maxsize=None)
+def _stats_keyboard(language: str):
+    # Кнопки для просмотра календаря
+    builder = InlineKeyboardBuilder()
+    builder.button(
+        text=get_text(language, "view_calendar"),
+        callback_data="calendar_current"
+    )
+    # Кнопка назад нужна только если это было инлайн взаимодействие, или чтобы закрыть инлайн
+    # Если мы в Persistent Menu, кнопка назад в стате (которая пришла новым сообщением)
+    # может просто удалять сообщение статистики?
+    # Пока оставим как есть, она вернет "Main Menu" через callback
+    builder.button(
+        text=get_text(language, "back_button"),
+        callback_data="main_menu"
+    )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@lru_cache(maxsize=None)
 def get_back_button(language: str):
     """Создать кнопку 'Назад'"""
     builder = InlineKeyboardBuilder()
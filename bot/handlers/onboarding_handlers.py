@@ -1,3 +1,6 @@
+from functools import lru_cache
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
@@ -5,7 +8,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from bot.states import UserStates
-from bot.database.models import Database
+from bot.database.base import Repository, UserProfile
 from bot.locales.texts import get_text
 from bot.utils.formatting import format_number, parse_amount
 from bot.utils.message_manager import delete_previous_messages, track_bot_message
@@ -15,36 +18,39 @@ router = Router()
 
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext, db: Database):
+async def cmd_start(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Обработчик команды /start"""
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
 
     if user:
         # Пользователь уже существует - показываем главное меню
-        await show_main_menu(message, db, user_id)
+        await show_main_menu(message, db, user_id, user['language'])
     else:
         # Новый пользователь - показываем выбор языка
         await show_language_selection(message, state, db, user_id)
 
 
-async def show_language_selection(message: Message, state: FSMContext, db: Database, user_id: int):
-    """Показать выбор языка"""
+@lru_cache(maxsize=None)
+def _language_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="O'zbekcha (lotin)", callback_data="lang_uz_latin")
     builder.button(text="O'zbekcha (кирилл)", callback_data="lang_uz_cyrillic")
     builder.button(text="Русский", callback_data="lang_ru")
     builder.adjust(1)
+    return builder.as_markup()
 
+
+async def show_language_selection(message: Message, state: FSMContext, db: Repository, user_id: int):
+    """Показать выбор языка"""
     await message.answer(
         "Tilni tanlang / Выберите язык:",
-        reply_markup=builder.as_markup()
+        reply_markup=_language_keyboard()
     )
     await state.set_state(UserStates.NEW)
 
 
 @router.callback_query(UserStates.NEW, F.data.startswith("lang_"))
-async def select_language(callback: CallbackQuery, state: FSMContext, db: Database):
+async def select_language(callback: CallbackQuery, state: FSMContext, db: Repository):
     """Обработчик выбора языка"""
     user_id = callback.from_user.id
     language_map = {
@@ -83,23 +89,26 @@ async def show_onboarding(message: Message, language: str, state: FSMContext):
     await ask_daily_plan(message, language, state)
 
 
-async def ask_daily_plan(message: Message, language: str, state: FSMContext):
-    """Запросить ввод дневного плана"""
+@lru_cache(maxsize=None)
+def _daily_plan_keyboard(language: str):
     builder = InlineKeyboardBuilder()
     builder.button(text=get_text(language, "add_later"), callback_data="skip_daily_plan")
+    return builder.as_markup()
+
 
+async def ask_daily_plan(message: Message, language: str, state: FSMContext):
+    """Запросить ввод дневного плана"""
     await message.edit_text(
         get_text(language, "ask_daily_plan"),
-        reply_markup=builder.as_markup()
+        reply_markup=_daily_plan_keyboard(language)
     )
     await state.set_state(UserStates.WAITING_DAILY_PLAN)
 
 
 @router.message(UserStates.WAITING_DAILY_PLAN)
-async def receive_daily_plan(message: Message, state: FSMContext, db: Database):
+async def receive_daily_plan(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Обработчик ввода дневного плана"""
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     # Валидация ввода
@@ -109,8 +118,10 @@ async def receive_daily_plan(message: Message, state: FSMContext, db: Database):
             await message.answer(get_text(language, "daily_plan_too_small"))
             return
 
-        # Сохраняем дневной план
+        # Сохраняем дневной план; профиль из middleware после этого устарел
         await db.update_user_daily_plan(user_id, daily_plan)
+        user = await db.get_user(user_id)
+        language = user['language'] if user else language
 
         # Расчет показателей
         total_projected = daily_plan * 30
@@ -139,32 +150,34 @@ async def receive_daily_plan(message: Message, state: FSMContext, db: Database):
 
 
 @router.callback_query(UserStates.WAITING_DAILY_PLAN, F.data == "skip_daily_plan")
-async def skip_daily_plan(callback: CallbackQuery, state: FSMContext, db: Database):
+async def skip_daily_plan(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Пропустить ввод дневного плана"""
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     await ask_display_name(callback.message, language, state)
     await callback.answer()
 
 
-async def ask_display_name(message: Message, language: str, state: FSMContext):
-    """Запросить отображаемое имя"""
+@lru_cache(maxsize=None)
+def _display_name_keyboard(language: str):
     builder = InlineKeyboardBuilder()
     builder.button(text=get_text(language, "keep_my_name"), callback_data="name_keep")
     builder.button(text=get_text(language, "participate_anonymous"), callback_data="name_anonymous")
     builder.adjust(1)
+    return builder.as_markup()
 
+
+async def ask_display_name(message: Message, language: str, state: FSMContext):
+    """Запросить отображаемое имя"""
     await message.answer(
         get_text(language, "ask_display_name"),
-        reply_markup=builder.as_markup()
+        reply_markup=_display_name_keyboard(language)
     )
     await state.set_state(UserStates.WAITING_NAME)
 
 
 @router.callback_query(UserStates.WAITING_NAME, F.data == "name_keep")
-async def keep_name(callback: CallbackQuery, state: FSMContext, db: Database):
+async def keep_name(callback: CallbackQuery, state: FSMContext, db: Repository):
     """Оставить текущее имя"""
     user_id = callback.from_user.id
     display_name = callback.from_user.first_name
@@ -175,10 +188,8 @@ async def keep_name(callback: CallbackQuery, state: FSMContext, db: Database):
 
 
 @router.callback_query(UserStates.WAITING_NAME, F.data == "name_anonymous")
-async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Database):
+async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Выбрать анонимное участие"""
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     await callback.message.edit_text(get_text(language, "enter_pseudonym"))
@@ -187,7 +198,7 @@ async def choose_anonymous(callback: CallbackQuery, state: FSMContext, db: Datab
 
 
 @router.message(UserStates.WAITING_NAME)
-async def receive_pseudonym(message: Message, state: FSMContext, db: Database):
+async def receive_pseudonym(message: Message, state: FSMContext, db: Repository):
     """Получить псевдоним пользователя"""
     user_id = message.from_user.id
     pseudonym = message.text.strip()
@@ -196,7 +207,7 @@ async def receive_pseudonym(message: Message, state: FSMContext, db: Database):
     await complete_onboarding(message, db, user_id, state)
 
 
-async def complete_onboarding(message: Message, db: Database, user_id: int, state: FSMContext):
+async def complete_onboarding(message: Message, db: Repository, user_id: int, state: FSMContext):
     """Завершить онбординг"""
     user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
@@ -215,14 +226,11 @@ async def complete_onboarding(message: Message, db: Database, user_id: int, stat
         await message.answer(get_text(language, "waiting_for_marathon"))
 
     # Показываем главное меню
-    await show_main_menu(message, db, user_id)
+    await show_main_menu(message, db, user_id, language)
 
 
-async def show_main_menu(message: Message, db: Database, user_id: int):
+async def show_main_menu(message: Message, db: Repository, user_id: int, language: str):
     """Показать главное меню"""
-    user = await db.get_user(user_id)
-    language = user['language'] if user else 'uz_latin'
-
     from bot.handlers.dua_handlers import get_main_menu_keyboard
     
     # Удаляем предыдущие сообщения бота
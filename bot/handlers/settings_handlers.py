@@ -1,9 +1,12 @@
+from functools import lru_cache
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from bot.database.models import Database
+from bot.database.base import Repository, UserProfile
 from bot.locales.texts import get_text
 from bot.states import UserStates
 from bot.utils.formatting import format_number, parse_amount
@@ -12,20 +15,28 @@ router = Router()
 
 
 @router.callback_query(F.data == "settings")
-async def show_settings(callback: CallbackQuery, db: Database):
-    await _send_settings(callback.message, db, callback.from_user.id, is_callback=True)
+async def show_settings(callback: CallbackQuery, db: Repository, user: Optional[UserProfile]):
+    await _send_settings(callback.message, user, is_callback=True)
     await callback.answer()
 
 @router.message(F.text.in_([get_text("uz_latin", "settings"), get_text("uz_cyrillic", "settings"), get_text("ru", "settings")]))
-async def show_settings_message(message: Message, db: Database):
-    await _send_settings(message, db, message.from_user.id, is_callback=False)
+async def show_settings_message(message: Message, db: Repository, user: Optional[UserProfile]):
+    await _send_settings(message, user, is_callback=False)
 
 
-async def _send_settings(message: Message, db: Database, user_id: int, is_callback: bool):
+async def _send_settings(message: Message, user: Optional[UserProfile], is_callback: bool):
     """Internal function to show settings"""
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
+    text = get_text(language, "settings_menu")
+    if is_callback:
+        await message.edit_text(text, reply_markup=_settings_keyboard(language))
+    else:
+        await message.answer(text, reply_markup=_settings_keyboard(language))
+
+
+@lru_cache(maxsize=None)
+def _settings_keyboard(language: str):
     builder = InlineKeyboardBuilder()
     builder.button(
         text=get_text(language, "change_language"),
@@ -41,33 +52,32 @@ async def _send_settings(message: Message, db: Database, user_id: int, is_callba
         callback_data="main_menu"
     )
     builder.adjust(1)
-    
-    text = get_text(language, "settings_menu")
-    if is_callback:
-        await message.edit_text(text, reply_markup=builder.as_markup())
-    else:
-        await message.answer(text, reply_markup=builder.as_markup())
+    return builder.as_markup()
 
 
-@router.callback_query(F.data == "settings_change_language")
-async def change_language(callback: CallbackQuery, db: Database):
-    """Показать выбор языка"""
+@lru_cache(maxsize=None)
+def _language_keyboard():
     builder = InlineKeyboardBuilder()
     builder.button(text="O'zbekcha (lotin)", callback_data="settings_lang_uz_latin")
     builder.button(text="O'zbekcha (кирилл)", callback_data="settings_lang_uz_cyrillic")
     builder.button(text="Русский", callback_data="settings_lang_ru")
     builder.button(text="Назад", callback_data="settings")
     builder.adjust(1)
+    return builder.as_markup()
+
 
+@router.callback_query(F.data == "settings_change_language")
+async def change_language(callback: CallbackQuery, db: Repository):
+    """Показать выбор языка"""
     await callback.message.edit_text(
         "Tilni tanlang / Выберите язык:",
-        reply_markup=builder.as_markup()
+        reply_markup=_language_keyboard()
     )
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("settings_lang_"))
-async def update_language(callback: CallbackQuery, db: Database):
+async def update_language(callback: CallbackQuery, db: Repository):
     """Обновить язык пользователя"""
     user_id = callback.from_user.id
 
@@ -79,37 +89,34 @@ async def update_language(callback: CallbackQuery, db: Database):
 
     new_language = language_map.get(callback.data, "uz_latin")
     await db.update_user_language(user_id, new_language)
+    # Профиль из middleware снят до изменения: перечитываем сохраненный
+    user = await db.get_user(user_id)
+    language = user['language'] if user else new_language
 
     await callback.message.edit_text(
-        get_text(new_language, "language_changed"),
-        reply_markup=get_back_to_settings_keyboard(new_language)
+        get_text(language, "language_changed"),
+        reply_markup=get_back_to_settings_keyboard(language)
     )
     await callback.answer()
 
 
 @router.callback_query(F.data == "settings_change_plan")
-async def change_plan(callback: CallbackQuery, state: FSMContext, db: Database):
+async def change_plan(callback: CallbackQuery, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Запросить новый дневной план"""
-    user_id = callback.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
-    builder = InlineKeyboardBuilder()
-    builder.button(text=get_text(language, "back_button"), callback_data="settings")
-    
     await callback.message.edit_text(
         get_text(language, "enter_new_plan"),
-        reply_markup=builder.as_markup()
+        reply_markup=get_back_to_settings_keyboard(language)
     )
     await state.set_state(UserStates.SETTINGS_WAITING_PLAN)
     await callback.answer()
 
 
 @router.message(UserStates.SETTINGS_WAITING_PLAN)
-async def receive_new_plan(message: Message, state: FSMContext, db: Database):
+async def receive_new_plan(message: Message, state: FSMContext, db: Repository, user: Optional[UserProfile]):
     """Обработать новый дневной план"""
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
     language = user['language'] if user else 'uz_latin'
 
     try:
@@ -118,8 +125,10 @@ async def receive_new_plan(message: Message, state: FSMContext, db: Database):
             await message.answer(get_text(language, "daily_plan_too_small"))
             return
 
-        # Обновляем план
+        # Обновляем план; профиль из middleware после этого устарел
         await db.update_user_daily_plan(user_id, new_plan)
+        user = await db.get_user(user_id)
+        language = user['language'] if user else language
         
         # Расчет показателей
         total_projected = new_plan * 30
@@ -146,6 +155,7 @@ async def receive_new_plan(message: Message, state: FSMContext, db: Database):
         await message.answer(get_text(language, "invalid_number"))
 
 
+@lru_cache(maxsize=None)
 def get_back_to_settings_keyboard(language: str):
     """Создать кнопку возврата к настройкам"""
     builder = InlineKeyboardBuilder()
@@ -9,14 +9,15 @@ from aiogram.types import Message
 from aiogram.fsm.context import FSMContext
 
 from bot.states import UserStates
-from bot.database.models import Database
+from bot.database.base import Repository
+from bot.database.juma import juma_friday
 from bot.handlers.dua_handlers import get_main_menu_keyboard
 
 router = Router()
 
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext, db: Database):
+async def cmd_start(message: Message, state: FSMContext, db: Repository):
     """Временный обработчик /start для тестирования"""
     user_id = message.from_user.id
     username = message.from_user.username or ""
@@ -46,7 +47,7 @@ async def cmd_start(message: Message, state: FSMContext, db: Database):
 
 
 @router.message(Command("menu"))
-async def cmd_menu(message: Message, state: FSMContext, db: Database):
+async def cmd_menu(message: Message, state: FSMContext, db: Repository):
     """Показать главное меню"""
     user_id = message.from_user.id
     user = await db.get_user(user_id)
@@ -60,18 +61,18 @@ async def cmd_menu(message: Message, state: FSMContext, db: Database):
 
 
 @router.message(Command("stats"))
-async def cmd_stats(message: Message, db: Database):
+async def cmd_stats(message: Message, db: Repository):
     """Показать статистику дуа"""
     user_id = message.from_user.id
 
     user_duas = await db.count_user_duas_this_juma(user_id)
     total_duas = await db.count_total_duas_this_juma()
     total_all_duas = await db.get_total_duas_count()
-    juma_week = await db.get_current_juma_week()
+    friday = juma_friday(db.get_current_juma_week())
 
     stats_text = (
         f"📊 Статистика дуа\n\n"
-        f"Текущая неделя Жума: {juma_week}\n\n"
+        f"Текущая неделя Жума: до {friday.strftime('%d.%m.%Y')}\n\n"
         f"Ваши дуа на эту Жума: {user_duas}/2\n"
         f"Всего дуа на эту Жума: {total_duas}/20\n\n"
         f"Всего дуа за все время: {total_all_duas}"
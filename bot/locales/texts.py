@@ -1,3 +1,6 @@
+from string import Formatter
+from typing import Dict
+
 TEXTS = {
     "uz_latin": {
         # Dua texts
@@ -188,9 +191,55 @@ TEXTS = {
 }
 
 
+DEFAULT_LANGUAGE = "uz_latin"
+
+
+class Template:
+    """Текст, разобранный при загрузке: известны имена подстановок, format связан заранее"""
+
+    __slots__ = ("text", "fields", "format")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.fields = frozenset(
+            field_name.split(".")[0].split("[")[0]
+            for _, field_name, _, _ in Formatter().parse(text)
+            if field_name
+        )
+        # Встроенный str.format быстрее сборки строки из частей на Python
+        self.format = text.format
+
+
+def compile_catalog(texts: Dict[str, Dict[str, str]]) -> Dict[str, Dict[str, Template]]:
+    """Разобрать тексты и проверить, что у всех языков одни и те же ключи и подстановки"""
+    problems = []
+    keys = set().union(*(language_texts.keys() for language_texts in texts.values()))
+    catalog = {
+        language: {key: Template(text) for key, text in language_texts.items()}
+        for language, language_texts in texts.items()
+    }
+    for key in sorted(keys):
+        missing = [language for language in texts if key not in texts[language]]
+        if missing:
+            problems.append(f"'{key}' is missing in {', '.join(missing)}")
+            continue
+        fields = {language: catalog[language][key].fields for language in texts}
+        if len(set(fields.values())) > 1:
+            problems.append(f"'{key}' has different placeholders: {fields}")
+    if problems:
+        raise ValueError("Invalid localization catalog:\n" + "\n".join(problems))
+    return catalog
+
+
+# Проверяется при импорте, то есть при запуске бота
+_CATALOG = compile_catalog(TEXTS)
+_DEFAULT_TEMPLATES = _CATALOG[DEFAULT_LANGUAGE]
+
 
 def get_text(language: str, key: str, **kwargs) -> str:
-    text = TEXTS.get(language, TEXTS["uz_latin"]).get(key, key)
+    template = _CATALOG.get(language, _DEFAULT_TEMPLATES).get(key)
+    if template is None:
+        return key
     if kwargs:
-        text = text.format(**kwargs)
-    return text
+        return template.format(**kwargs)
+    return template.text
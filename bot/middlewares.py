@@ -1,12 +1,19 @@
+import asyncio
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
 
-from bot.database.models import Database
+from bot.database.base import Repository
 
 
 class DatabaseMiddleware(BaseMiddleware):
-    def __init__(self, db: Database):
+    """Передает обработчикам db и user - профиль пользователя (UserProfile или None).
+
+    user - снимок на момент начала обработки обновления: обработчик, который
+    меняет профиль (язык, план, состояние), перечитывает его через db.get_user.
+    """
+
+    def __init__(self, db: Repository):
         super().__init__()
         self.db = db
 
@@ -17,4 +24,45 @@ class DatabaseMiddleware(BaseMiddleware):
         data: Dict[str, Any]
     ) -> Any:
         data['db'] = self.db
+        # Профиль загружается один раз на апдейт (через кэш хранилища)
+        from_user = data.get('event_from_user')
+        user = await self.db.get_user(from_user.id) if from_user else None
+        if user and (user['is_blocked'] or user['is_deactivated'] or user['failure_count']):
+            # Пользователь снова пишет боту - возвращаем его в рассылки
+            await self.db.mark_user_reachable(from_user.id)
+            user = await self.db.get_user(from_user.id)
+        data['user'] = user
         return await handler(event, data)
+
+
+class UpdateTracker(BaseMiddleware):
+    """Внешний middleware dp.update: считает обновления, которые сейчас обрабатываются"""
+
+    def __init__(self):
+        super().__init__()
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        self.in_flight += 1
+        self._idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self._idle.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Дождаться завершения всех обновлений; False, если не успели за timeout секунд"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
@@ -0,0 +1,282 @@
+"""
+Массовая рассылка сообщений с учетом лимитов Telegram.
+
+Сообщения отправляются несколькими параллельными воркерами, а общий
+темп ограничивается корзиной токенов (~30 сообщений в секунду на бота).
+TelegramRetryAfter приостанавливает всю рассылку на указанное время,
+временные ошибки сети и сервера повторяются с экспоненциальной задержкой.
+Результат доставки различает пользователей, заблокировавших бота или
+удаливших аккаунт, чтобы их можно было исключить из следующих рассылок.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, Optional, Union
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError
+)
+
+from bot.config import BROADCAST_CONCURRENCY, BROADCAST_MAX_RETRIES, BROADCAST_RATE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Получатель -> аргументы bot.send_message (text, reply_markup, ...)
+MessageBuilder = Callable[[Dict[str, Any]], Dict[str, Any]]
+# Результаты доставки
+SENT = "sent"
+BLOCKED = "blocked"  # пользователь заблокировал бота
+DEACTIVATED = "deactivated"  # аккаунт удален или чат недоступен
+FAILED = "failed"  # временная ошибка, попытки исчерпаны
+
+# Получатель, результат доставки
+ResultCallback = Callable[[Dict[str, Any], str], None]
+Recipients = Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]
+
+
+class TokenBucket:
+    """Корзина токенов: не больше rate операций в секунду"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Дождаться свободного токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Приостановить выдачу токенов (например, после TelegramRetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class BroadcastStats:
+    """Итоги и прогресс одной рассылки"""
+
+    def __init__(self, name: str, total: Optional[int] = None):
+        self.name = name
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.unreachable = 0
+        self.retries = 0
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        """Обработано сообщений в секунду"""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах"""
+        if self.total is None or self.throughput <= 0:
+            return None
+        return max(0, self.total - self.processed) / self.throughput
+
+    def __str__(self) -> str:
+        total = self.total if self.total is not None else "?"
+        eta = f"{self.eta:.0f}s" if self.eta is not None else "?"
+        return (
+            f"{self.name}: {self.processed}/{total} processed "
+            f"(sent {self.sent}, failed {self.failed}, unreachable {self.unreachable}, "
+            f"retries {self.retries}), "
+            f"{self.throughput:.1f} msg/s, elapsed {self.elapsed:.0f}s, ETA {eta}"
+        )
+
+
+class Broadcaster:
+    """Движок рассылок с ограниченным параллелизмом и общим лимитом скорости"""
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate: float = 28,
+        concurrency: int = 20,
+        max_retries: int = 3,
+        progress_interval: float = 10
+    ):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+
+    async def broadcast(
+        self,
+        name: str,
+        recipients: Recipients,
+        build_message: MessageBuilder,
+        total: Optional[int] = None,
+        on_result: Optional[ResultCallback] = None
+    ) -> BroadcastStats:
+        """Разослать сообщения всем получателям.
+
+        Получатели читаются потоково через ограниченную очередь, поэтому
+        отправка начинается сразу, а память не зависит от размера аудитории.
+
+        Args:
+            name: Название рассылки для логов
+            recipients: Получатели (обычный или асинхронный итератор),
+                каждый - словарь минимум с user_id
+            build_message: Функция, возвращающая аргументы send_message для получателя
+            total: Ожидаемое число получателей для расчета ETA
+            on_result: Вызывается с результатом доставки каждому получателю
+
+        Returns:
+            Итоговая статистика рассылки
+        """
+        if total is None and hasattr(recipients, '__len__'):
+            total = len(recipients)
+        stats = BroadcastStats(name, total=total)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        logger.info(f"Broadcast '{name}' started for {total if total is not None else '?'} recipients")
+        reporter = asyncio.create_task(self._report_progress(stats))
+        workers = [
+            asyncio.create_task(self._worker(queue, build_message, stats, on_result))
+            for _ in range(self.concurrency)
+        ]
+        try:
+            await self._produce(recipients, queue, len(workers))
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            reporter.cancel()
+            stats.finished_at = time.monotonic()
+        logger.info(f"Broadcast finished - {stats}")
+        return stats
+
+    async def _produce(self, recipients: Recipients, queue: asyncio.Queue, workers_count: int):
+        """Передать получателей воркерам, затем по одному сигналу остановки каждому"""
+        if hasattr(recipients, '__aiter__'):
+            async for recipient in recipients:
+                await queue.put(recipient)
+        else:
+            for recipient in recipients:
+                await queue.put(recipient)
+        for _ in range(workers_count):
+            await queue.put(None)
+
+    async def _worker(
+        self,
+        queue: asyncio.Queue,
+        build_message: MessageBuilder,
+        stats: BroadcastStats,
+        on_result: Optional[ResultCallback]
+    ):
+        while True:
+            recipient = await queue.get()
+            if recipient is None:
+                return
+            try:
+                message = build_message(recipient)
+            except Exception as e:
+                # Ошибка одного получателя не должна останавливать воркер и всю рассылку
+                logger.error(f"Failed to build message for {recipient.get('user_id')}: {e}")
+                outcome = FAILED
+            else:
+                outcome = await self.send(recipient['user_id'], message, stats)
+            if outcome == SENT:
+                stats.sent += 1
+            else:
+                stats.failed += 1
+                if outcome in (BLOCKED, DEACTIVATED):
+                    stats.unreachable += 1
+            if on_result:
+                try:
+                    on_result(recipient, outcome)
+                except Exception as e:
+                    # Сбой учета результата не должен останавливать рассылку
+                    logger.exception(f"Failed to record result for {recipient.get('user_id')}: {e}")
+
+    async def send(self, chat_id: int, message: Dict[str, Any], stats: Optional[BroadcastStats] = None) -> str:
+        """Отправить одно сообщение с учетом лимита и повторами, вернуть результат доставки"""
+        attempt = 0
+        flood_waits = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, **message)
+                return SENT
+            except TelegramForbiddenError as e:
+                # Повторять бесполезно, пока пользователь сам не напишет боту
+                logger.info(f"User {chat_id} is unreachable: {e.message}")
+                return DEACTIVATED if "deactivated" in e.message else BLOCKED
+            except TelegramBadRequest as e:
+                if "chat not found" in e.message:
+                    logger.info(f"User {chat_id} is unreachable: {e.message}")
+                    return DEACTIVATED
+                logger.info(f"Failed to send message to {chat_id}: {e}")
+                return FAILED
+            except TelegramRetryAfter as e:
+                # Лимит превышен: останавливаем всю рассылку; такие повторы считаются отдельно
+                flood_waits += 1
+                if flood_waits > self.max_retries:
+                    logger.error(f"Failed to send message to {chat_id}: flood control after {flood_waits} attempts")
+                    return FAILED
+                logger.warning(f"Flood control, pausing broadcasts for {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"Failed to send message to {chat_id} after {attempt} attempts: {e}")
+                    return FAILED
+                await asyncio.sleep(2 ** (attempt - 1))
+            except Exception as e:
+                logger.info(f"Failed to send message to {chat_id}: {e}")
+                return FAILED
+            if stats:
+                stats.retries += 1
+
+    async def _report_progress(self, stats: BroadcastStats):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            logger.info(f"Broadcast progress - {stats}")
+
+
+_broadcaster: Optional[Broadcaster] = None
+
+
+def get_broadcaster(bot: Bot) -> Broadcaster:
+    """Общий движок рассылок процесса: все рассылки делят один лимит скорости"""
+    global _broadcaster
+    if _broadcaster is None or _broadcaster.bot is not bot:
+        _broadcaster = Broadcaster(
+            bot,
+            rate=BROADCAST_RATE_LIMIT,
+            concurrency=BROADCAST_CONCURRENCY,
+            max_retries=BROADCAST_MAX_RETRIES
+        )
+    return _broadcaster
@@ -0,0 +1,151 @@
+"""
+Работа бота в нескольких процессах.
+
+Главный процесс получает обновления (polling или webhook) и раскладывает их
+по процессам-воркерам по user_id, поэтому обновления одного пользователя
+всегда обрабатывает один воркер, и внутри воркера - строго по очереди.
+Планировщик напоминаний и рассылки выполняет только воркер, держащий аренду
+в базе (таблица leases); если он перестает ее продлевать, роль переходит
+к другому воркеру.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+from bot.database.base import Repository
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: dict) -> int:
+    """id пользователя (или чата) из обновления Telegram в виде сырого JSON"""
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            if isinstance(value.get(field), dict):
+                return value[field].get('id', 0)
+        # Обновления с вложенным сообщением без отправителя
+        message = value.get('message')
+        if isinstance(message, dict) and isinstance(message.get('chat'), dict):
+            return message['chat'].get('id', 0)
+    return 0
+
+
+def update_partition(update: dict, partitions: int) -> int:
+    """Номер воркера, обрабатывающего обновления этого пользователя"""
+    return update_user_id(update) % partitions
+
+
+class KeyedSerializer:
+    """Выполняет задачи с одним ключом строго по очереди, с разными - параллельно"""
+
+    def __init__(self, limit: int = 1000):
+        self._tails: Dict[int, asyncio.Task] = {}
+        # Сколько задач может ждать и выполняться одновременно
+        self._slots = asyncio.Semaphore(limit)
+
+    def __len__(self) -> int:
+        return len(self._tails)
+
+    async def submit(self, key: int, job: Callable[[], Awaitable]):
+        """Поставить задачу в очередь ключа; ждет, только если все места заняты"""
+        await self._slots.acquire()
+        previous = self._tails.get(key)
+        task = asyncio.create_task(self._run_after(previous, job))
+        self._tails[key] = task
+
+        def done(finished: asyncio.Task):
+            self._slots.release()
+            if self._tails.get(key) is finished:
+                del self._tails[key]
+
+        task.add_done_callback(done)
+
+    async def join(self, timeout: Optional[float] = None):
+        """Дождаться выполнения поставленных задач"""
+        tasks = list(self._tails.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    @staticmethod
+    async def _run_after(previous: Optional[asyncio.Task], job: Callable[[], Awaitable]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await job()
+        except Exception as e:
+            logger.exception(f"Update processing failed: {e}")
+
+
+class LeaderElection:
+    """Аренда роли name в базе: держащий ее процесс - лидер.
+
+    Аренда продлевается каждые ttl/3 секунд. on_elected вызывается при
+    получении роли, on_demoted - при потере или освобождении, on_renewed -
+    после каждого продления.
+    """
+
+    def __init__(
+        self,
+        db: Repository,
+        name: str,
+        ttl: float = 30,
+        on_elected: Optional[Callable[[], Awaitable]] = None,
+        on_demoted: Optional[Callable[[], Awaitable]] = None,
+        on_renewed: Optional[Callable[[], Awaitable]] = None
+    ):
+        self.db = db
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.on_renewed = on_renewed
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Сложить роль и освободить аренду, чтобы ее сразу взял другой процесс"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._set_leader(False)
+            await self.db.release_lease(self.name, self.holder)
+
+    async def _run(self):
+        while True:
+            try:
+                acquired = await self.db.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception as e:
+                logger.error(f"Failed to renew lease '{self.name}': {e}")
+                acquired = False
+            try:
+                await self._set_leader(acquired)
+                if acquired and self.on_renewed:
+                    await self.on_renewed()
+            except Exception as e:
+                logger.exception(f"Lease '{self.name}' callback failed: {e}")
+            await asyncio.sleep(self.ttl / 3)
+
+    async def _set_leader(self, is_leader: bool):
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        if is_leader:
+            logger.info(f"{self.holder} acquired lease '{self.name}'")
+            if self.on_elected:
+                await self.on_elected()
+        else:
+            logger.info(f"{self.holder} lost lease '{self.name}'")
+            if self.on_demoted:
+                await self.on_demoted()
@@ -0,0 +1,156 @@
+"""
+Пересылка дуа администратору сводками.
+
+Дуа сохраняется в базе, и пользователь сразу получает ответ. Фоновая
+задача собирает еще не пересланные дуа в сообщения до 4096 символов и
+отправляет их в ADMIN_CHAT_ID раз в DUA_DIGEST_INTERVAL секунд или сразу,
+как только накопится DUA_DIGEST_BATCH дуа. Переслано ли дуа, отмечается
+в duas.delivered_at после отправки каждого сообщения, поэтому после
+перезапуска пересылаются только оставшиеся.
+"""
+import asyncio
+import logging
+from html import escape
+from typing import List, Optional, Tuple
+
+from aiogram import Bot
+
+from bot.config import ADMIN_CHAT_ID, DUA_DIGEST_BATCH, DUA_DIGEST_INTERVAL
+from bot.database.base import Repository
+from bot.utils.broadcast import SENT, Broadcaster, get_broadcaster
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения Telegram
+MESSAGE_LIMIT = 4096
+DIGEST_HEADER = "<b>Новые дуа</b>"
+
+
+def format_dua(dua: dict, limit: int = MESSAGE_LIMIT) -> str:
+    """Дуа в HTML, не длиннее limit символов: слишком длинный текст обрезается"""
+    sender = f"<b>{escape(dua['sender_name'])}</b>\n"
+    text = dua['text'] or ""
+    entry = sender + escape(text)
+    if len(entry) <= limit:
+        return entry
+    # Экранирование удлиняет текст неравномерно: ищем самое длинное начало текста,
+    # которое после экранирования помещается в limit
+    available = limit - len(sender) - 1
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if len(escape(text[:middle])) <= available:
+            low = middle
+        else:
+            high = middle - 1
+    return sender + escape(text[:low]) + "…"
+
+
+def build_digests(duas: List[dict], limit: int = MESSAGE_LIMIT) -> List[Tuple[str, List[int]]]:
+    """Разложить дуа по сообщениям: список (текст сообщения, id вошедших дуа)"""
+    digests: List[Tuple[str, List[int]]] = []
+    text, dua_ids = DIGEST_HEADER, []
+    for dua in duas:
+        entry = format_dua(dua, limit - len(DIGEST_HEADER) - 2)
+        if dua_ids and len(text) + 2 + len(entry) > limit:
+            digests.append((text, dua_ids))
+            text, dua_ids = DIGEST_HEADER, []
+        text += "\n\n" + entry
+        dua_ids.append(dua['id'])
+    if dua_ids:
+        digests.append((text, dua_ids))
+    return digests
+
+
+class DuaDigest:
+    """Фоновая пересылка дуа в чат администратора"""
+
+    def __init__(
+        self,
+        db: Repository,
+        broadcaster: Broadcaster,
+        chat_id,
+        interval: float = 300,
+        batch_size: int = 10,
+        fetch_size: int = 200
+    ):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.chat_id = chat_id
+        self.interval = interval
+        self.batch_size = batch_size
+        self.fetch_size = fetch_size
+        # Дуа, добавленные в этом процессе после последней сводки
+        self._pending = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is None and self.chat_id:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить пересылку; оставшиеся дуа будут пересланы после запуска"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self):
+        """Сообщить о новом дуа: при накоплении batch_size сводка отправляется сразу"""
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        """Переслать все непересланные дуа, вернуть их количество"""
+        self._pending = 0
+        delivered = 0
+        while True:
+            duas = await self.db.get_undelivered_duas(self.fetch_size)
+            for text, dua_ids in build_digests(duas):
+                outcome = await self.broadcaster.send(self.chat_id, {"text": text, "parse_mode": "HTML"})
+                if outcome != SENT:
+                    logger.error(f"Failed to send dua digest to admin chat: {outcome}")
+                    return delivered
+                await self.db.mark_duas_delivered(dua_ids)
+                delivered += len(dua_ids)
+            if len(duas) < self.fetch_size:
+                break
+        if delivered:
+            logger.info(f"Forwarded {delivered} duas to admin chat")
+        return delivered
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Dua digest failed: {e}")
+
+
+_digest: Optional[DuaDigest] = None
+
+
+def get_dua_digest(bot: Bot, db: Repository) -> DuaDigest:
+    """Общая пересылка дуа процесса"""
+    global _digest
+    broadcaster = get_broadcaster(bot)
+    if _digest is None or _digest.db is not db or _digest.broadcaster is not broadcaster:
+        _digest = DuaDigest(
+            db,
+            broadcaster,
+            ADMIN_CHAT_ID,
+            interval=DUA_DIGEST_INTERVAL,
+            batch_size=DUA_DIGEST_BATCH
+        )
+    return _digest
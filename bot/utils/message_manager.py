@@ -2,13 +2,35 @@
 Утилита для управления сообщениями бота.
 Автоматически удаляет старые сообщения, чтобы не засорять чат.
 """
+import asyncio
 import logging
-from typing import Optional, List
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List, Set
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest
 
 logger = logging.getLogger(__name__)
 
+# Telegram удаляет сообщения бота только в течение 48 часов после отправки
+MESSAGE_DELETE_WINDOW = timedelta(hours=48)
+# Максимум сообщений в одном запросе deleteMessages
+DELETE_MESSAGES_BATCH = 100
+# Одновременных запросов на удаление по всем чатам
+DELETE_CONCURRENCY = 8
+
+_delete_semaphore: Optional[asyncio.Semaphore] = None
+_cleanup_tasks: Set[asyncio.Task] = set()
+# Сообщения, уже поставленные на удаление, по чатам
+_deleting: Dict[int, Set[int]] = {}
+
+
+def _get_delete_semaphore() -> asyncio.Semaphore:
+    """Семафор создается при первом удалении, внутри работающего event loop"""
+    global _delete_semaphore
+    if _delete_semaphore is None:
+        _delete_semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+    return _delete_semaphore
+
 
 async def safe_delete_message(bot: Bot, chat_id: int, message_id: int) -> bool:
     """
@@ -37,45 +59,122 @@ async def safe_delete_message(bot: Bot, chat_id: int, message_id: int) -> bool:
 async def delete_previous_messages(bot: Bot, db, user_id: int, chat_id: int, keep_last: int = 0) -> int:
     """
     Удалить предыдущие сообщения бота из чата.
-    
+
+    Список сообщений читается сразу, а удаление выполняется в фоне,
+    не задерживая ответ пользователю.
+
     Args:
         bot: Экземпляр бота
         db: Экземпляр базы данных
         user_id: ID пользователя
         chat_id: ID чата
         keep_last: Сколько последних сообщений оставить (по умолчанию 0 - удалить все)
-        
+
     Returns:
-        Количество удаленных сообщений
+        Количество сообщений, поставленных на удаление
     """
     # Получаем список сообщений для удаления
     messages = await db.get_bot_messages(user_id, chat_id)
-    
+
     if not messages:
         return 0
-    
+
     # Оставляем последние N сообщений, если указано
     if keep_last > 0 and len(messages) > keep_last:
         messages_to_delete = messages[:-keep_last]
     else:
         messages_to_delete = messages
-    
-    deleted_count = 0
-    message_ids_to_remove = []
-    
-    # Удаляем сообщения
-    for message in messages_to_delete:
-        message_id = message['message_id']
-        if await safe_delete_message(bot, chat_id, message_id):
-            deleted_count += 1
-            message_ids_to_remove.append(message_id)
-    
-    # Удаляем записи из базы данных
-    if message_ids_to_remove:
-        await db.remove_bot_messages(message_ids_to_remove)
-    
-    logger.info(f"Deleted {deleted_count} messages for user {user_id} in chat {chat_id}")
-    return deleted_count
+
+    # Повторное нажатие, пока идет предыдущее удаление, не удаляет те же сообщения второй раз
+    deleting = _deleting.setdefault(chat_id, set())
+    messages_to_delete = [message for message in messages_to_delete if message['message_id'] not in deleting]
+    if not messages_to_delete:
+        return 0
+    message_ids = {message['message_id'] for message in messages_to_delete}
+    deleting.update(message_ids)
+
+    task = asyncio.create_task(_cleanup_messages(bot, db, user_id, chat_id, messages_to_delete))
+    task.add_done_callback(lambda _: _forget_deleting(chat_id, message_ids))
+    # Храним ссылку, иначе задача может быть собрана сборщиком мусора до завершения
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+    return len(messages_to_delete)
+
+
+def _forget_deleting(chat_id: int, message_ids: Set[int]):
+    deleting = _deleting.get(chat_id)
+    if deleting is not None:
+        deleting -= message_ids
+        if not deleting:
+            del _deleting[chat_id]
+
+
+async def wait_for_cleanups():
+    """Дождаться фоновых удалений сообщений (при остановке бота)"""
+    if _cleanup_tasks:
+        await asyncio.gather(*_cleanup_tasks, return_exceptions=True)
+
+
+async def _cleanup_messages(bot: Bot, db, user_id: int, chat_id: int, messages: List[dict]):
+    """Удалить сообщения пачками через deleteMessages и забыть их в базе"""
+    stale_before = datetime.utcnow() - MESSAGE_DELETE_WINDOW
+    fresh_ids = []
+    stale_count = 0
+    for message in messages:
+        # Сообщения старше 48 часов Telegram удалить не даст - не тратим на них запросы
+        if _parse_created_at(message['created_at']) < stale_before:
+            stale_count += 1
+        else:
+            fresh_ids.append(message['message_id'])
+
+    async def delete_chunk(chunk: List[int]) -> int:
+        async with _get_delete_semaphore():
+            return len(chunk) if await safe_delete_messages(bot, chat_id, chunk) else 0
+
+    deleted_count = sum(await asyncio.gather(*(
+        delete_chunk(fresh_ids[start:start + DELETE_MESSAGES_BATCH])
+        for start in range(0, len(fresh_ids), DELETE_MESSAGES_BATCH)
+    )))
+
+    # Записи удаляются в любом случае: повторная попытка закончится той же ошибкой
+    try:
+        await db.remove_bot_messages([message['message_id'] for message in messages], chat_id=chat_id)
+    except Exception as e:
+        logger.error(f"Failed to forget deleted messages for chat {chat_id}: {e}")
+
+    logger.info(
+        f"Deleted {deleted_count} messages for user {user_id} in chat {chat_id}"
+        f" (skipped {stale_count} stale)"
+    )
+
+
+async def safe_delete_messages(bot: Bot, chat_id: int, message_ids: List[int]) -> bool:
+    """
+    Удалить до 100 сообщений одним запросом deleteMessages.
+
+    Сообщения, которые уже удалены или не найдены, Telegram пропускает.
+
+    Returns:
+        True если запрос выполнен успешно, False в противном случае
+    """
+    if len(message_ids) == 1:
+        return await safe_delete_message(bot, chat_id, message_ids[0])
+    try:
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        return True
+    except TelegramBadRequest as e:
+        logger.debug(f"Failed to delete {len(message_ids)} messages in chat {chat_id}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Unexpected error deleting {len(message_ids)} messages in chat {chat_id}: {e}")
+        return False
+
+
+def _parse_created_at(value) -> datetime:
+    """created_at из bot_messages (CURRENT_TIMESTAMP, UTC)"""
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
 
 
 async def track_bot_message(db, user_id: int, chat_id: int, message_id: int):
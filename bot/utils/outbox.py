@@ -0,0 +1,168 @@
+"""
+Надежная очередь рассылок (outbox).
+
+Задание рассылки и список его получателей сохраняются в базе одной
+транзакцией, после чего воркер захватывает получателей порциями и
+отмечает результат доставки каждому. После перезапуска незавершенные
+задания продолжаются с места остановки, а ключ идемпотентности задания
+(например, evening_reminder:2024-03-15) не дает разослать его повторно.
+
+Следующая порция захватывается только после того, как по всем получателям
+предыдущей известен результат и он записан в базу. Получатели, захваченные
+в момент падения процесса, возвращаются в очередь, поэтому повторно
+сообщение может получить не больше одной порции.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot
+
+from bot.database.base import Repository
+from bot.utils.broadcast import Broadcaster, BroadcastStats, get_broadcaster
+
+logger = logging.getLogger(__name__)
+
+# (язык, данные задания) -> аргументы bot.send_message
+JobMessageBuilder = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+
+_message_builders: Dict[str, JobMessageBuilder] = {}
+
+
+def register_message_builder(kind: str):
+    """Зарегистрировать функцию, строящую сообщение для заданий вида kind"""
+    def decorator(builder: JobMessageBuilder) -> JobMessageBuilder:
+        _message_builders[kind] = builder
+        return builder
+
+    return decorator
+
+
+class BroadcastOutbox:
+    """Исполнитель заданий рассылки, сохраненных в базе"""
+
+    def __init__(self, db: Repository, broadcaster: Broadcaster, batch_size: int = 200):
+        self.db = db
+        self.broadcaster = broadcaster
+        self.batch_size = batch_size
+        # False - задания только сохраняются, выполняет их другой процесс
+        self.active = True
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def enqueue(
+        self,
+        job_key: str,
+        kind: str,
+        audience: str,
+        payload: Optional[dict] = None,
+        **parameters
+    ) -> Optional[int]:
+        """Создать задание рассылки и запустить его в фоне.
+
+        Возвращает id задания или None, если задание с таким ключом уже было.
+        """
+        if kind not in _message_builders:
+            raise ValueError(f"Unknown broadcast kind: {kind}")
+        job_id = await self.db.create_broadcast_job(job_key, kind, audience, payload, **parameters)
+        if job_id is None:
+            logger.info(f"Broadcast job '{job_key}' already exists, skipped")
+            return None
+        if self.active:
+            self._start(await self.db.get_broadcast_job(job_id))
+        return job_id
+
+    async def resume(self):
+        """Продолжить задания, не завершенные до перезапуска"""
+        for job in await self.db.get_unfinished_broadcast_jobs():
+            logger.info(f"Resuming broadcast job '{job['job_key']}'")
+            self._start(job)
+
+    async def pickup(self):
+        """Запустить задания, созданные другими процессами"""
+        for job in await self.db.get_unfinished_broadcast_jobs(reset_claimed=False):
+            if job['id'] not in self._tasks:
+                logger.info(f"Picked up broadcast job '{job['job_key']}'")
+                self._start(job)
+
+    async def stop(self):
+        """Остановить выполняющиеся задания, сохранив результаты доставки"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _start(self, job: dict):
+        if job['id'] in self._tasks:
+            return
+        task = asyncio.create_task(self.run(job))
+        self._tasks[job['id']] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job['id'], None))
+
+    async def run(self, job: dict) -> Optional[BroadcastStats]:
+        """Разослать оставшимся получателям задания"""
+        builder = _message_builders.get(job['kind'])
+        if builder is None:
+            logger.error(f"No message builder for broadcast kind '{job['kind']}', job '{job['job_key']}' left pending")
+            return None
+
+        payload = job['payload']
+        # Результат доставки -> user_id получателей
+        results: Dict[str, List[int]] = defaultdict(list)
+        # Получатели текущей порции, переданные рассылке и еще без результата
+        outstanding = 0
+        settled = asyncio.Event()
+        settled.set()
+
+        def on_result(recipient, outcome):
+            nonlocal outstanding
+            results[outcome].append(recipient['user_id'])
+            outstanding -= 1
+            if outstanding <= 0:
+                settled.set()
+
+        async def record():
+            batch = dict(results)
+            results.clear()
+            await self.db.record_broadcast_results(job['id'], batch)
+
+        async def recipients():
+            nonlocal outstanding
+            while True:
+                # Следующая порция захватывается только после результатов по всей
+                # предыдущей: иначе отправляемые еще сообщения остались бы claimed
+                await settled.wait()
+                await record()
+                batch = await self.db.claim_broadcast_recipients(job['id'], self.batch_size)
+                if not batch:
+                    return
+                outstanding = len(batch)
+                settled.clear()
+                for recipient in batch:
+                    yield recipient
+
+        total = await self.db.count_pending_broadcast_recipients(job['id'])
+        try:
+            stats = await self.broadcaster.broadcast(
+                job['job_key'],
+                recipients(),
+                lambda recipient: builder(recipient['language'], payload),
+                total,
+                on_result=on_result
+            )
+        finally:
+            await record()
+        await self.db.finish_broadcast_job(job['id'])
+        return stats
+
+
+_outbox: Optional[BroadcastOutbox] = None
+
+
+def get_outbox(bot: Bot, db: Repository) -> BroadcastOutbox:
+    """Общая очередь рассылок процесса"""
+    global _outbox
+    broadcaster = get_broadcaster(bot)
+    if _outbox is None or _outbox.db is not db or _outbox.broadcaster is not broadcaster:
+        _outbox = BroadcastOutbox(db, broadcaster)
+    return _outbox
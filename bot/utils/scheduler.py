@@ -1,45 +1,65 @@
+import asyncio
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Optional, Set
 import pytz
 from aiogram import Bot
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from bot.database.models import Database
+from bot.database.base import Repository
 from bot.locales.texts import get_text
+from bot.utils.outbox import get_outbox, register_message_builder
+
+# Аудитория каждого вида напоминания: утром - все участники марафона,
+# днем и вечером - только те, кто еще не отметил сегодняшний день
+REMINDER_AUDIENCES = {
+    "morning_reminder": "due_participants",
+    "afternoon_reminder": "due_without_completion",
+    "evening_reminder": "due_without_completion",
+}
+MAX_CATCH_UP_MINUTES = 30
 
 
 class ReminderScheduler:
     """Планировщик напоминаний для пользователей"""
 
-    def __init__(self, bot: Bot, db: Database):
+    def __init__(self, bot: Bot, db: Repository):
         self.bot = bot
         self.db = db
+        self.outbox = get_outbox(bot, db)
         # Устанавливаем часовой пояс Ташкента
         self.timezone = pytz.timezone('Asia/Tashkent')
         self.scheduler = AsyncIOScheduler(timezone=self.timezone)
+        self._last_dispatched: Optional[datetime] = None
+        # Выполняющиеся задачи планировщика, которые нужно дождаться при остановке
+        self._running: Set[asyncio.Task] = set()
 
     def start(self):
         """Запустить планировщик"""
-        # Утреннее напоминание (07:30)
+        # Диспетчер напоминаний: каждую минуту рассылает тем, чье время наступило
         self.scheduler.add_job(
-            self.send_morning_reminder,
-            CronTrigger(hour=13, minute=35, timezone=self.timezone),
-            id="morning_reminder"
+            self._tracked(self.dispatch_reminders),
+            CronTrigger(minute="*", timezone=self.timezone),
+            id="reminder_dispatcher",
+            max_instances=1,
+            coalesce=True
         )
 
-        # Дневное напоминание (17:50)
+        # Пересчет времени напоминаний при переходе на летнее/зимнее время
         self.scheduler.add_job(
-            self.send_afternoon_reminder,
-            CronTrigger(hour=13, minute=40, timezone=self.timezone),
-            id="afternoon_reminder"
+            self._tracked(self.db.refresh_reminder_slots),
+            CronTrigger(hour=0, minute=5, timezone=self.timezone),
+            id="refresh_reminder_slots"
         )
 
-        # Вечернее напоминание (20:00)
+        # Очистка по срокам хранения, архивирование марафонов и сжатие базы
         self.scheduler.add_job(
-            self.send_evening_reminder,
-            CronTrigger(hour=13, minute=50, timezone=self.timezone),
-            id="evening_reminder"
+            self._tracked(self.run_maintenance),
+            CronTrigger(hour=3, minute=30, timezone=self.timezone),
+            id="database_maintenance",
+            max_instances=1
         )
 
         self.scheduler.start()
@@ -49,124 +69,129 @@ class ReminderScheduler:
         """Остановить планировщик"""
         self.scheduler.shutdown()
 
-    async def send_morning_reminder(self):
-        """Отправить утреннее напоминание"""
-        print(f"[{datetime.now()}] Job 'morning_reminder' triggered.")
-        
-        # Получаем всех пользователей
-        all_users = await self.db.get_all_users()
-        print(f"[{datetime.now()}] Found {len(all_users)} users for morning reminder.")
-
-        for user in all_users:
-            user_id = user['user_id']
-            language = user['language']
-
-            builder = InlineKeyboardBuilder()
-            builder.button(text=get_text(language, "yes"), callback_data="morning_yes")
-            builder.button(text=get_text(language, "no"), callback_data="morning_no")
-            builder.adjust(2)
-
+    async def drain(self, timeout: float = 30):
+        """Остановить планировщик и дождаться выполняющихся задач.
+
+        Задачи, не успевшие завершиться за timeout секунд, отменяются.
+        """
+        if self.scheduler.running:
+            # Новые запуски больше не планируются, текущие доработают сами
+            self.scheduler.shutdown(wait=False)
+        tasks = list(self._running)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _tracked(self, job):
+        """Обернуть задачу, чтобы drain мог дождаться ее выполнения"""
+        async def run():
+            task = asyncio.current_task()
+            self._running.add(task)
             try:
-                await self.bot.send_message(
-                    user_id,
-                    get_text(language, "morning_reminder"),
-                    reply_markup=builder.as_markup()
-                )
-            except Exception as e:
-                print(f"Failed to send morning reminder to {user_id}: {e}")
-
-    async def send_afternoon_reminder(self):
-        """Отправить дневное напоминание"""
-        print(f"[{datetime.now()}] Job 'afternoon_reminder' triggered.")
-
-        # Получаем всех пользователей
-        all_users = await self.db.get_all_users()
-        print(f"[{datetime.now()}] Found {len(all_users)} users for afternoon reminder.")
-
-        for user in all_users:
-            user_id = user['user_id']
-            language = user['language']
+                await job()
+            finally:
+                self._running.discard(task)
+
+        run.__name__ = job.__name__
+        run.__qualname__ = job.__qualname__
+        return run
+
+    async def run_maintenance(self):
+        """Обслуживание базы данных"""
+        print(f"[{datetime.now()}] Job 'database_maintenance' triggered.")
+        await self.db.run_maintenance()
+
+    async def dispatch_reminders(self):
+        """Поставить в очередь рассылок напоминания, назначенные на текущую минуту.
+
+        Минуты после последней обработанной (она хранится в базе), пропущенные
+        из-за задержки или перезапуска, досылаются, но не больше
+        MAX_CATCH_UP_MINUTES; ключи заданий не дают разослать одну минуту дважды.
+        """
+        now = datetime.now(pytz.utc).replace(second=0, microsecond=0)
+        if self._last_dispatched is None:
+            # После запуска - с минуты, на которой остановился прошлый процесс
+            self._last_dispatched = await self.db.get_last_reminder_minute() or now - timedelta(minutes=1)
+        oldest = now - timedelta(minutes=MAX_CATCH_UP_MINUTES)
+        if self._last_dispatched < oldest:
+            self._last_dispatched = oldest
+        if self._last_dispatched >= now:
+            return
 
-            try:
-                await self.bot.send_message(
-                    user_id,
-                    get_text(language, "afternoon_reminder")
-                )
-            except Exception as e:
-                print(f"Failed to send afternoon reminder to {user_id}: {e}")
-
-    async def send_evening_reminder(self):
-        """Отправить вечернее напоминание"""
-        print(f"[{datetime.now()}] Job 'evening_reminder' triggered.")
-
-        # Получаем всех пользователей
-        all_users = await self.db.get_all_users()
-        print(f"[{datetime.now()}] Found {len(all_users)} users for evening reminder.")
-
-        for user in all_users:
-            user_id = user['user_id']
-            language = user['language']
-
-            builder = InlineKeyboardBuilder()
-            builder.button(
-                text=get_text(language, "yes_completed"),
-                callback_data="mark_completed"
-            )
-            builder.button(
-                text=get_text(language, "no_not_completed"),
-                callback_data="mark_not_completed"
+        marathon = await self.db.get_active_marathon()
+        while self._last_dispatched < now:
+            minute = self._last_dispatched + timedelta(minutes=1)
+            if marathon:
+                await self._enqueue_due_reminders(minute, marathon['id'])
+            self._last_dispatched = minute
+        await self.db.set_last_reminder_minute(now)
+
+    async def _enqueue_due_reminders(self, minute: datetime, marathon_id: int):
+        utc_minute = minute.hour * 60 + minute.minute
+        # День марафона считается по местной дате каждого получателя:
+        # в зависимости от пояса это дата минуты UTC, предыдущая или следующая
+        day = minute.date()
+        for kind in await self.db.get_due_reminder_kinds(utc_minute):
+            audience = REMINDER_AUDIENCES.get(kind)
+            if audience is None:
+                continue
+            print(f"[{datetime.now()}] Dispatching '{kind}' for {minute:%H:%M} UTC")
+            await self.outbox.enqueue(
+                f"{kind}:{minute:%Y-%m-%d}:{utc_minute:04d}",
+                kind,
+                audience,
+                marathon_id=marathon_id,
+                date=day.isoformat(),
+                previous_date=(day - timedelta(days=1)).isoformat(),
+                next_date=(day + timedelta(days=1)).isoformat(),
+                reminder_kind=kind,
+                utc_minute=utc_minute
             )
-            builder.adjust(1)
 
-            try:
-                await self.bot.send_message(
-                    user_id,
-                    get_text(language, "evening_reminder"),
-                    reply_markup=builder.as_markup()
-                )
-            except Exception as e:
-                print(f"Failed to send evening reminder to {user_id}: {e}")
-
-    async def get_active_marathon_users(self):
-        """Получить список пользователей, участвующих в активном марафоне"""
-        marathon = await self.db.get_active_marathon()
-        if not marathon:
-            return []
-        
-        import aiosqlite
-        async with aiosqlite.connect(self.db.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                """SELECT u.user_id, u.language
-                   FROM users u
-                   INNER JOIN marathon_participants mp ON u.user_id = mp.user_id
-                   WHERE mp.marathon_id = ?""",
-                (marathon['id'],)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
-
-    async def get_users_without_today_completion(self):
-        """Получить список пользователей, не отметивших сегодняшний день"""
-        marathon = await self.db.get_active_marathon()
-        if not marathon:
-            return []
-        
-        today = datetime.now().strftime("%Y-%m-%d")
-        
-        import aiosqlite
-        async with aiosqlite.connect(self.db.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                """SELECT DISTINCT u.user_id, u.language
-                   FROM users u
-                   INNER JOIN marathon_participants mp ON u.user_id = mp.user_id
-                   WHERE mp.marathon_id = ?
-                   AND u.user_id NOT IN (
-                       SELECT user_id FROM daily_completions
-                       WHERE marathon_id = ? AND completion_date = ?
-                   )""",
-                (marathon['id'], marathon['id'], today)
-            ) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+
+@lru_cache(maxsize=None)
+def _morning_keyboard(language: str):
+    builder = InlineKeyboardBuilder()
+    builder.button(text=get_text(language, "yes"), callback_data="morning_yes")
+    builder.button(text=get_text(language, "no"), callback_data="morning_no")
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+@lru_cache(maxsize=None)
+def _evening_keyboard(language: str):
+    builder = InlineKeyboardBuilder()
+    builder.button(
+        text=get_text(language, "yes_completed"),
+        callback_data="mark_completed"
+    )
+    builder.button(
+        text=get_text(language, "no_not_completed"),
+        callback_data="mark_not_completed"
+    )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+@register_message_builder("morning_reminder")
+def build_morning_reminder(language: str, payload: dict):
+    return {
+        'text': get_text(language, "morning_reminder"),
+        'reply_markup': _morning_keyboard(language)
+    }
+
+
+@register_message_builder("afternoon_reminder")
+def build_afternoon_reminder(language: str, payload: dict):
+    return {'text': get_text(language, "afternoon_reminder")}
+
+
+@register_message_builder("evening_reminder")
+def build_evening_reminder(language: str, payload: dict):
+    return {
+        'text': get_text(language, "evening_reminder"),
+        'reply_markup': _evening_keyboard(language)
+    }
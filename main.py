@@ -1,9 +1,44 @@
 import asyncio
+import hmac
 import logging
+import multiprocessing
+import signal
+from functools import partial
+from typing import Callable, Tuple
+
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
-from bot.config import BOT_TOKEN, DATABASE_PATH
+from bot.config import (
+    BOT_MODE,
+    BOT_TOKEN,
+    BOT_WORKERS,
+    DATABASE_PATH,
+    DATABASE_POOL_SIZE,
+    DATABASE_PRAGMAS,
+    DATABASE_URL,
+    DATABASE_WRITE_BATCH_SIZE,
+    DUA_LIMIT_PER_USER,
+    DUA_LIMIT_TOTAL,
+    FSM_CACHE_TTL,
+    FSM_FLUSH_INTERVAL,
+    MESSAGE_BUFFER_SIZE,
+    MESSAGE_FLUSH_INTERVAL,
+    SHUTDOWN_TIMEOUT,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WORKER_LEASE_TTL,
+    WORKER_SYNC_INTERVAL
+)
+from bot.database.base import Repository
+from bot.database.fsm_storage import DatabaseStorage
 from bot.database.models import Database
 from bot.handlers import (
     onboarding_router,
@@ -12,7 +47,11 @@ from bot.handlers import (
     settings_router,
     dua_router
 )
-from bot.middlewares import DatabaseMiddleware
+from bot.middlewares import DatabaseMiddleware, UpdateTracker
+from bot.utils.cluster import KeyedSerializer, LeaderElection, update_partition, update_user_id
+from bot.utils.dua_digest import get_dua_digest
+from bot.utils.message_manager import wait_for_cleanups
+from bot.utils.outbox import get_outbox
 from bot.utils.scheduler import ReminderScheduler
 from bot import set_bot_instance
 
@@ -23,31 +62,66 @@ logger = logging.getLogger(__name__)
 scheduler = None
 
 
-async def main():
-    global scheduler
-    
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN is not set! Please check your .env file")
-        return
+def create_database(shared: bool = False) -> Repository:
+    if DATABASE_URL:
+        # asyncpg нужен только для PostgreSQL
+        from bot.database.postgres import PostgresDatabase
+        return PostgresDatabase(
+            DATABASE_URL,
+            max_pool_size=DATABASE_POOL_SIZE,
+            message_buffer_size=MESSAGE_BUFFER_SIZE,
+            dua_limit_per_user=DUA_LIMIT_PER_USER,
+            dua_limit_total=DUA_LIMIT_TOTAL
+        )
+    return Database(
+        DATABASE_PATH,
+        pool_size=DATABASE_POOL_SIZE,
+        pragmas=DATABASE_PRAGMAS,
+        write_batch_size=DATABASE_WRITE_BATCH_SIZE,
+        user_cache_size=USER_CACHE_SIZE,
+        user_cache_ttl=USER_CACHE_TTL,
+        message_buffer_size=MESSAGE_BUFFER_SIZE,
+        message_flush_interval=MESSAGE_FLUSH_INTERVAL,
+        shared=shared,
+        sync_interval=WORKER_SYNC_INTERVAL,
+        dua_limit_per_user=DUA_LIMIT_PER_USER,
+        dua_limit_total=DUA_LIMIT_TOTAL
+    )
 
-    bot = Bot(token=BOT_TOKEN)
-    set_bot_instance(bot)
 
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+def include_routers(dp: Dispatcher):
+    dp.include_router(onboarding_router)
+    dp.include_router(marathon_router)
+    dp.include_router(admin_router)
+    dp.include_router(settings_router)
+    dp.include_router(dua_router)
 
-    db = Database(DATABASE_PATH)
+
+async def startup(bot: Bot, shared: bool = False) -> Tuple[Dispatcher, Repository, DatabaseStorage]:
+    """Открыть базу и собрать диспетчер"""
+    db = create_database(shared)
     await db.init_db()
 
+    # Состояния FSM хранятся в базе бота и переживают перезапуск. Если базу
+    # используют несколько экземпляров, состояние пишется сразу и не кэшируется
+    if db.multi_instance:
+        storage = DatabaseStorage(db, flush_interval=0, cache_ttl=0)
+    else:
+        storage = DatabaseStorage(db, flush_interval=FSM_FLUSH_INTERVAL, cache_ttl=FSM_CACHE_TTL)
+    storage.start()
+    dp = Dispatcher(storage=storage)
+
     dp.message.middleware(DatabaseMiddleware(db))
     dp.callback_query.middleware(DatabaseMiddleware(db))
 
     # Подключаем все роутеры
-    dp.include_router(onboarding_router)
-    dp.include_router(marathon_router)
-    dp.include_router(admin_router)
-    dp.include_router(settings_router)
-    dp.include_router(dua_router)
+    include_routers(dp)
+    return dp, db, storage
+
+
+async def start_background_jobs(bot: Bot, db: Repository):
+    """Запустить планировщик и продолжить прерванные рассылки"""
+    global scheduler
 
     # Инициализируем и запускаем планировщик напоминаний
     logger.info("Initializing reminder scheduler...")
@@ -56,14 +130,288 @@ async def main():
     scheduler.start()
     logger.info(f"Reminder scheduler started successfully. Jobs: {scheduler.scheduler.get_jobs()}")
 
-    logger.info("Bot starting...")
+    # Продолжаем рассылки, прерванные перезапуском
+    outbox = get_outbox(bot, db)
+    outbox.active = True
+    await outbox.resume()
+
+    # Дуа пересылаются администратору сводками
+    get_dua_digest(bot, db).start()
+
+
+async def stop_background_jobs(bot: Bot, db: Repository):
+    global scheduler
+
+    if scheduler:
+        await scheduler.drain(SHUTDOWN_TIMEOUT)
+        scheduler = None
+        logger.info("Reminder scheduler stopped")
+    outbox = get_outbox(bot, db)
+    outbox.active = False
+    await outbox.stop()
+    await get_dua_digest(bot, db).stop()
+
+
+async def shutdown(bot: Bot, db: Repository, storage: DatabaseStorage):
+    """Graceful shutdown: дождаться фоновых задач и записать все в базу"""
+    await stop_background_jobs(bot, db)
+    await wait_for_cleanups()
+    await storage.close()
+    await db.close()
+
+
+async def run_polling(bot: Bot):
+    dp, db, storage = await startup(bot)
+    await start_background_jobs(bot, db)
+    logger.info("Bot starting in polling mode...")
     try:
+        # getUpdates не работает, пока установлен вебхук
+        await bot.delete_webhook()
         await dp.start_polling(bot)
     finally:
-        # Graceful shutdown
-        if scheduler:
-            scheduler.stop()
-            logger.info("Reminder scheduler stopped")
+        await shutdown(bot, db, storage)
+
+
+def create_webhook_app(bot: Bot, dp: Dispatcher, db: Repository, storage: DatabaseStorage) -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram на WEBHOOK_PATH.
+
+    Запросы без верного секретного заголовка отклоняются с кодом 401.
+    Обновления обрабатываются в фоне, Telegram сразу получает ответ.
+    """
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+    updates = UpdateTracker()
+    dp.update.outer_middleware(updates)
+
+    async def on_shutdown(_: web.Application):
+        # Сервер уже не принимает запросы: дообрабатываем принятые обновления,
+        # затем останавливаем планировщик и фоновые задачи, пока сессия бота открыта
+        if updates.in_flight:
+            logger.info(f"Waiting for {updates.in_flight} updates in progress...")
+            if not await updates.wait(SHUTDOWN_TIMEOUT):
+                logger.warning(f"{updates.in_flight} updates still in progress after {SHUTDOWN_TIMEOUT}s")
+        await shutdown(bot, db, storage)
+
+    # Выполняется раньше закрытия сессии бота, которое регистрирует handler
+    app.on_shutdown.append(on_shutdown)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(bot: Bot):
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode")
+        return
+
+    dp, db, storage = await startup(bot)
+    await start_background_jobs(bot, db)
+    runner = web.AppRunner(create_webhook_app(bot, dp, db, storage))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logger.info(f"Bot starting in webhook mode on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}...")
+
+    try:
+        await set_webhook(bot, dp)
+        await wait_for_stop_signal()
+    finally:
+        logger.info("Stopping webhook server...")
+        await runner.cleanup()
+
+
+async def set_webhook(bot: Bot, dp: Dispatcher):
+    # Несколько экземпляров за балансировщиком регистрируют один и тот же адрес,
+    # поэтому вебхук при остановке не удаляется
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+
+def worker_process(index: int, count: int, updates: multiprocessing.Queue):
+    """Точка входа процесса-воркера"""
+    logging.basicConfig(level=logging.INFO)
+    # Ctrl+C получает вся группа процессов; воркер останавливает главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, count, updates))
+
+
+async def run_worker(index: int, count: int, updates: multiprocessing.Queue):
+    """Обработать обновления своей доли пользователей.
+
+    Обновления одного пользователя обрабатываются строго по очереди.
+    Планировщик и рассылки запускаются, только пока воркер держит аренду.
+    """
+    bot = Bot(token=BOT_TOKEN)
+    set_bot_instance(bot)
+    # Базу изменяют и другие воркеры: кэши сверяются с ней каждые WORKER_SYNC_INTERVAL секунд
+    dp, db, storage = await startup(bot, shared=True)
+    outbox = get_outbox(bot, db)
+    # Рассылки, созданные в этом воркере, выполнит держатель аренды
+    outbox.active = False
+    election = LeaderElection(
+        db,
+        "scheduler",
+        ttl=WORKER_LEASE_TTL,
+        on_elected=partial(start_background_jobs, bot, db),
+        on_demoted=partial(stop_background_jobs, bot, db),
+        on_renewed=outbox.pickup
+    )
+    election.start()
+
+    serializer = KeyedSerializer()
+    loop = asyncio.get_running_loop()
+    logger.info(f"Worker {index + 1}/{count} started")
+    try:
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                break
+            await serializer.submit(update_user_id(update), partial(dp.feed_raw_update, bot, update))
+        await serializer.join(SHUTDOWN_TIMEOUT)
+    finally:
+        await election.stop()
+        await shutdown(bot, db, storage)
+        await bot.session.close()
+        logger.info(f"Worker {index + 1}/{count} stopped")
+
+
+async def receive_polling(bot: Bot, route: Callable[[dict], None], allowed_updates: list):
+    """Получать обновления через getUpdates и передавать их route"""
+    # getUpdates не работает, пока установлен вебхук
+    await bot.delete_webhook()
+    offset = None
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=25, allowed_updates=allowed_updates)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.error(f"Failed to fetch updates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # Подтверждаем переданные воркерам обновления, иначе Telegram пришлет их снова
+            await bot.get_updates(offset=offset, timeout=0, limit=1)
+
+
+def create_routing_app(route: Callable[[dict], None]) -> web.Application:
+    """aiohttp-приложение, передающее обновления с вебхука route без обработки"""
+    async def handle(request: web.Request) -> web.Response:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(secret, WEBHOOK_SECRET):
+            return web.Response(status=401, text="Unauthorized")
+        route(await request.json())
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+
+async def run_workers(bot: Bot, count: int):
+    """Главный процесс: получить обновления и разложить их по воркерам по user_id"""
+    if BOT_MODE == "webhook" and (not WEBHOOK_URL or not WEBHOOK_SECRET):
+        logger.error("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode")
+        return
+
+    # Миграции применяются один раз, до запуска воркеров
+    db = create_database()
+    await db.init_db()
+    await db.close()
+
+    # Диспетчер главного процесса нужен только для списка типов обновлений
+    dp = Dispatcher()
+    include_routers(dp)
+
+    # spawn: воркеру не достаются event loop и соединения главного процесса
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(count)]
+    workers = []
+    for index, queue in enumerate(queues):
+        process = context.Process(target=worker_process, args=(index, count, queue), name=f"worker-{index}")
+        process.start()
+        workers.append(process)
+
+    def route(update: dict):
+        queues[update_partition(update, count)].put(update)
+
+    async def watch_workers():
+        # Упавший воркер перезапускается и продолжает со своей очереди
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.error(f"Worker {index + 1}/{count} exited with code {process.exitcode}, restarting")
+                    workers[index] = context.Process(
+                        target=worker_process,
+                        args=(index, count, queues[index]),
+                        name=f"worker-{index}"
+                    )
+                    workers[index].start()
+
+    watcher = asyncio.create_task(watch_workers())
+    try:
+        if BOT_MODE == "webhook":
+            runner = web.AppRunner(create_routing_app(route))
+            await runner.setup()
+            await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+            logger.info(f"Bot starting in webhook mode with {count} workers on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}...")
+            try:
+                await set_webhook(bot, dp)
+                await wait_for_stop_signal()
+            finally:
+                await runner.cleanup()
+        else:
+            logger.info(f"Bot starting in polling mode with {count} workers...")
+            polling = asyncio.create_task(receive_polling(bot, route, dp.resolve_used_update_types()))
+            stop = asyncio.create_task(wait_for_stop_signal())
+            await asyncio.wait([polling, stop], return_when=asyncio.FIRST_COMPLETED)
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+    finally:
+        watcher.cancel()
+        # Воркеры дообрабатывают свои очереди и завершаются
+        for queue in queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in workers:
+            await loop.run_in_executor(None, process.join, SHUTDOWN_TIMEOUT * 2)
+            if process.is_alive():
+                logger.error(f"Worker {process.name} did not stop in time, terminating")
+                process.terminate()
+        await bot.session.close()
+
+
+async def main():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set! Please check your .env file")
+        return
+
+    bot = Bot(token=BOT_TOKEN)
+    set_bot_instance(bot)
+
+    if BOT_MODE not in ("polling", "webhook"):
+        logger.error(f"Unknown BOT_MODE '{BOT_MODE}', expected 'polling' or 'webhook'")
+    elif BOT_WORKERS > 1:
+        await run_workers(bot, BOT_WORKERS)
+    elif BOT_MODE == "webhook":
+        await run_webhook(bot)
+    else:
+        await run_polling(bot)
 
 
 if __name__ == '__main__':
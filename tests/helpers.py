@@ -0,0 +1,14 @@
+"""
+Общие шаги сценариев тестов хранилища.
+"""
+
+
+async def create_users(db, *user_ids):
+    for user_id in user_ids:
+        await db.create_user(user_id, f"user{user_id}", f"User {user_id}")
+
+
+async def create_marathon(db, goal_amount=1000, start_date="2026-10-01", end_date="2026-10-31"):
+    """Создать активный марафон и вернуть его id"""
+    await db.create_marathon(goal_amount, start_date, end_date)
+    return (await db.get_active_marathon())['id']
@@ -0,0 +1,38 @@
+"""
+Снимок активного марафона: обновляется при создании марафона и отметках.
+"""
+from tests.helpers import create_marathon, create_users
+
+
+def test_new_marathon_replaces_active(run):
+    async def scenario(db):
+        await create_users(db, 1)
+        first_id = await create_marathon(db)
+        await db.mark_day_completed(1, first_id, "2026-10-01", 100)
+        second_id = await create_marathon(db, start_date="2026-11-01", end_date="2026-11-30")
+
+        assert second_id != first_id
+        active = await db.get_active_marathon()
+        assert active['id'] == second_id
+        assert active['current_amount'] == 0
+        assert await db.get_total_marathons_count() == 2
+        assert await db.get_marathon_top(second_id) == []
+        # Рейтинг прошлого марафона по-прежнему доступен
+        assert await db.get_marathon_top(first_id) == [(1, 1, 100)]
+        assert await db.get_marathon_ranking(1, first_id) == (1, 100)
+
+    run(scenario)
+
+
+def test_active_marathon_amount_follows_marks(run):
+    async def scenario(db):
+        await create_users(db, 1)
+        marathon_id = await create_marathon(db)
+        assert (await db.get_active_marathon())['current_amount'] == 0
+
+        await db.mark_day_completed(1, marathon_id, "2026-10-01", 100)
+        assert (await db.get_active_marathon())['current_amount'] == 100
+        await db.mark_day_not_completed(1, marathon_id, "2026-10-01")
+        assert (await db.get_active_marathon())['current_amount'] == 0
+
+    run(scenario)
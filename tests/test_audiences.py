@@ -0,0 +1,27 @@
+"""
+Аудитории рассылок: получатели выбираются одним запросом в базе.
+"""
+from tests.helpers import create_marathon, create_users
+
+
+def test_broadcast_audiences(run):
+    async def scenario(db):
+        await create_users(db, 1, 2, 3)
+        marathon_id = await create_marathon(db)
+        await db.join_marathon(1, marathon_id)
+        await db.join_marathon(2, marathon_id)
+        await db.mark_day_completed(1, marathon_id, "2026-10-05", 100)
+
+        participants = await db.create_broadcast_job(
+            "participants", "reminder", "participants", marathon_id=marathon_id
+        )
+        assert (await db.get_broadcast_job(participants))['total'] == 2
+
+        without_completion = await db.create_broadcast_job(
+            "without_completion", "reminder", "without_completion",
+            marathon_id=marathon_id, date="2026-10-05"
+        )
+        claimed = await db.claim_broadcast_recipients(without_completion, 10)
+        assert [recipient['user_id'] for recipient in claimed] == [2]
+
+    run(scenario)
@@ -0,0 +1,23 @@
+"""
+Пересылка дуа администратору сводками: дуа, еще не отправленные в чат.
+"""
+from tests.helpers import create_users
+
+
+def test_undelivered_duas(run):
+    async def scenario(db):
+        await create_users(db, 1, 2)
+        await db.add_dua(1, "first", "User 1", False)
+        await db.add_dua(2, "second", "User 2", True)
+        await db.add_dua(1, "third", "User 1", False)
+
+        duas = await db.get_undelivered_duas()
+        assert [dua['text'] for dua in duas] == ["first", "second", "third"]
+        assert duas[1]['is_anonymous'] == 1
+        assert [dua['text'] for dua in await db.get_undelivered_duas(limit=2)] == ["first", "second"]
+
+        await db.mark_duas_delivered([duas[0]['id'], duas[1]['id']])
+        await db.mark_duas_delivered([])
+        assert [dua['text'] for dua in await db.get_undelivered_duas()] == ["third"]
+
+    run(scenario)
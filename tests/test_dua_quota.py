@@ -0,0 +1,38 @@
+"""
+Лимиты дуа за неделю Джума: на пользователя и общий.
+"""
+import asyncio
+
+from bot.database.dua_quota import LIMIT_TOTAL, LIMIT_USER
+from tests.helpers import create_users
+
+
+def test_add_dua_limits(run):
+    async def scenario(db):
+        await create_users(db, 1, 2, 3)
+        assert await db.add_dua(1, "first", "User 1", False) is None
+        assert await db.add_dua(1, "second", "User 1", False) is None
+        assert await db.add_dua(1, "third", "User 1", False) == LIMIT_USER
+        assert await db.add_dua(2, "fourth", "Anonymous", True) is None
+        assert await db.add_dua(3, "fifth", "User 3", False) == LIMIT_TOTAL
+
+        assert await db.count_user_duas_this_juma(1) == 2
+        assert await db.count_user_duas_this_juma(3) == 0
+        assert await db.count_total_duas_this_juma() == 3
+        assert await db.get_total_duas_count() == 3
+
+    run(scenario, dua_limit_per_user=2, dua_limit_total=3)
+
+
+def test_add_dua_concurrent_total_limit(run):
+    async def scenario(db):
+        user_ids = list(range(1, 21))
+        await create_users(db, *user_ids)
+        reasons = await asyncio.gather(*(
+            db.add_dua(user_id, "dua", f"User {user_id}", False) for user_id in user_ids
+        ))
+        assert reasons.count(None) == 5
+        assert reasons.count(LIMIT_TOTAL) == 15
+        assert await db.count_total_duas_this_juma() == 5
+
+    run(scenario, dua_limit_per_user=2, dua_limit_total=5)
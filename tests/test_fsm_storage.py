@@ -0,0 +1,17 @@
+"""
+Состояния FSM в базе данных.
+"""
+
+
+def test_fsm_states(run):
+    async def scenario(db):
+        assert await db.load_fsm_state("bot:1:1") is None
+        await db.save_fsm_states([("bot:1:1", "DuaStates:text", '{"name": "A"}'), ("bot:2:2", None, "{}")], [])
+        assert await db.load_fsm_state("bot:1:1") == ("DuaStates:text", '{"name": "A"}')
+        assert await db.load_fsm_state("bot:2:2") == (None, "{}")
+
+        await db.save_fsm_states([("bot:1:1", None, '{"name": "B"}')], ["bot:2:2"])
+        assert await db.load_fsm_state("bot:1:1") == (None, '{"name": "B"}')
+        assert await db.load_fsm_state("bot:2:2") is None
+
+    run(scenario)
@@ -0,0 +1,79 @@
+"""
+Недели Джума: ключи недель и перевод старых строк "%Y-%W".
+"""
+import asyncio
+from datetime import date, datetime, timezone
+
+import aiosqlite
+
+from bot.database.juma import (
+    JumaCalendar,
+    current_juma_week,
+    juma_friday,
+    juma_friday_for,
+    juma_week_key,
+    legacy_week_key
+)
+from bot.database.migrations import _convert_juma_weeks
+
+
+def test_week_ends_on_friday():
+    # 2026-10-17 - суббота, 2026-10-23 - пятница
+    assert juma_friday_for(date(2026, 10, 17)) == date(2026, 10, 23)
+    assert juma_friday_for(date(2026, 10, 23)) == date(2026, 10, 23)
+    assert juma_friday_for(date(2026, 10, 24)) == date(2026, 10, 30)
+
+
+def test_week_key_uses_juma_timezone():
+    # 23:30 пятницы и 00:30 субботы в Ташкенте (UTC+5) - разные недели
+    friday = juma_week_key(datetime(2026, 10, 23, 18, 30, tzinfo=timezone.utc), "Asia/Tashkent")
+    saturday = juma_week_key(datetime(2026, 10, 23, 19, 30, tzinfo=timezone.utc), "Asia/Tashkent")
+    assert juma_friday(friday) == date(2026, 10, 23)
+    assert saturday - friday == 7
+    # Ключи не зависят от границы года
+    assert juma_week_key(datetime(2027, 1, 1, 12, tzinfo=timezone.utc), "Asia/Tashkent") - \
+        juma_week_key(datetime(2026, 12, 25, 12, tzinfo=timezone.utc), "Asia/Tashkent") == 7
+
+
+def test_legacy_week_key():
+    assert juma_friday(legacy_week_key("2024-10")) == date(2024, 3, 8)
+
+
+def test_calendar_matches_week_key():
+    assert JumaCalendar().current() == juma_week_key()
+
+
+def test_repository_current_week(run):
+    async def scenario(db):
+        assert db.get_current_juma_week() == current_juma_week()
+
+    run(scenario)
+
+
+def test_convert_legacy_weeks():
+    async def scenario():
+        async with aiosqlite.connect(":memory:") as db:
+            await db.execute(
+                """CREATE TABLE duas (
+                       id INTEGER PRIMARY KEY, juma_week TEXT, created_at TIMESTAMP, juma_key INTEGER
+                   )"""
+            )
+            await db.executemany(
+                "INSERT INTO duas (id, juma_week, created_at) VALUES (?, ?, ?)",
+                [
+                    (1, "2024-10", "2024-03-05 10:00:00"),
+                    # Неизвестный формат недели - по времени создания
+                    (2, "week 10", "2024-03-09 10:00:00"),
+                    # Ничего не разобрать - текущая неделя
+                    (3, "week 10", "yesterday"),
+                ]
+            )
+            await _convert_juma_weeks(db)
+            async with db.execute("SELECT id, juma_key, juma_week FROM duas ORDER BY id") as cursor:
+                rows = await cursor.fetchall()
+
+        assert rows[0][1:] == (date(2024, 3, 8).toordinal(), "2024-03-08")
+        assert rows[1][1:] == (date(2024, 3, 15).toordinal(), "2024-03-15")
+        assert rows[2][1] == current_juma_week()
+
+    asyncio.run(scenario())
@@ -0,0 +1,28 @@
+"""
+Рейтинг участников марафона: место, топ и соседи по сумме.
+"""
+from tests.helpers import create_marathon, create_users
+
+
+def test_marathon_ranking(run):
+    async def scenario(db):
+        await create_users(db, 1, 2, 3, 4, 5)
+        marathon_id = await create_marathon(db)
+        for user_id, amount in ((1, 100), (2, 300), (3, 200), (4, 300), (5, 50)):
+            await db.join_marathon(user_id, marathon_id)
+            await db.mark_day_completed(user_id, marathon_id, "2026-10-01", amount)
+
+        # При равных суммах место общее, порядок - по user_id
+        assert await db.get_marathon_top(marathon_id, limit=3) == [(1, 2, 300), (1, 4, 300), (3, 3, 200)]
+        assert await db.get_marathon_ranking(4, marathon_id) == (1, 300)
+        assert await db.get_marathon_ranking(1, marathon_id) == (4, 100)
+        # Еще не отмечавший дни пользователь - после всех
+        assert await db.get_marathon_ranking(6, marathon_id) == (6, 0)
+        assert await db.get_marathon_neighbours(3, marathon_id, radius=1) == [(1, 4, 300), (3, 3, 200), (4, 1, 100)]
+        assert await db.get_marathon_neighbours(6, marathon_id) == []
+
+        await db.mark_day_completed(5, marathon_id, "2026-10-02", 500)
+        assert await db.get_marathon_ranking(5, marathon_id) == (1, 550)
+        assert (await db.get_marathon_top(marathon_id, limit=1)) == [(1, 5, 550)]
+
+    run(scenario)
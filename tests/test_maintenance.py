@@ -0,0 +1,73 @@
+"""
+Ночное обслуживание базы: сроки хранения и архивирование марафонов.
+"""
+import asyncio
+
+import aiosqlite
+
+from bot.database.maintenance import enable_incremental_vacuum, incremental_vacuum_enabled
+from tests.helpers import create_marathon, create_users
+
+
+async def execute(db, sql):
+    """Изменить данные в обход Repository (например, состарить записи)"""
+    if hasattr(db, 'writer'):
+        await db.writer.execute(sql, ())
+    else:
+        await db.pool.execute(sql)
+
+
+def test_maintenance_archives_closed_marathons(run):
+    async def scenario(db):
+        await create_users(db, 1, 2)
+        old_id = await create_marathon(db, goal_amount=500, start_date="2020-01-01", end_date="2020-01-31")
+        await db.join_marathon(1, old_id)
+        await db.mark_day_completed(1, old_id, "2020-01-10", 100)
+        await db.mark_day_completed(2, old_id, "2020-01-11", 200)
+        new_id = await create_marathon(db)
+        await db.mark_day_completed(1, new_id, "2026-10-01", 50)
+
+        report = await db.run_maintenance(batch_size=1)
+        assert report['archived'] == {old_id: 2}
+        assert set(report['deleted']) >= {'bot_messages', 'broadcast_jobs', 'fsm_states'}
+
+        # Суммы архивного марафона сохраняются
+        assert (await db.get_marathon_stats(old_id))['total_collected'] == 300
+        assert await db.get_user_marathon_stats(2, old_id) == {
+            'total_contribution': 200, 'completed_days': 1, 'total_days': 1
+        }
+        assert await db.get_total_donations_amount() == 350
+        assert await db.get_user_daily_completions(1, old_id, 2020, 1) == {}
+        assert await db.reconcile_marathon_totals() == []
+
+        # Повторный запуск ничего не переносит
+        assert (await db.run_maintenance())['archived'] == {}
+
+    run(scenario)
+
+
+def test_maintenance_keeps_duas_by_default(run):
+    async def scenario(db):
+        await create_users(db, 1)
+        await db.add_dua(1, "dua", "User 1", False)
+        await execute(db, "UPDATE duas SET created_at = '2000-01-01 00:00:00'")
+
+        report = await db.run_maintenance()
+        # Срок хранения дуа по умолчанию не задан - они не удаляются
+        assert 'duas' not in report['deleted']
+        assert await db.get_total_duas_count() == 1
+
+    run(scenario)
+
+
+def test_enable_incremental_vacuum(tmp_path):
+    async def scenario():
+        async with aiosqlite.connect(str(tmp_path / "test.db")) as connection:
+            await connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+            assert not await incremental_vacuum_enabled(connection)
+            assert await enable_incremental_vacuum(connection)
+            assert await incremental_vacuum_enabled(connection)
+            # Повторный запуск базу не перестраивает
+            assert not await enable_incremental_vacuum(connection)
+
+    asyncio.run(scenario())
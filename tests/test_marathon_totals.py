@@ -0,0 +1,49 @@
+"""
+Итоги марафонов и участников, поддерживаемые при каждой отметке дня.
+"""
+from tests.helpers import create_marathon, create_users
+
+
+def test_marathon_totals(run):
+    async def scenario(db):
+        await create_users(db, 1, 2, 3)
+        assert await db.get_active_marathon() is None
+        marathon_id = await create_marathon(db, goal_amount=1000)
+        for user_id in (1, 2, 3):
+            await db.join_marathon(user_id, marathon_id)
+        await db.join_marathon(1, marathon_id)
+
+        await db.mark_day_completed(1, marathon_id, "2026-10-01", 100)
+        await db.mark_day_completed(1, marathon_id, "2026-10-02", 150)
+        await db.mark_day_completed(2, marathon_id, "2026-10-01", 200)
+        # Повторная отметка того же дня заменяет сумму
+        await db.mark_day_completed(2, marathon_id, "2026-10-01", 50)
+        await db.mark_day_completed(3, marathon_id, "2026-10-01", 300)
+        await db.mark_day_not_completed(3, marathon_id, "2026-10-01")
+
+        assert await db.get_user_marathon_stats(1, marathon_id) == {
+            'total_contribution': 250, 'completed_days': 2, 'total_days': 2
+        }
+        assert await db.get_user_marathon_stats(3, marathon_id) == {
+            'total_contribution': 0, 'completed_days': 0, 'total_days': 1
+        }
+        assert await db.get_user_marathon_stats(4, marathon_id) == {
+            'total_contribution': 0, 'completed_days': 0, 'total_days': 0
+        }
+        assert await db.get_marathon_stats(marathon_id) == {
+            'total_collected': 300, 'participants_count': 3, 'percent': 30
+        }
+        assert (await db.get_active_marathon())['current_amount'] == 300
+        assert await db.get_daily_global_stats(marathon_id, "2026-10-01") == {
+            'total_amount': 150, 'participants_count': 2
+        }
+        assert await db.get_user_daily_completions(1, marathon_id, 2026, 10) == {1: "completed", 2: "completed"}
+        assert await db.get_user_daily_completions(3, marathon_id, 2026, 10) == {1: "not_completed"}
+        assert await db.get_user_daily_completions(1, marathon_id, 2026, 11) == {}
+
+        assert await db.get_total_marathons_count() == 1
+        assert await db.get_total_donations_amount() == 300
+        assert await db.reconcile_marathon_totals() == []
+        assert await db.verify_leaderboard() == []
+
+    run(scenario)
@@ -0,0 +1,28 @@
+"""
+Сообщения бота в чатах: учет в памяти и отложенная запись в bot_messages.
+"""
+
+
+def test_bot_messages(run):
+    async def scenario(db):
+        for message_id in (10, 11, 12):
+            await db.add_bot_message(1, 100, message_id)
+        await db.add_bot_message(1, 200, 10)
+
+        messages = await db.get_bot_messages(1, 100)
+        assert [message['message_id'] for message in messages] == [10, 11, 12]
+        assert all(message['created_at'] for message in messages)
+
+        await db.remove_bot_messages([10, 11], chat_id=100)
+        assert [message['message_id'] for message in await db.get_bot_messages(1, 100)] == [12]
+        assert [message['message_id'] for message in await db.get_bot_messages(1, 200)] == [10]
+
+        await db.remove_bot_messages([10])
+        assert await db.get_bot_messages(1, 200) == []
+        await db.remove_bot_messages([])
+
+        # Свежие сообщения не удаляются
+        await db.clear_old_bot_messages(days=7)
+        assert [message['message_id'] for message in await db.get_bot_messages(1, 100)] == [12]
+
+    run(scenario)
@@ -0,0 +1,119 @@
+"""
+Очередь рассылок: задания и получатели в базе, исполнитель BroadcastOutbox.
+"""
+import asyncio
+
+from bot.utils.broadcast import Broadcaster
+from bot.utils.outbox import BroadcastOutbox, register_message_builder
+from tests.helpers import create_users
+
+
+@register_message_builder("test")
+def build_test_message(language, payload):
+    return {"text": payload['text']}
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, **message):
+        # Разное время отправки перемешивает порядок результатов
+        await asyncio.sleep(0.001 * (chat_id % 3))
+        self.sent.append(chat_id)
+
+
+def test_broadcast_outbox(run):
+    async def scenario(db):
+        await create_users(db, 1, 2, 3, 4)
+        await db.update_user_language(2, "ru")
+
+        job_id = await db.create_broadcast_job("news:1", "news", "all", {"text": "Salom"})
+        assert job_id is not None
+        # Ключ идемпотентности: повторное создание ничего не делает
+        assert await db.create_broadcast_job("news:1", "news", "all", {"text": "Salom"}) is None
+
+        job = await db.get_broadcast_job(job_id)
+        assert job['job_key'] == "news:1"
+        assert job['kind'] == "news"
+        assert job['payload'] == {"text": "Salom"}
+        assert job['total'] == 4
+        assert await db.get_broadcast_job(job_id + 100) is None
+        assert await db.count_pending_broadcast_recipients(job_id) == 4
+
+        claimed = await db.claim_broadcast_recipients(job_id, 3)
+        assert sorted(recipient['user_id'] for recipient in claimed) == [1, 2, 3]
+        assert {recipient['user_id']: recipient['language'] for recipient in claimed}[2] == "ru"
+        assert await db.count_pending_broadcast_recipients(job_id) == 1
+
+        # Без сброса захваченные получатели остаются за своим рассыльщиком
+        assert [job['id'] for job in await db.get_unfinished_broadcast_jobs(reset_claimed=False)] == [job_id]
+        assert await db.count_pending_broadcast_recipients(job_id) == 1
+        # После перезапуска захваченные получатели возвращаются в очередь
+        assert [job['id'] for job in await db.get_unfinished_broadcast_jobs()] == [job_id]
+        assert await db.count_pending_broadcast_recipients(job_id) == 4
+
+        claimed = await db.claim_broadcast_recipients(job_id, 10)
+        assert len(claimed) == 4
+        assert await db.claim_broadcast_recipients(job_id, 10) == []
+        await db.record_broadcast_results(job_id, {
+            'sent': [1],
+            'blocked': [2],
+            'deactivated': [3],
+            'failed': [4],
+        })
+        await db.record_broadcast_results(job_id, {})
+        await db.finish_broadcast_job(job_id)
+        assert await db.get_unfinished_broadcast_jobs() == []
+
+        assert await db.get_unreachable_users_count() == {'blocked': 1, 'deactivated': 1, 'backoff': 1}
+        assert (await db.get_user(2))['is_blocked'] == 1
+        assert (await db.get_user(4))['failure_count'] == 1
+
+        # Недоступные пользователи не попадают в следующие рассылки
+        next_job_id = await db.create_broadcast_job("news:2", "news", "all")
+        assert (await db.get_broadcast_job(next_job_id))['payload'] == {}
+        assert [recipient['user_id'] for recipient in await db.claim_broadcast_recipients(next_job_id, 10)] == [1]
+
+        # Пользователь снова написал боту
+        await db.mark_user_reachable(2)
+        user = await db.get_user(2)
+        assert user['is_blocked'] == 0
+        assert await db.get_unreachable_users_count() == {'blocked': 0, 'deactivated': 1, 'backoff': 1}
+
+    run(scenario)
+
+
+def test_next_batch_claimed_after_previous_results(run):
+    async def scenario(db):
+        await create_users(db, *range(1, 11))
+
+        claimed, recorded = [], []
+        claim, record = db.claim_broadcast_recipients, db.record_broadcast_results
+
+        async def checked_claim(job_id, limit):
+            # Ни один получатель прошлых порций не должен оставаться claimed
+            assert sorted(recorded) == sorted(claimed)
+            batch = await claim(job_id, limit)
+            claimed.extend(recipient['user_id'] for recipient in batch)
+            return batch
+
+        async def tracked_record(job_id, results):
+            for user_ids in results.values():
+                recorded.extend(user_ids)
+            await record(job_id, results)
+
+        db.claim_broadcast_recipients = checked_claim
+        db.record_broadcast_results = tracked_record
+
+        bot = FakeBot()
+        outbox = BroadcastOutbox(db, Broadcaster(bot, rate=10000, concurrency=4), batch_size=3)
+        job_id = await db.create_broadcast_job("test:1", "test", "all", {"text": "Salom"})
+        stats = await outbox.run(await db.get_broadcast_job(job_id))
+
+        assert stats.sent == 10
+        assert sorted(bot.sent) == list(range(1, 11))
+        assert sorted(recorded) == list(range(1, 11))
+        assert await db.get_unfinished_broadcast_jobs() == []
+
+    run(scenario)
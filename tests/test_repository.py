@@ -0,0 +1,46 @@
+"""
+Общие методы Repository на SQLite и PostgreSQL: обе реализации должны вести
+себя одинаково. Сценарии отдельных возможностей - в своих модулях tests/.
+"""
+from bot.database.migrations import MIGRATIONS
+from tests.helpers import create_users
+
+
+def test_schema_is_up_to_date(run, backend):
+    async def scenario(db):
+        if backend == "postgres":
+            from bot.database.postgres import POSTGRES_MIGRATIONS
+
+            assert db.schema_version == POSTGRES_MIGRATIONS[-1][0]
+        else:
+            assert db.schema_version == MIGRATIONS[-1][0]
+
+    run(scenario)
+
+
+# Пользователи
+
+def test_users(run):
+    async def scenario(db):
+        assert await db.get_user(1) is None
+        await create_users(db, 1, 2)
+
+        user = await db.get_user(1)
+        assert user['username'] == "user1"
+        assert user['language'] == "uz_latin"
+        assert user['state'] == "NEW"
+
+        await db.update_user_language(1, "ru")
+        await db.update_user_state(1, "ACTIVE")
+        await db.update_user_daily_plan(1, 5000)
+        await db.update_user_display_name(1, "Abdulloh", True)
+        user = await db.get_user(1)
+        assert user['language'] == "ru"
+        assert user['state'] == "ACTIVE"
+        assert user['daily_plan'] == 5000
+        assert user['display_name'] == "Abdulloh"
+        assert user['is_anonymous'] == 1
+
+        assert await db.get_total_users_count() == 2
+
+    run(scenario)
@@ -0,0 +1,135 @@
+"""
+Расписание напоминаний пользователей и диспетчер ReminderScheduler.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bot.utils.scheduler import MAX_CATCH_UP_MINUTES, ReminderScheduler
+from tests.helpers import create_marathon, create_users
+
+# 10:00 UTC: 15:00 в Ташкенте, 00:00 следующего дня на Киритимати (UTC+14),
+# 23:00 предыдущего дня в Паго-Паго (UTC-11)
+MINUTE = datetime(2026, 10, 18, 10, 0, tzinfo=timezone.utc)
+USERS = {
+    1: ("Asia/Tashkent", "15:00"),
+    2: ("Pacific/Kiritimati", "00:00"),
+    3: ("Pacific/Pago_Pago", "23:00"),
+    4: ("Asia/Tashkent", "15:00"),
+    5: ("Pacific/Kiritimati", "00:00"),
+}
+
+
+async def create_scheduler(db):
+    scheduler = ReminderScheduler(bot=object(), db=db)
+    # Задания только сохраняются в базе, без отправки
+    scheduler.outbox.active = False
+    return scheduler
+
+
+async def pending_recipients(db):
+    user_ids = []
+    for job in await db.get_unfinished_broadcast_jobs(reset_claimed=False):
+        user_ids += [recipient['user_id'] for recipient in await db.claim_broadcast_recipients(job['id'], 100)]
+    return sorted(user_ids)
+
+
+def test_reminder_slots(run):
+    async def scenario(db):
+        await create_users(db, 1)
+        await db.update_user_timezone(1, "Asia/Tashkent")
+        # Окно длиной в одну минуту: 07:00 в Ташкенте (UTC+5) - 02:00 UTC
+        await db.update_reminder_window(1, "morning_reminder", "07:00", 1)
+        assert "morning_reminder" in await db.get_due_reminder_kinds(120)
+        assert (await db.get_user(1))['timezone'] == "Asia/Tashkent"
+
+        # Смещения не менялись - пересчитывать нечего
+        assert await db.refresh_reminder_slots() == 0
+
+        # Последняя обработанная диспетчером минута только растет
+        assert await db.get_last_reminder_minute() is None
+        minute = datetime(2026, 10, 18, 10, 0, tzinfo=timezone.utc)
+        await db.set_last_reminder_minute(minute)
+        await db.set_last_reminder_minute(minute - timedelta(minutes=5))
+        assert await db.get_last_reminder_minute() == minute
+
+        with pytest.raises(ValueError):
+            await db.update_reminder_window(1, "night_reminder", "23:00", 1)
+        with pytest.raises(ValueError):
+            await db.update_user_timezone(1, "Mars/Olympus")
+
+    run(scenario)
+
+
+def test_reminder_skips_users_marked_on_their_local_date(run):
+    async def scenario(db):
+        marathon_id = await create_marathon(db)
+        await create_users(db, *USERS)
+        for user_id, (timezone_name, start) in USERS.items():
+            await db.join_marathon(user_id, marathon_id)
+            await db.update_user_timezone(user_id, timezone_name)
+            await db.update_reminder_window(user_id, "evening_reminder", start, 1)
+
+        # Отметки за местный день каждого получателя
+        await db.mark_day_completed(1, marathon_id, "2026-10-18", 100)
+        await db.mark_day_completed(2, marathon_id, "2026-10-19", 100)
+        await db.mark_day_not_completed(3, marathon_id, "2026-10-17")
+        # Отметка за дату UTC, а не за местную дату, не считается
+        await db.mark_day_completed(5, marathon_id, "2026-10-18", 100)
+
+        scheduler = await create_scheduler(db)
+        await scheduler._enqueue_due_reminders(MINUTE, marathon_id)
+        assert await pending_recipients(db) == [4, 5]
+
+    run(scenario)
+
+
+async def dispatched_minutes(db, last_minute=None):
+    """Минуты, которые диспетчер обработает после запуска"""
+    await create_marathon(db)
+    if last_minute is not None:
+        await db.set_last_reminder_minute(last_minute)
+    scheduler = await create_scheduler(db)
+    minutes = []
+
+    async def enqueue(minute, marathon_id):
+        minutes.append(minute)
+
+    scheduler._enqueue_due_reminders = enqueue
+    await scheduler.dispatch_reminders()
+    assert await db.get_last_reminder_minute() == minutes[-1]
+    return minutes
+
+
+def now_minute():
+    return datetime.now(timezone.utc).replace(second=0, microsecond=0)
+
+
+def test_first_start_dispatches_current_minute(run):
+    async def scenario(db):
+        now = now_minute()
+        minutes = await dispatched_minutes(db)
+        # Сменившаяся во время теста минута тоже допустима
+        assert minutes in ([now], [now, now + timedelta(minutes=1)])
+
+    run(scenario)
+
+
+def test_catch_up_starts_after_last_processed_minute(run):
+    async def scenario(db):
+        now = now_minute()
+        minutes = await dispatched_minutes(db, now - timedelta(minutes=3))
+        assert minutes[:3] == [now - timedelta(minutes=offset) for offset in (2, 1, 0)]
+        assert len(minutes) <= 4
+
+    run(scenario)
+
+
+def test_catch_up_is_limited(run):
+    async def scenario(db):
+        now = now_minute()
+        minutes = await dispatched_minutes(db, now - timedelta(hours=5))
+        assert minutes[0] >= now - timedelta(minutes=MAX_CATCH_UP_MINUTES - 1)
+        assert len(minutes) <= MAX_CATCH_UP_MINUTES + 1
+
+    run(scenario)
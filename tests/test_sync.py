@@ -0,0 +1,70 @@
+"""
+Несколько процессов с одной базой: аренды ролей и синхронизация кэшей.
+"""
+import asyncio
+
+from bot.database.models import Database
+from tests.helpers import create_marathon, create_users
+
+
+def test_leases(run):
+    async def scenario(db):
+        assert await db.acquire_lease("scheduler", "a", 30)
+        assert not await db.acquire_lease("scheduler", "b", 30)
+        # Владелец продлевает аренду
+        assert await db.acquire_lease("scheduler", "a", 30)
+        # Чужую аренду освободить нельзя
+        await db.release_lease("scheduler", "b")
+        assert not await db.acquire_lease("scheduler", "b", 30)
+
+        await db.release_lease("scheduler", "a")
+        assert await db.acquire_lease("scheduler", "b", 30)
+
+        # Истекшую аренду забирает другой процесс
+        assert await db.acquire_lease("outbox", "a", -1)
+        assert await db.acquire_lease("outbox", "b", 30)
+
+    run(scenario)
+
+
+def test_sync_external_changes(run, backend):
+    async def scenario(db):
+        # Изменения, внесенные самим процессом, не требуют сброса кэшей
+        await create_users(db, 1)
+        assert await db.sync_external_changes() is False
+
+    if backend == "sqlite":
+        run(scenario, shared=True, sync_interval=3600)
+    else:
+        run(scenario)
+
+
+def test_sync_reloads_leaderboard_only_for_totals(tmp_path):
+    async def main():
+        path = str(tmp_path / "shared.db")
+        first = Database(path, shared=True, sync_interval=3600)
+        second = Database(path, shared=True, sync_interval=3600)
+        await first.init_db()
+        await second.init_db()
+        try:
+            await create_users(first, 1)
+            marathon_id = await create_marathon(first)
+            await first.mark_day_completed(1, marathon_id, "2026-10-01", 100)
+            await second.sync_external_changes()
+            leaderboard = second.leaderboard
+
+            # Другой процесс изменил только пользователей: рейтинг не перезагружается
+            await first.create_user(2, "user2", "User 2")
+            assert await second.sync_external_changes() is True
+            assert second.leaderboard is leaderboard
+            assert (await second.get_user(2))['username'] == "user2"
+
+            await first.mark_day_completed(2, marathon_id, "2026-10-01", 300)
+            assert await second.sync_external_changes() is True
+            assert second.leaderboard is not leaderboard
+            assert await second.get_marathon_ranking(2, marathon_id) == (1, 300)
+        finally:
+            await first.close()
+            await second.close()
+
+    asyncio.run(main())
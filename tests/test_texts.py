@@ -0,0 +1,31 @@
+"""
+Каталог текстов: проверка при загрузке и подстановки.
+"""
+import pytest
+
+from bot.locales.texts import TEXTS, compile_catalog, get_text
+
+
+def test_get_text():
+    assert get_text("ru", "settings") == "Настройки"
+    assert "5/20" in get_text("uz_latin", "dua_limit_warning", total=5)
+    # Неизвестный язык - язык по умолчанию, неизвестный ключ - сам ключ
+    assert get_text("en", "settings") == get_text("uz_latin", "settings")
+    assert get_text("ru", "no_such_key") == "no_such_key"
+
+
+def test_catalog_templates_match_str_format():
+    catalog = compile_catalog(TEXTS)
+    for language, templates in catalog.items():
+        for key, template in templates.items():
+            values = {field: 7 for field in template.fields}
+            assert template.format(**values) == TEXTS[language][key].format(**values)
+
+
+def test_catalog_rejects_mismatched_placeholders():
+    with pytest.raises(ValueError, match="missing"):
+        compile_catalog({"ru": {"a": "A", "b": "B"}, "uz_latin": {"a": "A"}})
+    with pytest.raises(ValueError, match="placeholders"):
+        compile_catalog({"ru": {"a": "{total}"}, "uz_latin": {"a": "{count}"}})
+    with pytest.raises(ValueError):
+        compile_catalog({"ru": {"a": "{total"}})
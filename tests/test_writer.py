@@ -0,0 +1,77 @@
+"""
+Единственный писатель SQLite: сбой транзакции не должен останавливать очередь записи.
+"""
+import asyncio
+
+import pytest
+
+from bot.database.writer import WriteQueue
+
+
+def run_writer(tmp_path, scenario):
+    async def main():
+        # Отложенный внешний ключ проверяется только при COMMIT
+        writer = WriteQueue(str(tmp_path / "writer.db"), pragmas={"foreign_keys": "ON"})
+        await writer.start()
+        try:
+            await writer.execute("CREATE TABLE parents (id INTEGER PRIMARY KEY)")
+            await writer.execute(
+                """CREATE TABLE children (
+                       id INTEGER PRIMARY KEY,
+                       parent_id INTEGER REFERENCES parents (id) DEFERRABLE INITIALLY DEFERRED
+                   )"""
+            )
+            await scenario(writer)
+        finally:
+            await asyncio.wait_for(writer.stop(), timeout=5)
+
+    asyncio.run(main())
+
+
+async def count(writer, table):
+    async def operation(db):
+        async with db.execute(f"SELECT COUNT(*) FROM {table}") as cursor:
+            return (await cursor.fetchone())[0]
+
+    return await writer.submit(operation)
+
+
+def test_failed_commit_fails_whole_batch(tmp_path):
+    async def scenario(writer):
+        results = await asyncio.wait_for(asyncio.gather(
+            writer.execute("INSERT INTO parents (id) VALUES (1)"),
+            writer.execute("INSERT INTO children (parent_id) VALUES (42)"),
+            return_exceptions=True
+        ), timeout=5)
+        assert all(isinstance(result, Exception) for result in results)
+        assert "FOREIGN KEY" in str(results[1])
+
+        # Транзакция откатана, писатель продолжает работать
+        assert await asyncio.wait_for(writer.execute("INSERT INTO parents (id) VALUES (2)"), timeout=5) == 1
+        assert await count(writer, "parents") == 1
+        assert await count(writer, "children") == 0
+
+    run_writer(tmp_path, scenario)
+
+
+def test_writer_survives_batch_failure(tmp_path, monkeypatch):
+    async def scenario(writer):
+        run_batch = writer._run_batch
+        calls = []
+
+        async def failing_run_batch(db, batch):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                # Как если бы сам BEGIN IMMEDIATE завершился ошибкой ввода-вывода
+                await db.execute("BEGIN IMMEDIATE")
+                raise OSError("disk I/O error")
+            await run_batch(db, batch)
+
+        monkeypatch.setattr(writer, "_run_batch", failing_run_batch)
+        with pytest.raises(OSError):
+            await asyncio.wait_for(writer.execute("INSERT INTO parents (id) VALUES (1)"), timeout=5)
+        assert writer.is_running
+        assert await asyncio.wait_for(writer.execute("INSERT INTO parents (id) VALUES (2)"), timeout=5) == 1
+        assert await count(writer, "parents") == 1
+
+    run_writer(tmp_path, scenario)
@@ -0,0 +1,56 @@
+"""
+Перевод базы SQLite в режим auto_vacuum = INCREMENTAL.
+
+Без этого режима ночное обслуживание не может вернуть свободные страницы
+и файл базы только растет. Включение требует полного VACUUM: файл
+перестраивается целиком, на время работы база заблокирована, а на диске
+нужно свободное место размером с базу. Поэтому команда выполняется один раз
+при остановленном боте:
+
+    python tools/enable_incremental_vacuum.py
+    python tools/enable_incremental_vacuum.py --database /path/to/sadaka_bot.db
+
+Если режим уже включен, база не меняется.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import aiosqlite
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.config import DATABASE_PATH  # noqa: E402
+from bot.database.maintenance import enable_incremental_vacuum  # noqa: E402
+
+
+async def run(args):
+    if not os.path.exists(args.database):
+        sys.exit(f"Database {args.database} does not exist")
+    size_before = os.path.getsize(args.database)
+    started = time.perf_counter()
+    async with aiosqlite.connect(args.database, timeout=args.timeout) as connection:
+        rebuilt = await enable_incremental_vacuum(connection)
+    if not rebuilt:
+        print(f"Incremental auto_vacuum is already enabled for {args.database}")
+        return
+    size_after = os.path.getsize(args.database)
+    print(
+        f"Incremental auto_vacuum enabled for {args.database} in {time.perf_counter() - started:.1f}s, "
+        f"size {size_before} -> {size_after} bytes"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enable incremental auto_vacuum (runs a full VACUUM, stop the bot first)")
+    parser.add_argument("--database", default=DATABASE_PATH, help="path to the SQLite database")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for other connections to release the database")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Локальная проверка webhook-режима.
+
+Отправляет на запущенный бот (BOT_MODE=webhook) синтетические обновления
+Telegram в том виде, в каком их присылает сервер Telegram, и выводит коды
+ответов и задержку. Пользователи создаются с id, начиная с --first-user-id,
+чтобы не пересекаться с настоящими.
+
+    python tools/webhook_harness.py --text /start --users 50 --concurrency 10
+    python tools/webhook_harness.py --callback marathon_info
+    python tools/webhook_harness.py --secret wrong   # ожидается 401
+
+По умолчанию адрес и секрет берутся из bot.config (WEBAPP_PORT, WEBHOOK_PATH,
+WEBHOOK_SECRET).
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+from collections import Counter
+
+from aiohttp import ClientSession
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.config import WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET  # noqa: E402
+
+_update_ids = itertools.count(int(time.time()))
+
+
+def build_message_update(user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Test", "username": f"test{user_id}", "language_code": "ru"}
+    return {
+        "update_id": next(_update_ids),
+        "message": {
+            "message_id": next(_update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": "Test"},
+            "from": user,
+            "text": text,
+            **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+               if text.startswith("/") else {}),
+        },
+    }
+
+
+def build_callback_update(user_id: int, data: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "Test", "language_code": "ru"}
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": "Test"},
+                "text": "...",
+            },
+        },
+    }
+
+
+async def run(args):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def post(session: ClientSession, update: dict):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(args.url, json=update, headers=headers) as response:
+                await response.read()
+                statuses[response.status] += 1
+            latencies.append(time.perf_counter() - started)
+
+    updates = []
+    for user_id in range(args.first_user_id, args.first_user_id + args.users):
+        for _ in range(args.repeat):
+            if args.callback:
+                updates.append(build_callback_update(user_id, args.callback))
+            else:
+                updates.append(build_message_update(user_id, args.text))
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"Sent {len(updates)} updates to {args.url} in {elapsed:.2f}s ({len(updates) / elapsed:.1f}/s)")
+    print(f"Statuses: {dict(statuses)}")
+    if latencies:
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"Latency: p50 {p50 * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post synthetic Telegram updates to the bot webhook")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{WEBAPP_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET, help="value of X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--text", default="/start", help="message text")
+    parser.add_argument("--callback", help="send callback queries with this data instead of messages")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="updates per user")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--first-user-id", type=int, default=900000000)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()